@@ -74,7 +74,7 @@ for i in range(62, 87):
     
     # Run OCCULT-2
     print("Tracing frame {}".format(i))
-    ls_occ = AutoTracingOCCULT(data=filt1).run(
+    ls_occ = AutoTracingOCCULT(data=filt1, cache=True).run(
         nsm1=6,
         ngap=3, 
         rmin=25,
@@ -43,7 +43,7 @@ def gaussian_smoothing(img_data, params):
 
     return(gs)
 
-def rolling_hough_transform(img_data, params):
+def rolling_hough_transform(img_data, params, engine="convolve", raw=None, progress=None, stride=1):
     """
     Perform a Rolling Hough Transform on the image data.
 
@@ -60,23 +60,151 @@ def rolling_hough_transform(img_data, params):
             Threshold value from 0.0 to 1.0, which acts
             as a threshold intensity above which a pixel 
             is part of a feature.
+        center : float or None (optional)
+            Orientation of the features to keep, in degrees
+            (0 to 180), as rht.theta_rht() reports it. None
+            keeps every orientation.
+        halfwidth : float or None (optional)
+            Only orientations within this many degrees of
+            center are evaluated.
+    engine : str
+        Hough evaluation engine, one of "loop", "convolve",
+        "sparse" or "bitpack". All give identical results; the
+        others are much faster than "loop" on large images.
+    raw : dict (optional)
+        Raw transform of img_data from rht_raw() with the same
+        wlen and smr. If given, only the frac threshold is applied,
+        which is near-instant. It is ignored when frac is below
+        the min_frac of raw.
+    progress : rht.Progress (optional)
+        Progress of the run, whose callbacks are called at
+        a throttled rate while the transform runs.
+    stride : int
+        Evaluate only every stride-th row and column of windows,
+        filling in the rest, for a fast preview. With the "sparse"
+        and "bitpack" engines this is about stride**2 times less
+        Hough work; "convolve" gains little. raw is ignored when 
+        stride > 1.
     
     Returns
     -------
     data : ndarray
         Image. 
     """
+    theta_range = get_theta_range(params)
+    if raw is not None and stride == 1 and params[2] >= raw["min_frac"]:
+        return(rht.raw_frac(raw, params[2], theta_range=theta_range)[-1])
+
     rht_img = rht.rht(
         '',
         data=img_data, 
         wlen=params[0], 
         smr=params[1], 
-        frac=params[2]
+        frac=params[2],
+        engine=engine,
+        backproj_only=True,
+        progress=progress,
+        theta_range=theta_range,
+        stride=stride
         )[-1]
 
     return(rht_img)
+
+def get_theta_range(params):
+    """
+    Orientation restriction of the RHT parameters.
+
+    Parameters
+    ----------
+    params : list
+        Parameters of rolling_hough_transform().
+
+    Returns
+    -------
+    theta_range : tuple or None
+        (center, halfwidth) in radians, or None if 
+        every orientation is kept. center is on the
+        theta axis of the RHT, where a theta_rht() 
+        angle a is the bin angle pi - a.
+    """
+    if len(params) < 5 or params[3] is None or params[4] is None:
+        return(None)
+    return((np.pi - np.radians(params[3]), np.radians(params[4])))
     
 
+def rht_raw(img_data, params, engine="sparse", min_frac=rht.RAW_MIN_FRAC, progress=None, 
+        roi=None, previous=None):
+    """
+    Compute the raw Rolling Hough Transform of the image data,
+    which rolling_hough_transform() can threshold for any frac.
+
+    Parameters
+    ----------
+    img_data : ndarray
+    params : list
+        Same as rolling_hough_transform(). Only wlen and smr
+        are used; the raw transform holds every orientation.
+    engine : str
+        Hough evaluation engine, "convolve", "sparse" or "bitpack".
+    min_frac : float
+        Smallest frac the raw transform can be thresholded at.
+        Only windows that can pass it are kept.
+    progress : rht.Progress (optional)
+        Progress of the run, see rolling_hough_transform().
+    roi : tuple (optional)
+        (y0, y1, x0, x1) bounds of the pixels that changed since
+        previous, as from changed_region(). Only the windows they
+        can affect are recomputed.
+    previous : dict (optional)
+        Raw transform of the image before the change, with the
+        same wlen and smr and no higher min_frac. Required with roi.
+
+    Returns
+    -------
+    raw : dict
+    """
+    raw = rht.rht_raw(
+        '',
+        data=img_data,
+        wlen=params[0],
+        smr=params[1],
+        engine=engine,
+        min_frac=min_frac,
+        progress=progress,
+        roi=roi,
+        previous=previous
+        )
+
+    return(raw)
+
+def changed_region(before, after):
+    """
+    Bounding box of the pixels that differ between two images.
+    NaN pixels, such as the borders of rotated or cropped frames,
+    only count as changed where the other image is not NaN.
+
+    Parameters
+    ----------
+    before : ndarray
+    after : ndarray
+        Image of the same shape as before.
+
+    Returns
+    -------
+    roi : tuple or None
+        (y0, y1, x0, x1) half-open bounds of the changed pixels,
+        or None if the images are identical.
+    """
+    before = np.asarray(before)
+    after = np.asarray(after)
+    same = before == after
+    if np.issubdtype(before.dtype, np.inexact) or np.issubdtype(after.dtype, np.inexact):
+        same |= np.isnan(before) & np.isnan(after)
+    rows, cols = np.nonzero(~same)
+    if len(rows) == 0:
+        return(None)
+    return((rows.min(), rows.max()+1, cols.min(), cols.max()+1))
+
 def unsharp_mask(image, kernel_size=(5, 5), sigma=1.0, amount=1.0, threshold=0):
     """Return a sharpened version of the image, using an unsharp mask."""
     # From https://codingdeekshi.com/python-3-opencv-script-to-smoothen-or-sharpen-input-image-using-numpy-library/
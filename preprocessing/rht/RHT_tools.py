@@ -2,6 +2,7 @@ from __future__ import division, print_function
 from astropy.io import fits
 import numpy as np
 import math
+from preprocessing.rht.rht import EncodedThetas
 
 def get_thets(wlen, save = True, returnbins = False, verbose = False):
     """
@@ -32,6 +33,10 @@ def get_thets(wlen, save = True, returnbins = False, verbose = False):
 def get_RHT_data(xyt_filename = "filename.fits"):
     """
     Loads in RHT data from file.
+
+    Compactly encoded spectra (uint8, uint16 or top-k, see rht.putXYT)
+    are returned as an EncodedThetas, which decodes rows only when they
+    are indexed.
     """
         
     hdu_list = fits.open(xyt_filename, mode='readonly', memmap=True, save_backup=False, checksum=True) #Allows for reading in very large files!
@@ -40,7 +45,11 @@ def get_RHT_data(xyt_filename = "filename.fits"):
     data = hdu_list[1].data
     ipoints = data['hi'] 
     jpoints = data['hj'] 
-    hthets = data['hthets']
+    if 'ENCODING' in header:
+        hthets = EncodedThetas(header['ENCODING'], header['NTHETA'], **{
+                name[1:]: data[name] for name in data.names if name in ('hvalues', 'hscale', 'hindex', 'hpower')})
+    else:
+        hthets = data['hthets']
     
     naxis1 = header["NAXIS1"]
     naxis2 = header["NAXIS2"]
@@ -58,20 +67,8 @@ def grid_QU_RHT(xyt_filename = "filename.fits", output_fn = "output_filename", s
     # Values of theta for RHT output
     thets = get_thets(wlen, save = False)
     
-    URHT = np.zeros((naxis2, naxis1), np.float_)
-    QRHT = np.zeros((naxis2, naxis1), np.float_)
-    URHTsq = np.zeros((naxis2, naxis1), np.float_)
-    QRHTsq = np.zeros((naxis2, naxis1), np.float_)
-    intrht = np.zeros((naxis2, naxis1), np.float_)
-    
-    # Create dictionary of (i, j) points and their corresponding hthets array
-    jipoints = zip(jpoints, ipoints)
-    jih = dict(zip(jipoints, hthets))
-    
-    # Calculate Q and U from the RHT output for each point in the image
-    for s in jih.keys():
-        QRHT[s], URHT[s], QRHTsq[s], URHTsq[s] = get_QU_RHT_unnorm(jih[s], thets, sqerror = True)
-        intrht[s] = np.sum(jih[s])
+    # Calculate Q and U from the RHT output for every point in the image at once
+    QRHT, URHT, QRHTsq, URHTsq, intrht, angle = get_QU_RHT_maps(ipoints, jpoints, hthets, naxis1, naxis2, thets)
     
     # Save data using defined output_filename
     if save == True:       
@@ -83,6 +80,48 @@ def grid_QU_RHT(xyt_filename = "filename.fits", output_fn = "output_filename", s
         
     return QRHT, URHT, URHTsq, QRHTsq, intrht
         
+def get_QU_RHT_maps(ipoints, jpoints, hthets, naxis1, naxis2, thets, chunk = 65536):
+    """
+    Return QRHT, URHT, QRHTsq, URHTsq, intrht and angle maps of shape (naxis2, naxis1)
+    from all (N, ntheta) hthets at once.
+
+    Each chunk of rows is multiplied by one (ntheta, 5) matrix of cos(2 theta), 
+    sin(2 theta), their squares and ones, and the results are scattered into the maps. 
+    Only chunk rows are read at a time, so memmapped or encoded hthets are never
+    loaded whole. Values match get_QU_RHT_unnorm; points with no power are NaN, and
+    angle is <theta>_RHT (Clark, Peek, & Putman Eq. 7 and 8), NaN off the points.
+    """
+
+    basis = np.stack([np.cos(2*thets), np.sin(2*thets), np.cos(2*thets)**2, 
+                      np.sin(2*thets)**2, np.ones_like(thets)], axis=1)
+    
+    QRHT = np.zeros((naxis2, naxis1), np.float64)
+    URHT = np.zeros((naxis2, naxis1), np.float64)
+    QRHTsq = np.zeros((naxis2, naxis1), np.float64)
+    URHTsq = np.zeros((naxis2, naxis1), np.float64)
+    intrht = np.zeros((naxis2, naxis1), np.float64)
+    angle = np.full((naxis2, naxis1), np.nan)
+    
+    for start in range(0, len(ipoints), chunk):
+        stop = start + chunk
+        jj = np.asarray(jpoints[start:stop], dtype=np.intp)
+        ii = np.asarray(ipoints[start:stop], dtype=np.intp)
+        sums = np.asarray(hthets[start:stop], dtype=np.float64) @ basis
+        
+        # NaN anything which is bad data
+        sums[sums[:, 4] <= 0, :4] = np.nan
+        
+        QRHT[jj, ii] = sums[:, 0]
+        URHT[jj, ii] = sums[:, 1]
+        QRHTsq[jj, ii] = sums[:, 2]
+        URHTsq[jj, ii] = sums[:, 3]
+        intrht[jj, ii] = sums[:, 4]
+        
+        rough_angle = 0.5*np.arctan2(sums[:, 1], sums[:, 0])
+        angle[jj, ii] = np.pi - np.fmod(rough_angle + np.pi, np.pi)
+    
+    return QRHT, URHT, QRHTsq, URHTsq, intrht, angle
+
 def get_QU_RHT_unnorm(hthets, thets, sqerror = True):
     """ 
     Return QHRT, URHT from single hthets
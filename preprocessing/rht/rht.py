@@ -23,6 +23,7 @@ from argparse import ArgumentParser
 from argparse import ArgumentDefaultsHelpFormatter
 
 import scipy.ndimage
+import scipy.fft
 import math
 import os
 import sys
@@ -31,6 +32,13 @@ import tempfile
 import shutil
 import time 
 import fnmatch
+from functools import reduce
+import hashlib
+import json
+from collections import namedtuple, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -51,6 +59,11 @@ SMR = 15
 # Compute the standard RHT (False sets the dRHT)
 ORIGINAL = True 
 
+# BEGIN MOD
+# Hough evaluation engine: 'loop' (one window at a time), or 'convolve', 'sparse' and 'bitpack' (many windows at once)
+ENGINE = 'loop'
+# END MOD
+
 #-----------------------------------------------------------------------------------------
 # Initialization 2 of 3: Runtime Variable
 #-----------------------------------------------------------------------------------------
@@ -82,6 +95,11 @@ TEXTWIDTH = 70
 # Displays a progress bar, at a minor cost to speed.
 PROGRESS = True 
 
+# BEGIN MOD
+# Minimum number of seconds between two progress bar redraws or callbacks of one run.
+PROGRESS_INTERVAL = 0.25
+# END MOD
+
 # Displays information that would be helpful to developers and advanced users.
 DEBUG = True 
 
@@ -95,15 +113,66 @@ DTYPE = np.float32
 # Maximum number of bytes allowed for a single buffer file. There can be multiple buffer files.
 FILECAP = int(5e8)
 
+# BEGIN MOD
+# Maximum number of bytes used by one band of rows in the 'convolve', 'sparse' and 'bitpack' engines.
+BANDCAP = int(5e8)
+
+# Maximum number of bytes of one band of packed rows in the 'bitpack' engine, which is
+# fastest when a band stays in cache.
+BITCAP = 1 << 18
+
+# Number of worker processes for the tiled RHT. 1 runs serially in this process.
+WORKERS = 1
+
+# Side length in pixels of one tile in the tiled RHT (excluding its wlen//2 halo).
+TILE = 256
+
+# Reconstruction of the backprojection between the grid points of a strided RHT,
+# 'nearest' or 'linear'
+FILL = 'nearest'
+
+# Directory of precomputed xyt kernels, shared by repeated runs and worker processes.
+# Set to None to keep kernels in memory only.
+KERNEL_CACHE = os.path.join(tempfile.gettempdir(), 'rht_kernels')
+
+# Version of the on-disk kernel format. Bump whenever all_thetas changes its output.
+KERNEL_VERSION = 1
+
+# Number of xyt kernels kept in memory by cached_thetas.
+KERNEL_LRU = 8
+
+# Directory of the content-addressed store of rht() results, replacing the _xyt??.fits
+# search of the original xyt_name_factory. None disables the store; set it to a directory,
+# such as os.path.join(tempfile.gettempdir(), 'rht_store'), to reuse results across runs.
+STORE = None
+
+# Version of the store layout. Bump whenever the results of rht() change.
+STORE_VERSION = 2
+
+# Maximum size of STORE in bytes; the least recently used results are removed beyond it.
+STORE_BYTES = int(2e9)
+
+# Directory, beside the files of a batch, that batch() stores results in when STORE is None
+BATCH_STORE = 'rht_store'
+
+# Compact representation of Hthets: None keeps full float spectra, 'uint8' and 'uint16'
+# quantize each spectrum against its own maximum, 'topk' keeps the TOPK strongest angles.
+ENCODING = None
+
+# Number of (angle index, power) pairs kept per pixel by the 'topk' encoding.
+TOPK = 8
+
+# Smallest frac that raw_frac() may be asked for by default, the default FRAC. rht_raw()
+# keeps only the windows that could pass it; at 0.5 and below nearly every window passes.
+RAW_MIN_FRAC = FRAC
+# END MOD
+
 
 # Excluded Data Types
 BAD_0 = False
 BAD_INF = True
 BAD_Neg = False 
 
-# Timers #______________Should be put into a timer object
-start_time = None
-stop_time = None
 
 #-----------------------------------------------------------------------------------------
 # Utility Functions
@@ -123,65 +192,134 @@ def announcement(strings):
 def announce(strings):
     print(announcement(strings))
 
-def update_progress(progress, message='Progress:', final_message='Finished:'):
-    # Create progress meter that looks like: 
-    # message + ' ' + '[' + '#'*p + ' '*(length-p) + ']' + time_message
-    if not PROGRESS:
-        # Allows time-sensitive jobs to be completed without timing overhead
-        return 
-
-    if not 0.0 <= progress <= 1.0:
-        # Fast fail for values outside the allowed range
-        raise ValueError('Progress value outside allowed value in update_progress') 
-
-    #TODO_________________Slow Global Implementation
-    global start_time
-    global stop_time 
-
-    # First call
-    if 0.0 == progress:
-        start_time = time.time()
-        stop_time = None
-        return
-
-    # Second call
-    elif stop_time is None:
-        stop_time = start_time + (time.time() - start_time)/progress
-
-    # Randomly callable re-calibration
-    elif np.random.rand() > 0.98: 
-        stop_time = start_time + (time.time() - start_time)/progress
-
-    # Normal Call with Progress
-    sec_remaining = int(stop_time - time.time())
-    if sec_remaining >= 60:
-        time_message = ' < ' + str(sec_remaining//60  +1) + 'min'
-    else:
-        time_message = ' < ' + str(sec_remaining +1) + 'sec'
-
-    length = int(0.55 * TEXTWIDTH)
-    messlen = TEXTWIDTH-(length+3)-len(time_message)
-    message = str.ljust(message, messlen)[:messlen]
-
-    p = int(length*progress/1.0) 
-    sys.stdout.write('\r{2} [{0}{1}]{3}'.format('#'*p, ' '*(length-p), message, time_message))
-    sys.stdout.flush()
-
-    # Final call
-    if p == length:
-        total = int(time.time()-start_time)
-        if total > 60:
-            time_message = ' ' + str(total//60) + 'min'
+# BEGIN MOD
+class Progress(object):
+    # Progress meter and counters of one RHT run, replacing the module-level timers of
+    # update_progress so that concurrent runs do not share state.
+    #
+    # update() only does integer arithmetic until the next checkpoint (about every
+    # 1/1000th of the run), so it can be called once per window. Only there is the
+    # clock read, and at most every interval seconds the bar is drawn and every
+    # callback is called as callback(progress). The last update always reports.
+    #
+    # Counters, summed over the run:
+    #   pixels: windows evaluated
+    #   significant: windows with at least one theta above frac
+    #   spilled: bytes of Hthets written to BUFFER files
+    def __init__(self, message='Progress:', final_message='Finished:', display=None, 
+            callbacks=(), interval=PROGRESS_INTERVAL):
+        self.message = message
+        self.final_message = final_message
+        self.display = display
+        self.callbacks = list(callbacks)
+        self.interval = interval
+        self.pixels = 0
+        self.significant = 0
+        self.spilled = 0
+        self.start(0)
+
+    def subscribe(self, callback):
+        # Adds a callback, called as callback(progress) at most every interval seconds
+        self.callbacks.append(callback)
+
+    def start(self, total, message=None, final_message=None):
+        # Resets the meter for a step of total units of work. Counters keep accumulating.
+        if message is not None:
+            self.message = message
+            self.final_message = message if final_message is None else final_message
+        self.total = int(total)
+        self.done = 0
+        self.finished = False
+        self.start_time = time.time()
+        self.last_time = self.start_time
+        self.step = max(1, self.total//1000)
+        # Checkpoints fall on multiples of step and on the last unit of work
+        self.checkpoint = min(self.step, self.total)
+
+    def update(self, done=None, pixels=0, significant=0, spilled=0):
+        # Records work since the last call. done is the absolute number of units finished,
+        # and defaults to counting the windows in pixels.
+        self.pixels += pixels
+        self.significant += significant
+        self.spilled += spilled
+        if done is None:
+            self.done += pixels
         else:
-            time_message = ' ' + str(total) + 'sec'
-        
-        final_offset = TEXTWIDTH-len(time_message)
-        final_message = str.ljust(final_message, final_offset)[:final_offset]
-        sys.stdout.write('\r{0}{1}'.format(final_message, time_message))
-        sys.stdout.flush()
-        start_time = None
-        stop_time = None
-        print('')
+            self.done = done
+        if self.done < self.checkpoint:
+            return
+        self.checkpoint = min(self.done + self.step, self.total)
+        if self.done >= self.total:
+            self.finish()
+            return
+        now = time.time()
+        if now - self.last_time >= self.interval:
+            self.last_time = now
+            self.report(now)
+
+    @property
+    def fraction(self):
+        if self.total == 0:
+            return 1.0
+        return min(1.0, self.done/float(self.total))
+
+    @property
+    def elapsed(self):
+        return time.time() - self.start_time
+
+    def remaining(self, now=None):
+        # Estimated seconds left in this step, or None before any progress
+        if self.done == 0:
+            return None
+        now = time.time() if now is None else now
+        return (now - self.start_time)*(self.total - self.done)/float(self.done)
+
+    def stats(self):
+        # Snapshot of the run for logging, e.g. in batch summaries
+        return {'message': self.message, 'done': self.done, 'total': self.total, 
+                'elapsed': self.elapsed, 'pixels': self.pixels, 
+                'significant': self.significant, 'spilled': self.spilled}
+
+    def report(self, now=None):
+        # Draws the progress bar (if displayed) and calls every callback
+        display = PROGRESS if self.display is None else self.display
+        if display:
+            # Create progress meter that looks like: 
+            # message + ' ' + '[' + '#'*p + ' '*(length-p) + ']' + time_message
+            if self.finished:
+                total = int(time.time()-self.start_time)
+                if total > 60:
+                    time_message = ' ' + str(total//60) + 'min'
+                else:
+                    time_message = ' ' + str(total) + 'sec'
+                final_offset = TEXTWIDTH-len(time_message)
+                final_message = str.ljust(self.final_message, final_offset)[:final_offset]
+                sys.stdout.write('\r{0}{1}\n'.format(final_message, time_message))
+            else:
+                sec_remaining = int(self.remaining(now) or 0)
+                if sec_remaining >= 60:
+                    time_message = ' < ' + str(sec_remaining//60  +1) + 'min'
+                else:
+                    time_message = ' < ' + str(sec_remaining +1) + 'sec'
+
+                length = int(0.55 * TEXTWIDTH)
+                messlen = TEXTWIDTH-(length+3)-len(time_message)
+                message = str.ljust(self.message, messlen)[:messlen]
+
+                p = int(length*self.fraction) 
+                sys.stdout.write('\r{2} [{0}{1}]{3}'.format('#'*p, ' '*(length-p), message, time_message))
+            sys.stdout.flush()
+        for callback in self.callbacks:
+            callback(self)
+
+    def finish(self):
+        # Final report of this step; later calls do nothing
+        if self.finished:
+            return
+        self.done = max(self.done, self.total)
+        self.finished = True
+        self.report()
+# END MOD
 
 #-----------------------------------------------------------------------------------------
 # Naming Conventions and Converisons
@@ -191,58 +329,147 @@ def filename_from_path(filepath):
     # Maintains all characters in path except for those after and including the last period
     return os.path.basename('.'.join( filepath.split('.')[ 0:filepath.count('.') ] ) ) 
 
-def xyt_name_factory(filepath, wlen, smr, frac, original):
-    # Returns the filename that _xyt output should have.
-    # Will have the general behavior: filename_xyt00.format
-
-    # filepath ~ dirname/name.fits
-    # filename ~ dirname/name
-    # fnmatch_string ~ name + xyt_suffix + ?? + xyt_format
-
-    # Remove RHT-specific endings
-    filename = filename_from_path(filepath)
-    
-    if OUTPUT == '.':
-        dirname = os.path.dirname(os.path.abspath(filepath))
-    else:
-        dirname = OUTPUT
-    
-    fnmatch_string = filename + xyt_suffix + '?'*DIGITS + xyt_format 
-    xyt_files = fnmatch.filter(os.listdir(dirname), fnmatch_string) 
-    xyt_array = [None]*(10**DIGITS) 
-
-    # Try to find a parameter match among existing files
-    left = str.find(fnmatch_string, '?')
-    for x in xyt_files:
-        abs_x = os.path.join(dirname, x)
-
-        if getXYT(abs_x, match_only={'WLEN':wlen, 'SMR':smr, 'FRAC':frac, 'ORIGINAL':original} ): #TODO ______________________________________#print 'Found _xyt file matching your input parameters!'
-
-            return os.path.normpath(abs_x)
+# BEGIN MOD
+# Names of the payload arrays of one stored result, in rht() order
+STORE_FIELDS = ('hi', 'hj', 'hthets', 'backproj')
+
+def store_key(data, wlen, smr, frac, original, backproj_only=False, encoding=None, bins=None,
+        stride=1, fill=FILL):
+    # Returns the store key of rht() on data, a hash of the array contents and
+    # every parameter that changes the output. The engine, workers and tile 
+    # settings are left out, since they all give identical results.
+    data = np.ascontiguousarray(data)
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(json.dumps([STORE_VERSION, data.dtype.str, data.shape, int(wlen), 
+            int(smr), repr(float(frac)), bool(original), bool(backproj_only), 
+            encoding, TOPK if encoding == 'topk' else None]).encode())
+    digest.update(data.view(np.uint8).reshape(-1))
+    if bins is not None:
+        # Theta-restricted runs, keyed by the selected bins
+        bins = np.ascontiguousarray(bins, dtype=np.int64)
+        digest.update(json.dumps(bins.shape).encode())
+        digest.update(bins.view(np.uint8).reshape(-1))
+    if stride > 1:
+        # Strided previews
+        digest.update(json.dumps([int(stride), fill]).encode())
+    return digest.hexdigest()
+
+def store_entry(key):
+    # Returns the path of the index file of key, holding its parameters and payload names.
+    # Each key has its own index file, so writers in different processes never conflict.
+    return os.path.join(STORE, key + '.json')
+
+def store_get(key):
+    # Returns the stored rht() results for key, memory-mapped copy-on-write so that
+    # large frames load instantly, or None if key is not in the store
+    if STORE is None:
+        return None
+    try:
+        with open(store_entry(key), 'r') as f:
+            entry = json.load(f)
+        # Marks the result as recently used for store_evict
+        os.utime(store_entry(key))
+    except (OSError, ValueError):
+        return None
+    results = []
+    for field in STORE_FIELDS:
+        files = entry['files'][field]
+        if files is None:
+            results.append(None)
+            continue
+        try:
+            if isinstance(files, dict):
+                # Encoded Hthets, one payload per array of EncodedThetas
+                results.append(EncodedThetas(entry['encoding'], entry['ntheta'], **{
+                        name: np.load(os.path.join(STORE, f), mmap_mode='c') 
+                        for name, f in files.items()}))
+            else:
+                results.append(np.load(os.path.join(STORE, files), mmap_mode='c'))
+        except (OSError, ValueError):
+            # Payload removed or truncated; recompute
+            return None
+    return results
+
+def store_payload(name, array):
+    # Atomically writes one payload array to STORE and returns its file name.
+    # Temporary files start with a dot, so store_evict leaves them alone.
+    fd, temp_name = tempfile.mkstemp(prefix='.', suffix='.npy', dir=STORE)
+    with os.fdopen(fd, 'wb') as f:
+        np.save(f, np.asarray(array))
+    os.replace(temp_name, os.path.join(STORE, name + '.npy'))
+    return name + '.npy'
+
+def store_put(key, results, filepath, wlen, smr, frac, original, backproj_only=False):
+    # Writes rht() results to the store under key, then removes the least recently
+    # used results beyond STORE_BYTES. The payloads are written before the index
+    # file of key, each under a unique name renamed into place, so readers in other
+    # processes never see partial results.
+    if STORE is None:
+        return
+    try:
+        if not os.path.isdir(STORE):
+            os.makedirs(STORE)
+        files = {}
+        encoding = None
+        for field, array in zip(STORE_FIELDS, results):
+            if array is None:
+                files[field] = None
+            elif isinstance(array, EncodedThetas):
+                encoding = array.encoding
+                files[field] = {name: store_payload(key + '_' + field + '_' + name, a) 
+                        for name, a in array.arrays.items()}
+            else:
+                files[field] = store_payload(key + '_' + field, array)
+
+        entry = {'source': filepath, 'wlen': int(wlen), 'smr': int(smr), 
+                'frac': float(frac), 'original': bool(original), 
+                'backproj_only': bool(backproj_only), 'files': files}
+        if encoding is not None:
+            entry['encoding'] = encoding
+            entry['ntheta'] = results[2].ntheta
+        fd, temp_name = tempfile.mkstemp(prefix='.', suffix='.json', dir=STORE)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f, indent=1)
+        os.replace(temp_name, store_entry(key))
+        store_evict()
+    except OSError:
+        print('Unable to write RHT result store in', STORE)
+
+def store_evict(limit=None):
+    # Removes whole stored results, least recently used first, until STORE holds at most
+    # limit (default STORE_BYTES) bytes. A result was last used when its index file was
+    # last written or read; payloads left without an index file count from their own time.
+    limit = STORE_BYTES if limit is None else limit
+    keys = {}
+    for name in os.listdir(STORE):
+        if name.startswith('.'):
+            continue
+        try:
+            stat = os.stat(os.path.join(STORE, name))
+        except OSError:
+            # Removed by another process
+            continue
+        key = keys.setdefault(os.path.splitext(name)[0].split('_')[0], 
+                {'entry': None, 'payloads': 0, 'size': 0, 'names': []})
+        if name.endswith('.json'):
+            key['entry'] = stat.st_mtime_ns
         else:
-            xyt_array[int( x[left:(left+DIGITS)] )] = x
-    
-    # Try to find the lowest-numbered name that is unoccupied
-    for i, y in enumerate(xyt_array):
-        if y is None:
-            # Print 'Found _xyt available for these parameters!'
-            int_string = str.zfill(str(i), DIGITS)[:DIGITS] 
-            xyt_filename = filename+ xyt_suffix+ int_string+ xyt_format
-            return os.path.normpath(os.path.join(dirname, xyt_filename))
-    
-    # Failure: No match and no available output slots
-    xyt_filename = str.replace(fnmatch_string, '?', '0')
-    print('In xyt_filename(): No existing ouput matches the input parameters and no namespace is available')
-    print('Overwrite ' + xyt_filename + '?..') 
-    choice = input(' [y]/n/'+'0'*(DIGITS-1)+'x')
-    if len(choice) == 0 or choice == 'y':
-        return os.path.normpath(os.path.join(dirname, xyt_filename))
-    elif choice != 'n':
-        int_string = str.zfill(str(int(choice)), DIGITS)[:DIGITS] 
-        xyt_filename = filename+ xyt_suffix+ int_string+ xyt_format
-        return os.path.normpath(os.path.join(dirname, xyt_filename)) 
-    else:
-        raise RuntimeError('In xyt_filename(): No existing ouput matches the input parameters and no namespace is available')
+            key['payloads'] = max(key['payloads'], stat.st_mtime_ns)
+        key['size'] += stat.st_size
+        key['names'].append(name)
+    total = sum(key['size'] for key in keys.values())
+    used = lambda key: key['entry'] if key['entry'] is not None else key['payloads']
+    for key in sorted(keys.values(), key=used):
+        if total <= limit:
+            break
+        # The index file goes first, so the result is never found half removed
+        for name in sorted(key['names'], key=lambda n: not n.endswith('.json')):
+            try:
+                os.remove(os.path.join(STORE, name))
+            except OSError:
+                pass
+        total -= key['size']
+# END MOD
 
 #-----------------------------------------------------------------------------------------
 # Image Processing Functions
@@ -271,8 +498,98 @@ def ntheta_w(w=WLEN):
     # Linearly proportional to wlen
     return int(math.ceil( np.pi*(w-1)/np.sqrt(2.0) ))  
 
+# BEGIN MOD
+class EncodedThetas(object):
+    # Read-only stand-in for an (n, ntheta) Hthets array stored in a compact encoding.
+    # Rows are only decoded to float32 when indexed, so large outputs can be read
+    # (or memory-mapped) and inspected a few pixels at a time.
+    #   'uint8', 'uint16': values (n, ntheta) quantized so that values*scale ~ hthets
+    #   'topk': index (n, k) angle bins and power (n, k) of the k strongest angles, or of
+    #           the bins selected by theta_bins in a theta-restricted RHT
+    def __init__(self, encoding, ntheta, **arrays):
+        if encoding not in ('uint8', 'uint16', 'topk'):
+            raise ValueError('Supported encodings include: uint8, uint16 and topk only')
+        self.encoding = encoding
+        self.ntheta = int(ntheta)
+        self.arrays = arrays
+        if encoding == 'topk':
+            self.dtype = np.result_type(np.float32, arrays['power'].dtype)
+        else:
+            self.dtype = np.dtype(np.float32)
+
+    @property
+    def shape(self):
+        return (len(self), self.ntheta)
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in self.arrays.values())
+
+    def __len__(self):
+        return len(next(iter(self.arrays.values())))
+
+    def decode(self, rows=slice(None)):
+        # Returns the float32 spectra of the given rows
+        if self.encoding == 'topk':
+            index = np.asarray(self.arrays['index'][rows])
+            power = np.asarray(self.arrays['power'][rows])
+            out = np.zeros(index.shape[:-1] + (self.ntheta,), dtype=self.dtype)
+            np.put_along_axis(out, index.astype(np.intp), power, axis=-1)
+            return out
+        values = np.asarray(self.arrays['values'][rows], dtype=np.float32)
+        scale = np.asarray(self.arrays['scale'][rows], dtype=np.float32)
+        return values*scale[..., None]
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            return self.decode(key[0])[(Ellipsis,) + key[1:]]
+        return self.decode(key)
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self.decode(row)
+
+    def __array__(self, dtype=None, copy=None):
+        out = self.decode()
+        if dtype is not None:
+            out = out.astype(dtype)
+        return out
+
+    @staticmethod
+    def concatenate(parts):
+        # Joins encoded blocks of rows that share an encoding
+        first = parts[0]
+        return EncodedThetas(first.encoding, first.ntheta, **{name: 
+                np.concatenate([p.arrays[name] for p in parts]) for name in first.arrays})
+
+def encode_thetas(hthets, encoding=ENCODING, topk=TOPK):
+    # Returns hthets in the given compact encoding. Quantization scales each spectrum by
+    # its own maximum, so the largest angle of every pixel is always exact.
+    if encoding is None or isinstance(hthets, EncodedThetas):
+        return hthets
+    hthets = np.asarray(hthets, dtype=np.float32)
+    ntheta = hthets.shape[1]
+    if encoding == 'topk':
+        k = min(int(topk), ntheta)
+        index = np.argpartition(hthets, ntheta-k, axis=1)[:, ntheta-k:]
+        power = np.take_along_axis(hthets, index, axis=1)
+        return EncodedThetas('topk', ntheta, index=index.astype(np.uint16), power=power)
+    if encoding not in ('uint8', 'uint16'):
+        raise ValueError('Supported encodings include: uint8, uint16 and topk only')
+    levels = np.iinfo(encoding).max
+    scale = np.amax(hthets, axis=1)/levels
+    safe = np.where(scale > 0, scale, 1.0)
+    values = np.rint(hthets/safe[:, None]).astype(encoding)
+    return EncodedThetas(encoding, ntheta, values=values, scale=scale.astype(np.float32))
+# END MOD
+
 # Saves the data into the given xyt_filename, depending upon filetype. Supports .fits and .npz currently
-def putXYT(filepath, xyt_filename, hi, hj, hthets, wlen, smr, frac, original, backproj=None, compressed=True):
+def putXYT(filepath, xyt_filename, hi, hj, hthets, wlen, smr, frac, original, backproj=None, compressed=True, encoding=None):
+
+    # BEGIN MOD
+    # Compact Hthets are written as their encoded arrays; see EncodedThetas
+    hthets = encode_thetas(hthets, encoding=encoding)
+    # END MOD
 
     if xyt_filename.endswith('.npz'):
         # IMPLEMENTATION1: Zipped Numpy arrays of Data #TODO _______________________________________ALWAYS BE CAREFUL WITH HEADER VARS
@@ -281,10 +598,17 @@ def putXYT(filepath, xyt_filename, hi, hj, hthets, wlen, smr, frac, original, ba
             save = np.savez_compressed  
         else:
             save = np.savez
+        # BEGIN MOD
+        if isinstance(hthets, EncodedThetas):
+            columns = {'h'+name: array for name, array in hthets.arrays.items()}
+            columns['encoding'] = hthets.encoding
+        else:
+            columns = {'hthets': hthets}
         if backproj is None:
-            save(xyt_filename, hi=hi, hj=hj, hthets=hthets, wlen=wlen, smr=smr, frac=frac, original=original, ntheta=hthets.shape[1])
+            save(xyt_filename, hi=hi, hj=hj, wlen=wlen, smr=smr, frac=frac, original=original, ntheta=hthets.shape[1], **columns)
         else:
-            save(xyt_filename, hi=hi, hj=hj, hthets=hthets, wlen=wlen, smr=smr, frac=frac, original=original, ntheta=hthets.shape[1], backproj=backproj)
+            save(xyt_filename, hi=hi, hj=hj, wlen=wlen, smr=smr, frac=frac, original=original, ntheta=hthets.shape[1], backproj=backproj, **columns)
+        # END MOD
 
 
 
@@ -293,8 +617,21 @@ def putXYT(filepath, xyt_filename, hi, hj, hthets, wlen, smr, frac, original, ba
         Hi = fits.Column(name='hi', format='1I', array=hi)
         Hj = fits.Column(name='hj', format='1I', array=hj)
         ntheta = hthets.shape[1]
-        Hthets = fits.Column(name='hthets', format=str(int(ntheta))+'E', array=hthets)
-        cols = fits.ColDefs([Hi, Hj, Hthets])
+        # BEGIN MOD
+        if not isinstance(hthets, EncodedThetas):
+            Hthets = [fits.Column(name='hthets', format=str(int(ntheta))+'E', array=hthets)]
+        elif hthets.encoding == 'topk':
+            k = hthets.arrays['index'].shape[1]
+            Hthets = [fits.Column(name='hindex', format=str(k)+'I', bzero=32768, array=hthets.arrays['index']),
+                      fits.Column(name='hpower', format=str(k)+'E', array=hthets.arrays['power'])]
+        else:
+            if hthets.encoding == 'uint8':
+                Hvalues = fits.Column(name='hvalues', format=str(int(ntheta))+'B', array=hthets.arrays['values'])
+            else:
+                Hvalues = fits.Column(name='hvalues', format=str(int(ntheta))+'I', bzero=32768, array=hthets.arrays['values'])
+            Hthets = [Hvalues, fits.Column(name='hscale', format='1E', array=hthets.arrays['scale'])]
+        cols = fits.ColDefs([Hi, Hj] + Hthets)
+        # END MOD
         tbhdu = fits.BinTableHDU.from_columns(cols)
 
         # Header Values for RHT Parameters
@@ -306,6 +643,10 @@ def putXYT(filepath, xyt_filename, hi, hj, hthets, wlen, smr, frac, original, ba
 
         # Other Header Values
         prihdr['NTHETA'] = ntheta
+        # BEGIN MOD
+        if isinstance(hthets, EncodedThetas):
+            prihdr['ENCODING'] = hthets.encoding
+        # END MOD
         
         """
         Adding RA, DEC and other possible header values to your new header
@@ -368,7 +709,13 @@ def getXYT(xyt_filename, match_only=False):
                     return False
             Hi = data['hi']
             Hj = data['hj']
-            Hthets = data['hthets']
+            # BEGIN MOD
+            if 'encoding' in data:
+                Hthets = EncodedThetas(str(data['encoding']), int(data['ntheta']), **{
+                        name[1:]: data[name] for name in data.files if name in ('hvalues', 'hscale', 'hindex', 'hpower')})
+            else:
+                Hthets = data['hthets']
+            # END MOD
 
         elif xyt_filename.endswith('.fits'):
             hdu_list = fits.open(xyt_filename, mode='readonly', memmap=True, save_backup=False, checksum=True) #Allows for reading in very large files!
@@ -381,7 +728,13 @@ def getXYT(xyt_filename, match_only=False):
             data = hdu_list[1].data
             Hi = data['hi'] 
             Hj = data['hj'] 
-            Hthets = data['hthets']
+            # BEGIN MOD
+            if 'ENCODING' in header:
+                Hthets = EncodedThetas(header['ENCODING'], header['NTHETA'], **{
+                        name[1:]: data[name] for name in data.names if name in ('hvalues', 'hscale', 'hindex', 'hpower')})
+            else:
+                Hthets = data['hthets']
+            # END MOD
 
         else:
             raise ValueError('Supported input types in getXYT include .npz and .fits only')
@@ -413,7 +766,9 @@ def bad_pixels(data):
     # Returns an array of the same shape as data
     # NaN values MUST ALWAYS be considered bad.
     # Bad values become 1, all else become 0
-    data = np.array(data, np.float) #TODO________________________Double Check This?
+    # BEGIN MOD
+    data = np.asarray(data, dtype=float) #TODO________________________Double Check This?
+    # END MOD
     
     # IMPLEMENTATION1: Do Comparisons which are VERY different depending on boolean choices .
     try:
@@ -454,35 +809,64 @@ def bad_pixels(data):
     except:
         # IMPLEMENTATION3: Give up?
         print('Unable to properly mask data in bad_pixels()...')
-        return data.astype(np.bool)
+        # BEGIN MOD
+        return data.astype(bool)
+        # END MOD
+
+# BEGIN MOD
+def dilate_circle(mask, diameter):
+    # Binary dilation of a boolean mask by circ_kern(diameter), without looping over pixels.
+    # The circle is a stack of horizontal runs, one per row offset dy, of half-width
+    # isqrt(r**2 - dy**2). Each distinct run is built from two overlapping runs of a 
+    # power-of-two length, which are made by repeated doubling, and then ORed into every
+    # row offset that uses it. This costs O(diameter) whole-image boolean operations.
+    assert diameter%2
+    r = diameter//2
+    datay, datax = mask.shape
+    halfwidths = [math.isqrt(r*r - dy*dy) for dy in range(-r, r+1)]
+
+    # run[:, x] is True when any of mask[:, x-r : x-r+length] is True
+    run = np.zeros((datay, datax + 2*r), dtype=bool)
+    run[:, r:r+datax] = mask
+    length = 1
+
+    out = np.zeros((datay + 2*r, datax), dtype=bool)
+    for w in sorted(set(halfwidths)):
+        # Double the run until it covers at least half of the 2*w+1 pixels
+        while 2*length <= 2*w+1:
+            run[:, :-length] |= run[:, length:]
+            length *= 2
+        # Two runs of that length, aligned to each end of [x-w, x+w]
+        spread = run[:, r-w:r-w+datax] | run[:, r+w+1-length:r+w+1-length+datax]
+        for dy, width in zip(range(-r, r+1), halfwidths):
+            if width == w:
+                out[r-dy:r-dy+datay] |= spread
+    return out[r:r+datay]
+# END MOD
 
 def all_within_diameter_are_good(data, diameter):
     assert diameter%2
-    r = int(np.int(diameter/2))
+    # BEGIN MOD
+    r = diameter//2
+    # END MOD
 
     # Base case, 'assume all pixels are bad'
-    mask = np.zeros_like(data)
+    # BEGIN MOD
+    mask = np.zeros(data.shape, dtype=bool)
+    # END MOD
 
     # Edge case, 'any pixel not within r of the edge might be ok'
     datay, datax = data.shape
     mask[r:datay-r, r:datax-r] = 1
 
     # Identifiably bad case, 'all pixels within r of me are not bad'
-    circle = circ_kern(diameter)
-    y_arr, x_arr = np.nonzero(circle)
-    y_arr = y_arr - r
-    x_arr = x_arr - r
-
-    # IMPLEMENTATION1: Zero any mask pixel within r of a bad pixel
-    update_progress(0.0)
-    coords = list(zip(*np.nonzero(bad_pixels(data))))
-    N = len(coords)
-    for c in range(N):    
-        j,i = coords[c]
-        x = (x_arr + i).astype(np.int).clip(0, datax-1)
-        y = (y_arr + j).astype(np.int).clip(0, datay-1)
-        mask[y, x] = 0 
-        update_progress((c+1)/float(N), message='Masking:', final_message='Finished Masking:') 
+    # BEGIN MOD
+    # IMPLEMENTATION1: Zero any mask pixel within r of a bad pixel, by dilating all 
+    # bad pixels at once with the circle
+    bad = bad_pixels(data)
+    if np.any(bad):
+        mask &= np.logical_not(dilate_circle(bad, diameter))
+    # END MOD
     '''
     #IMPLEMENTATION2: For each good pixel, 'Not Any Bad pixels near me'
     update_progress(0.0)
@@ -531,11 +915,34 @@ def getMask(data, smr=SMR, wlen=WLEN):
     
     # Cuts away smr radius from bads, then wlen from bads 
     smr_mask = all_within_diameter_are_good(data, 2*smr+1)
-    nans = np.empty(data.shape, dtype=np.float).fill(np.nan)
+    # BEGIN MOD
+    # Every pixel outside smr_mask counts as bad (NaN) for the wlen_mask
+    nans = np.full(data.shape, np.nan)
     wlen_mask = all_within_diameter_are_good( np.where(smr_mask, data, 
         nans), wlen)
+    # END MOD
     return smr_mask, wlen_mask
 
+# BEGIN MOD
+def getMasks(data, smr=SMR, wlens=(WLEN,)):
+    # Like getMask, for several wlen at once: the smr_mask and the bad pixels it
+    # implies are found once, and only the wlen dilation is repeated per scale.
+    # Returns smr_mask and a dict of wlen_mask by wlen, each identical to getMask's.
+    smr_mask = all_within_diameter_are_good(data, 2*smr+1)
+    bad = bad_pixels(np.where(smr_mask, data, np.full(data.shape, np.nan)))
+    datay, datax = data.shape
+    wlen_masks = {}
+    for wlen in wlens:
+        assert wlen%2
+        r = wlen//2
+        mask = np.zeros(data.shape, dtype=bool)
+        mask[r:datay-r, r:datax-r] = 1
+        if np.any(bad):
+            mask &= np.logical_not(dilate_circle(bad, wlen))
+        wlen_masks[wlen] = mask
+    return smr_mask, wlen_masks
+# END MOD
+
 # Performs a circle-cut of given diameter on inkernel.
 # Outkernel is 0 anywhere outside the window.   
 def circ_kern(diameter):
@@ -543,7 +950,7 @@ def circ_kern(diameter):
     r = diameter//2 #int(np.floor(diameter/2))
     mnvals = np.indices((diameter, diameter)) - r
     rads = np.hypot(mnvals[0], mnvals[1])
-    return np.less_equal(rads, r).astype(np.int)
+    return np.less_equal(rads, r).astype(int)
 
 # Unsharp mask. Returns binary data.
 def umask(data, radius, smr_mask=None):
@@ -598,6 +1005,260 @@ def fast_hough(in_arr, xyt):
     # return np.sum(np.sum( cube , axis=0, dtype=np.int), axis=0, dtype=np.float) #WORKS FAST AND DIVIDES PROPERLY
     # return np.sum(cube, axis=(1,0), dtype=np.int)
 
+# BEGIN MOD
+def convolve_hough(in_arr, xyt, jpoints, ipoints):
+    # Evaluates fast_hough for the windows centered on every (jpoints, ipoints) at once.
+    # Each theta plane of xyt is correlated with in_arr by a batched FFT convolution,
+    # one band of rows at a time, so memory is bounded by BANDCAP.
+    # Yields (jpoints, ipoints, h) for each band, where h has shape (len(jpoints), ntheta).
+    assert in_arr.ndim == 2
+    assert xyt.ndim == 3
+    assert xyt.shape[0] == xyt.shape[1]
+
+    wlen = xyt.shape[0]
+    r = wlen//2
+    ntheta = xyt.shape[2]
+    datay, datax = in_arr.shape
+    if len(jpoints) == 0:
+        return
+
+    # Kernel spectra, product and output each need ~8 bytes per theta per padded pixel
+    jmin = int(np.min(jpoints))
+    jmax = int(np.max(jpoints))
+    cols = scipy.fft.next_fast_len(datax, real=True)
+    rows = max(2*wlen, int(BANDCAP // (24*ntheta*cols)))
+    rows = min(rows, jmax-jmin+wlen)
+    rows = scipy.fft.next_fast_len(rows, real=True)
+    band = rows - (wlen-1)
+    fshape = (rows, cols)
+
+    # Correlation is convolution with the flipped kernel, one plane per theta.
+    # A circular convolution is exact for the valid region, so no extra padding is needed.
+    kernels = np.moveaxis(xyt[::-1, ::-1, :], 2, 0).astype(np.float64)
+    kernels_ft = scipy.fft.rfft2(kernels, s=fshape, workers=-1)
+
+    for j0 in range(jmin, jmax+1, band):
+        j1 = min(j0+band, jmax+1)
+        in_band = np.logical_and(jpoints >= j0, jpoints < j1)
+        if not np.any(in_band):
+            continue
+        jj = jpoints[in_band]
+        ii = ipoints[in_band]
+
+        # Output [wlen-1+a, wlen-1+b] is the window centered on (j0+a, r+b)
+        chunk = in_arr[j0-r:j1+r, :].astype(np.float64)
+        chunk_ft = scipy.fft.rfft2(chunk, s=fshape, workers=-1)
+        out = scipy.fft.irfft2(kernels_ft*chunk_ft, s=fshape, workers=-1)
+
+        # Hough counts are integers, so rounding removes the FFT error exactly
+        h = np.rint(out[:, jj-j0+wlen-1, ii-r+wlen-1].T).astype(np.int64)
+        yield jj, ii, h
+
+# Lit pixels of each theta in CSR form: the pixels of theta k are at offsets
+# (dy, dx)[indptr[k]:indptr[k+1]] from the window center.
+SparseThetas = namedtuple('SparseThetas', ['wlen', 'indptr', 'dy', 'dx'])
+
+def sparse_thetas(xyt):
+    # Compresses the (wlen, wlen, ntheta) xyt cube into a SparseThetas kernel.
+    # Each theta only lights a line of ~wlen pixels, so this stores O(wlen*ntheta)
+    # offsets instead of O(wlen*wlen*ntheta) ints.
+    assert xyt.ndim == 3
+    assert xyt.shape[0] == xyt.shape[1]
+    assert np.all(np.logical_or(xyt == 0, xyt == 1))
+
+    wlen = xyt.shape[0]
+    r = wlen//2
+
+    # Transposing to (theta, y, x) makes np.nonzero return the pixels grouped by theta
+    theta, y, x = np.nonzero(np.moveaxis(xyt, 2, 0))
+    indptr = np.zeros(xyt.shape[2]+1, dtype=np.intp)
+    indptr[1:] = np.cumsum(np.bincount(theta, minlength=xyt.shape[2]))
+    return SparseThetas(wlen, indptr, (y-r).astype(np.intp), (x-r).astype(np.intp))
+
+def sparse_hough(in_arr, kernel):
+    # Equivalent to fast_hough(in_arr, xyt) for one wlen x wlen window,
+    # gathering only the lit pixels of each theta from a SparseThetas kernel.
+    assert in_arr.ndim == 2
+    assert in_arr.shape == (kernel.wlen, kernel.wlen)
+
+    r = kernel.wlen//2
+    lit = in_arr[kernel.dy+r, kernel.dx+r]
+    return segment_sums(lit[np.newaxis, :], kernel.indptr)[0]
+
+def segment_sums(values, indptr):
+    # Sums values[:, indptr[k]:indptr[k+1]] for every k, giving 0 for empty segments.
+    starts = indptr[:-1]
+    empty = starts == indptr[1:]
+    out = np.add.reduceat(values, np.minimum(starts, values.shape[1]-1), axis=1, dtype=np.int64)
+    out[:, empty] = 0
+    return out
+
+def lattice_step(points, start):
+    # Returns the largest step s such that every point is start plus a multiple of s,
+    # so that windows on a strided grid (see window_step) are evaluated on that grid only
+    return max(1, int(np.gcd.reduce(np.asarray(points) - start)))
+
+def sparse_hough_batch(in_arr, kernel, jpoints, ipoints):
+    # Evaluates sparse_hough for the windows centered on every (jpoints, ipoints).
+    # For each theta, the shifted copies of in_arr at its lit offsets are summed over
+    # a band of rows, which touches only the lit pixels and needs no dense xyt cube.
+    # Points on a strided grid are summed on that grid only (see lattice_step).
+    # Bands are sized so the yielded counts stay within BANDCAP.
+    # Yields (jpoints, ipoints, h) for each band, where h has shape (len(jpoints), ntheta).
+    assert in_arr.ndim == 2
+    if len(jpoints) == 0:
+        return
+
+    ntheta = len(kernel.indptr)-1
+    datax = in_arr.shape[1]
+    xmin = int(np.min(ipoints))
+    xmax = int(np.max(ipoints))
+    jmin = int(np.min(jpoints))
+    jmax = int(np.max(jpoints))
+    sy = lattice_step(jpoints, jmin)
+    sx = lattice_step(ipoints, xmin)
+    band = max(1, int(BANDCAP*sx // (8*ntheta*datax))) * sy
+
+    for j0 in range(jmin, jmax+1, band):
+        j1 = min(j0+band, jmax+1)
+        in_band = np.logical_and(jpoints >= j0, jpoints < j1)
+        if not np.any(in_band):
+            continue
+        jj = jpoints[in_band]
+        ii = ipoints[in_band]
+
+        h = np.empty((len(jj), ntheta), dtype=np.int64)
+        acc = np.empty((len(range(j0, j1, sy)), len(range(xmin, xmax+1, sx))), dtype=np.int32)
+        for k in range(ntheta):
+            acc.fill(0)
+            for p in range(kernel.indptr[k], kernel.indptr[k+1]):
+                dy = kernel.dy[p]
+                dx = kernel.dx[p]
+                acc += in_arr[j0+dy:j1+dy:sy, xmin+dx:xmax+1+dx:sx]
+            h[:, k] = acc[(jj-j0)//sy, (ii-xmin)//sx]
+        yield jj, ii, h
+
+# Number of set bits in each element of an unsigned integer array. numpy >= 2.0 has a
+# native popcount; older versions look up 16 bits at a time in a table.
+if hasattr(np, 'bitwise_count'):
+    popcount = np.bitwise_count
+else:
+    _popcount_table = np.array([bin(x).count('1') for x in range(1 << 16)], dtype=np.uint8)
+
+    def popcount(words, out=None):
+        words = np.ascontiguousarray(words, dtype=np.uint64)
+        counts = _popcount_table[words.view(np.uint16)]
+        counts = counts.reshape(words.shape + (4,)).sum(axis=-1, dtype=np.uint8)
+        if out is None:
+            return counts
+        out[...] = counts
+        return out
+
+def bit_thetas(xyt):
+    # Packs each row of each theta line-mask of xyt into uint64 words.
+    # Returns an array of shape (wlen, nwords, ntheta), where bit k of word w
+    # of row dy is set when xyt[dy, 64*w + k, theta] is lit.
+    wlen = xyt.shape[1]
+    nwords = (wlen + 63)//64
+    words = np.zeros((xyt.shape[0], nwords, xyt.shape[2]), dtype=np.uint64)
+    for k in range(wlen):
+        words[:, k//64, :] |= (xyt[:, k, :] != 0).astype(np.uint64) << np.uint64(k % 64)
+    return words
+
+def bitpack_hough(in_arr, kernel, jpoints, ipoints):
+    # Evaluates fast_hough for the windows centered on every (jpoints, ipoints) of a
+    # binary in_arr, such as the output of umask. The wlen pixels starting at each
+    # column are packed into uint64 words, so one bitwise AND with a packed row of a
+    # theta line-mask (see bit_thetas) and one popcount count every lit pixel of that
+    # row at once, for all windows of a band. Rows the line does not cross are skipped,
+    # and counts are accumulated in the smallest unsigned type that holds them.
+    # Bands are sized like sparse_hough_batch, but no larger than BITCAP, and points on
+    # a strided grid are likewise counted on that grid only.
+    # Yields (jpoints, ipoints, h) for each band, where h has shape (len(jpoints), ntheta).
+    assert in_arr.ndim == 2
+    if len(jpoints) == 0:
+        return
+
+    wlen, nwords, ntheta = kernel.shape
+    r = wlen//2
+    datax = in_arr.shape[1]
+    xmin = int(np.min(ipoints))
+    xmax = int(np.max(ipoints))
+    jmin = int(np.min(jpoints))
+    jmax = int(np.max(jpoints))
+    sy = lattice_step(jpoints, jmin)
+    sx = lattice_step(ipoints, xmin)
+    band = max(1, min(int(BANDCAP*sx // (8*ntheta*datax)), int(BITCAP*sx // (8*datax)))) * sy
+    in_arr = np.not_equal(in_arr, 0)
+
+    # Packed rows crossed by each theta's line
+    lines = [[(dy, w) for dy in range(wlen) for w in range(nwords) if kernel[dy, w, k]] 
+            for k in range(ntheta)]
+    if int(np.max(np.sum(popcount(kernel), axis=(0, 1), dtype=np.int64))) <= np.iinfo(np.uint8).max:
+        count_type = np.uint8
+    else:
+        count_type = np.uint16
+
+    for j0 in range(jmin, jmax+1, band):
+        j1 = min(j0+band, jmax+1)
+        in_band = np.logical_and(jpoints >= j0, jpoints < j1)
+        if not np.any(in_band):
+            continue
+        jj = jpoints[in_band]
+        ii = ipoints[in_band]
+
+        # words[w, y, x] holds the pixels from column xmin-r+sx*x+64*w of band row y
+        rows = in_arr[j0-r:j1+r, xmin-r:xmax+r+1]
+        ncols = xmax+1-xmin
+        words = np.zeros((nwords, rows.shape[0], len(range(0, ncols, sx))), dtype=np.uint64)
+        for k in range(wlen):
+            words[k//64] |= rows[:, k:k+ncols:sx].astype(np.uint64) << np.uint64(k % 64)
+
+        nrows = j1-j0
+        shape = (len(range(0, nrows, sy)), words.shape[2])
+        masked = np.empty(shape, dtype=np.uint64)
+        counts = np.empty(shape, dtype=np.uint8)
+        acc = np.empty(shape, dtype=count_type)
+        h = np.empty((len(jj), ntheta), dtype=np.int64)
+        for k in range(ntheta):
+            acc.fill(0)
+            for dy, w in lines[k]:
+                np.bitwise_and(words[w, dy:dy+nrows:sy], kernel[dy, w, k], out=masked)
+                popcount(masked, out=counts)
+                acc += counts
+            h[:, k] = acc[(jj-j0)//sy, (ii-xmin)//sx]
+        yield jj, ii, h
+
+def loop_hough(in_arr, xyt, jpoints, ipoints):
+    # Evaluates fast_hough one window at a time, in the same interface as the batch engines.
+    # Yields (jpoints, ipoints, h) for each run of windows sharing an image row.
+    r = xyt.shape[0]//2
+    ntheta = xyt.shape[2]
+    starts = np.flatnonzero(np.diff(jpoints)) + 1
+    for jj, ii in zip(np.split(jpoints, starts), np.split(ipoints, starts)):
+        h = np.empty((len(jj), ntheta), dtype=np.int64)
+        for c in range(len(jj)):
+            j, i = jj[c], ii[c]
+            h[c] = fast_hough(in_arr[j-r:j+r+1, i-r:i+r+1], xyt)
+        yield jj, ii, h
+
+def batch_hough(engine, in_arr, xyt, jpoints, ipoints):
+    # Dispatches to the many-windows-at-once evaluator of the given engine.
+    # xyt is the kernel of engine_thetas; 'sparse' also accepts a dense xyt cube.
+    if engine == 'loop':
+        return loop_hough(in_arr, xyt, jpoints, ipoints)
+    elif engine == 'convolve':
+        return convolve_hough(in_arr, xyt, jpoints, ipoints)
+    elif engine == 'sparse':
+        if not isinstance(xyt, SparseThetas):
+            xyt = sparse_thetas(xyt)
+        return sparse_hough_batch(in_arr, xyt, jpoints, ipoints)
+    elif engine == 'bitpack':
+        return bitpack_hough(in_arr, bit_thetas(xyt), jpoints, ipoints)
+    else:
+        raise ValueError('Supported engines include: loop, convolve, sparse and bitpack only')
+# END MOD
+
 def houghnew(image, cos_theta, sin_theta):
     assert image.ndim == 2 
     assert cos_theta.ndim == 1
@@ -657,13 +1318,17 @@ def all_thetas(wlen, theta, original):
     ntheta = len(theta)
     
     #outshape = (wlen, wlen, ntheta)
-    out = np.zeros(window.shape+(ntheta,), np.int)
-    coords = list(zip( *np.nonzero(window)))
-    for (j, i) in coords:
-        # At each x/y value, create new single-pixel data.
-        w_1 = np.zeros_like(window)
-        w_1[j,i] = 1
-        out[j, i, :] = houghnew(w_1, cos_theta, sin_theta)
+    out = np.zeros(window.shape+(ntheta,), int)
+
+    # BEGIN MOD
+    # houghnew() of a single lit pixel only reads out the center bin, which holds 1
+    # exactly when the pixel's rounded distance from the line through the window
+    # center is 0. Every pixel and theta is tested at once, with the same arithmetic.
+    wmid = wlen//2
+    y, x = np.nonzero(window)
+    distances = (x[:, np.newaxis] - wmid) * cos_theta + (y[:, np.newaxis] - wmid) * sin_theta
+    out[y, x, :] = np.equal(np.round(distances), 0.0)
+    # END MOD
 
     if not original:
         out[:,:,ntheta//2:] = out[::-1,::-1,ntheta//2:] 
@@ -673,6 +1338,200 @@ def all_thetas(wlen, theta, original):
     return out 
 
 
+# BEGIN MOD
+# In-process LRU of xyt kernels, keyed by (wlen, original, dtype)
+_kernel_lru = OrderedDict()
+
+def kernel_filename(wlen, original, dtype):
+    # Versioned name of the on-disk copy of one xyt kernel
+    kind = 'rht' if original else 'drht'
+    return os.path.join(KERNEL_CACHE, 'xyt_v{}_w{}_{}_{}.npy'.format(
+            KERNEL_VERSION, wlen, kind, np.dtype(dtype).name))
+
+def cached_thetas(wlen, original, dtype=int):
+    # Returns the read-only xyt cube that window_step would build with all_thetas.
+    # Kernels are looked up in memory first, then in KERNEL_CACHE, where they are
+    # memory-mapped so that every process on the machine shares one copy.
+    # Missing kernels are built once and written to the cache.
+    dtype = np.dtype(dtype)
+    key = (int(wlen), bool(original), dtype.str)
+    if key in _kernel_lru:
+        _kernel_lru.move_to_end(key)
+        return _kernel_lru[key]
+
+    xyt = None
+    if KERNEL_CACHE is not None:
+        filename = kernel_filename(wlen, original, dtype)
+        try:
+            xyt = np.load(filename, mmap_mode='r')
+        except (OSError, ValueError):
+            # Missing or truncated; rebuilt below
+            xyt = None
+
+    if xyt is None:
+        ntheta = ntheta_w(wlen)
+        if original:
+            theta = np.linspace(0.0, np.pi, ntheta, endpoint=False)
+        else:
+            theta = np.linspace(0.0, 2*np.pi, ntheta, endpoint=False)
+        xyt = all_thetas(wlen=wlen, theta=theta, original=original).astype(dtype)
+        xyt.setflags(write=0)
+
+        if KERNEL_CACHE is not None:
+            try:
+                if not os.path.isdir(KERNEL_CACHE):
+                    os.makedirs(KERNEL_CACHE)
+                # Write under a unique name, then rename, so readers never see a partial file
+                fd, temp_name = tempfile.mkstemp(suffix='.npy', dir=KERNEL_CACHE)
+                with os.fdopen(fd, 'wb') as f:
+                    np.save(f, xyt)
+                os.replace(temp_name, filename)
+                xyt = np.load(filename, mmap_mode='r')
+            except OSError:
+                print('Unable to write RHT kernel cache in', KERNEL_CACHE)
+
+    _kernel_lru[key] = xyt
+    while len(_kernel_lru) > KERNEL_LRU:
+        _kernel_lru.popitem(last=False)
+    return xyt
+
+def geometry_thetas(wlen, original):
+    # Builds sparse_thetas(cached_thetas(wlen, original)) straight from the line geometry
+    # of all_thetas, one theta at a time, so the dense xyt cube is never made.
+    # Pixels are tested with the same arithmetic as all_thetas, and the mirroring and
+    # zeroing of the dRHT are applied to the offsets instead of the cube.
+    ntheta = ntheta_w(wlen)
+    if original:
+        theta = np.linspace(0.0, np.pi, ntheta, endpoint=False)
+    else:
+        theta = np.linspace(0.0, 2*np.pi, ntheta, endpoint=False)
+    cos_theta = np.cos(theta)
+    sin_theta = np.sin(theta)
+
+    window = circ_kern(wlen)
+    if not original:
+        window[:,:wlen//2] = 0
+    wmid = wlen//2
+    # Row-major, as np.nonzero of the cube returns them
+    y, x = np.nonzero(window)
+
+    indptr = np.zeros(ntheta+1, dtype=np.intp)
+    dy, dx = [], []
+    for k in range(ntheta):
+        lit = np.equal(np.round((x - wmid) * cos_theta[k] + (y - wmid) * sin_theta[k]), 0.0)
+        ly, lx = y[lit], x[lit]
+        if not original:
+            if k >= ntheta//2:
+                # Point reflection through the center, which reverses the row-major order
+                ly, lx = (wlen-1-ly)[::-1], (wlen-1-lx)[::-1]
+            if k == ntheta//2:
+                keep = ly > wlen//2
+                ly, lx = ly[keep], lx[keep]
+            if k == 0:
+                keep = ly < wlen//2
+                ly, lx = ly[keep], lx[keep]
+        dy.append(ly - wmid)
+        dx.append(lx - wmid)
+        indptr[k+1] = indptr[k] + len(ly)
+    return SparseThetas(wlen, indptr, np.concatenate(dy).astype(np.intp), 
+            np.concatenate(dx).astype(np.intp))
+
+def sparse_filename(wlen, original):
+    # Versioned name of the on-disk copy of one SparseThetas kernel
+    kind = 'rht' if original else 'drht'
+    return os.path.join(KERNEL_CACHE, 'sparse_v{}_w{}_{}.npz'.format(
+            KERNEL_VERSION, wlen, kind))
+
+def cached_sparse_thetas(wlen, original):
+    # Returns the SparseThetas kernel of geometry_thetas, cached like cached_thetas:
+    # in the in-process LRU first, then in KERNEL_CACHE, else built and written there.
+    key = (int(wlen), bool(original), 'sparse')
+    if key in _kernel_lru:
+        _kernel_lru.move_to_end(key)
+        return _kernel_lru[key]
+
+    kernel = None
+    if KERNEL_CACHE is not None:
+        filename = sparse_filename(wlen, original)
+        try:
+            with np.load(filename) as f:
+                kernel = SparseThetas(int(wlen), f['indptr'], f['dy'], f['dx'])
+        except (OSError, ValueError, KeyError):
+            # Missing or truncated; rebuilt below
+            kernel = None
+
+    if kernel is None:
+        kernel = geometry_thetas(wlen, original)
+        if KERNEL_CACHE is not None:
+            try:
+                if not os.path.isdir(KERNEL_CACHE):
+                    os.makedirs(KERNEL_CACHE)
+                # Write under a unique name, then rename, so readers never see a partial file
+                fd, temp_name = tempfile.mkstemp(suffix='.npz', dir=KERNEL_CACHE)
+                with os.fdopen(fd, 'wb') as f:
+                    np.savez(f, indptr=kernel.indptr, dy=kernel.dy, dx=kernel.dx)
+                os.replace(temp_name, filename)
+            except OSError:
+                print('Unable to write RHT kernel cache in', KERNEL_CACHE)
+
+    for arr in kernel[1:]:
+        arr.setflags(write=0)
+    _kernel_lru[key] = kernel
+    while len(_kernel_lru) > KERNEL_LRU:
+        _kernel_lru.popitem(last=False)
+    return kernel
+
+def engine_thetas(engine, wlen, original):
+    # Returns the kernel batch_hough needs for engine: the SparseThetas of
+    # cached_sparse_thetas for 'sparse', and the xyt cube of cached_thetas otherwise
+    if engine == 'sparse':
+        return cached_sparse_thetas(wlen, original)
+    return cached_thetas(wlen=wlen, original=original)
+
+def kernel_ntheta(kernel):
+    # Number of theta bins of a kernel of engine_thetas
+    if isinstance(kernel, SparseThetas):
+        return len(kernel.indptr)-1
+    return kernel.shape[2]
+
+def kernel_radius(kernel):
+    # Half width wlen//2 of a kernel of engine_thetas
+    if isinstance(kernel, SparseThetas):
+        return kernel.wlen//2
+    return kernel.shape[0]//2
+
+def kernel_h1(kernel):
+    # Hough counts of a same-sized circular window of 1's, the h1 of window_step
+    if isinstance(kernel, SparseThetas):
+        return sparse_hough(circ_kern(kernel.wlen), kernel)
+    return fast_hough(circ_kern(kernel.shape[0]), kernel)
+
+def kernel_arrays(kernel):
+    # The arrays of a kernel of engine_thetas, for share_arrays
+    if isinstance(kernel, SparseThetas):
+        # The vertical line through the center spans every row, which shared_kernel
+        # relies on to recover wlen
+        assert 2*np.max(np.abs(kernel.dy))+1 == kernel.wlen
+        return {'indptr':kernel.indptr, 'dy':kernel.dy, 'dx':kernel.dx}
+    return {'xyt':kernel}
+
+def shared_kernel():
+    # Rebuilds, in a worker, the kernel shared through kernel_arrays
+    if 'xyt' in _shared:
+        return _shared['xyt'][1]
+    dy = _shared['dy'][1]
+    return SparseThetas(2*int(np.max(np.abs(dy)))+1, _shared['indptr'][1], dy, _shared['dx'][1])
+
+def select_thetas(kernel, bins):
+    # The kernel of engine_thetas restricted to the given theta bins, in that order
+    if isinstance(kernel, SparseThetas):
+        starts, stops = kernel.indptr[bins], kernel.indptr[np.asarray(bins)+1]
+        lit = np.concatenate([np.arange(a, b) for a, b in zip(starts, stops)])
+        indptr = np.concatenate([[0], np.cumsum(stops-starts)]).astype(np.intp)
+        return SparseThetas(kernel.wlen, indptr, kernel.dy[lit], kernel.dx[lit])
+    return np.ascontiguousarray(kernel[:, :, bins])
+# END MOD
+
 def theta_rht(theta_array, original, uv=False):
     # Maps an XYT cube into a 2D Array of angles- weighted by their significance.
     if original:
@@ -701,17 +1560,22 @@ def theta_rht(theta_array, original, uv=False):
         return angle, np.cos(angle), np.sin(angle)
 
 
-def buffershape(ntheta, filesize=FILECAP):
+def buffershape(ntheta, filesize=FILECAP, dtype=DTYPE):
     # Shape of maximum sized array that can fit into a single buffer file. 
+    # BEGIN MOD
+    # dtype is that of the rows written to the file
+    # END MOD
     ntheta = int(ntheta)
     filesize = int(filesize)
     if not 0 < filesize <= FILECAP:
         print('Chosen buffer size exceeds existing limit. Reset to', str(FILECAP), 'Bytes')
         filesize = FILECAP
 
-    bits_per_element_in_bits = np.dtype(DTYPE).itemsize
-    bits_per_file_in_bits = filesize*8
-    elements_per_file_in_elements = int(bits_per_file_in_bits // bits_per_element_in_bits)
+    # BEGIN MOD
+    # itemsize is in bytes, as is filesize
+    bytes_per_element_in_bytes = np.dtype(dtype).itemsize
+    elements_per_file_in_elements = int(filesize // bytes_per_element_in_bytes)
+    # END MOD
     length_in_elements = int(elements_per_file_in_elements // ntheta)
     if length_in_elements <= 0:
         print('In buffershape, ntheta has forced your buffer size to become larger than', filesize, 'Bytes')
@@ -719,62 +1583,345 @@ def buffershape(ntheta, filesize=FILECAP):
 
     return (length_in_elements, ntheta) 
 
-def concat_along_axis_0(memmap_list):
-    # Combines memmap objects of the same shape, except along axis 0, 
-    # by leaving them all on disk and appending them sequentially.
-    if len(memmap_list) == 0:
-        raise ValueError('Failed to buffer any data!') 
-
-    elif len(memmap_list) == 1:
-        return memmap_list[0]
-    
+# BEGIN MOD
+class ThetaSpill(object):
+    # Appends Hthets rows to one temporary file that grows with each write, so that
+    # only the rows not yet written are held in memory. close() returns all rows as a
+    # read-only memmap. The file is unlinked once mapped where the OS allows it, and is
+    # then freed with the memmap; discard() removes it when the run fails instead.
+    # Rows are kept in float64, the dtype of Hthets held in memory.
+    DTYPE = np.float64
+
+    def __init__(self, ntheta, dtype=DTYPE):
+        self.ntheta = int(ntheta)
+        self.dtype = np.dtype(dtype)
+        self.rows = 0
+        fd, self.filename = tempfile.mkstemp(prefix='rht', suffix='.dat')
+        self.file = os.fdopen(fd, 'wb')
+
+    def append(self, rows):
+        # Writes rows to the end of the file and returns the number of bytes written
+        rows = np.ascontiguousarray(rows, dtype=self.dtype).reshape(-1, self.ntheta)
+        rows.tofile(self.file)
+        self.rows += rows.shape[0]
+        return rows.nbytes
+
+    def close(self):
+        self.file.close()
+        if self.rows == 0:
+            os.remove(self.filename)
+            return np.zeros((0, self.ntheta), dtype=self.dtype)
+        out = np.memmap(self.filename, dtype=self.dtype, mode='r', shape=(self.rows, self.ntheta))
+        try:
+            os.remove(self.filename)
+        except OSError:
+            # Still mapped on Windows; left in the temporary directory
+            pass
+        return out
+
+    def discard(self):
+        # Closes and removes the file without mapping it
+        self.file.close()
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
+
+# Read-only arrays shared with the tiled RHT worker processes, attached once per worker
+_shared = {}
+
+def share_arrays(arrays):
+    # Copies each array of the given dict into its own block of shared memory.
+    # Returns the SharedMemory handles, which the caller must close and unlink,
+    # and the specs that attach_arrays() needs to map them in another process.
+    handles = []
+    specs = {}
+    for key, arr in arrays.items():
+        arr = np.ascontiguousarray(arr)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, arr.nbytes))
+        view = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+        view[...] = arr
+        handles.append(shm)
+        specs[key] = (shm.name, arr.shape, arr.dtype.str)
+    return handles, specs
+
+def attach_arrays(specs):
+    # Worker initializer: maps the shared arrays described by share_arrays() read-only
+    for key, (name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=name)
+        arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        arr.setflags(write=0)
+        _shared[key] = (shm, arr)
+
+def threshold_hough(h, h1, frac):
+    # Applies the RHT threshold to the Hough counts h of many windows, one per row,
+    # with exactly the arithmetic of the per-window loop in window_step.
+    # Returns the rows that remain lit and their thresholded theta spectra.
+    hout = np.true_divide(h, h1) - frac
+    hout *= np.greater_equal(hout, 0.0)
+    lit = np.any(hout, axis=1)
+    return lit, hout[lit]
+
+def backproj_step(masked_udata, xyt, h1, frac, wlen_mask, engine, message, progress=None):
+    # Runs the Hough step over every window of wlen_mask, keeping only the
+    # per-pixel sum of thresholded theta power. Returns an unnormalized float32 image.
+    backproj = np.zeros(masked_udata.shape, dtype=np.float32)
+    jpoints, ipoints = np.nonzero(wlen_mask)
+    progress = progress if progress is not None else Progress()
+    progress.start(len(jpoints), message=message)
+    for jj, ii, h in batch_hough(engine, masked_udata, xyt, jpoints, ipoints):
+        lit, hout = threshold_hough(h, h1, frac)
+        backproj[jj[lit], ii[lit]] = np.sum(hout, axis=1)
+        progress.update(pixels=len(jj), significant=len(hout))
+    return backproj
+
+def tile_step(task):
+    # Runs the Hough step for the windows centered in one tile, reading the
+    # tile and its wlen//2 halo from the shared masked_udata and xyt arrays.
+    # Returns the lit (jpoints, ipoints, hthets) and their backprojection values.
+    # With backproj_only, hthets is left empty.
+    jpoints, ipoints, h1, frac, engine, backproj_only = task
+    masked_udata = _shared['masked_udata'][1]
+    xyt = shared_kernel()
+    r = kernel_radius(xyt)
+
+    # Local view of the tile plus halo, with coordinates relative to it
+    y0 = int(np.min(jpoints))-r
+    x0 = int(np.min(ipoints))-r
+    y1 = int(np.max(jpoints))+r+1
+    x1 = int(np.max(ipoints))+r+1
+    sub = masked_udata[y0:y1, x0:x1]
+
+    Hi, Hj, Hthets, values = [], [], [], []
+    for jj, ii, h in batch_hough(engine, sub, xyt, jpoints-y0, ipoints-x0):
+        lit, hout = threshold_hough(h, h1, frac)
+        Hi.append(ii[lit]+x0)
+        Hj.append(jj[lit]+y0)
+        if not backproj_only:
+            Hthets.append(hout)
+        values.append(np.sum(hout, axis=1))
+    if backproj_only:
+        Hthets.append(np.zeros((0, kernel_ntheta(xyt))))
+    return (np.concatenate(Hj), np.concatenate(Hi), 
+            np.concatenate(Hthets), np.concatenate(values))
+
+def tiled_hough(masked_udata, xyt, h1, frac, wlen_mask, engine, workers, tile, message,
+        backproj_only=False, progress=None):
+    # Splits wlen_mask into tile x tile blocks and runs tile_step on each block in a
+    # pool of worker processes, sharing masked_udata and xyt through shared memory.
+    # Results are merged back into row-major order, so they match a serial run exactly.
+    datay, datax = wlen_mask.shape
+    tasks = []
+    for y0 in range(0, datay, tile):
+        for x0 in range(0, datax, tile):
+            jpoints, ipoints = np.nonzero(wlen_mask[y0:y0+tile, x0:x0+tile])
+            if len(jpoints):
+                tasks.append((jpoints+y0, ipoints+x0, h1, frac, engine, backproj_only))
+
+    handles, specs = share_arrays(dict(kernel_arrays(xyt), masked_udata=masked_udata))
+    try:
+        progress = progress if progress is not None else Progress()
+        progress.start(np.count_nonzero(wlen_mask), message=message)
+        parts = []
+        with ProcessPoolExecutor(max_workers=workers, initializer=attach_arrays, 
+                initargs=(specs,)) as pool:
+            for task, part in zip(tasks, pool.map(tile_step, tasks)):
+                parts.append(part)
+                progress.update(pixels=len(task[0]), significant=len(part[0]))
+    finally:
+        for shm in handles:
+            shm.close()
+            shm.unlink()
+
+    if len(parts) == 0:
+        return np.array([], dtype=np.intp), np.array([], dtype=np.intp), np.zeros((0, kernel_ntheta(xyt))), np.array([])
+    Hj, Hi, Hthets, values = [np.concatenate(x) for x in zip(*parts)]
+    order = np.lexsort((Hi, Hj))
+    if backproj_only:
+        return Hj[order], Hi[order], Hthets, values[order]
+    return Hj[order], Hi[order], Hthets[order], values[order]
+
+def theta_bins(wlen, original, center, halfwidth):
+    # Returns the indices of the theta bins of an RHT of this wlen that lie within
+    # halfwidth radians of center, for restricting the RHT to known orientations.
+    # Angles are those of the theta axis of Hthets, np.linspace(0, pi, ntheta) or
+    # up to 2*pi for the dRHT, and wrap around; a theta_rht() angle a is the bin angle
+    # pi - a. center is rounded to the nearest bin, so every center selects the same
+    # number of bins. center may be a scalar, giving an array of shape (nbins,), or an
+    # array such as a per-pixel prior orientation map, giving center.shape + (nbins,).
+    ntheta = ntheta_w(wlen)
+    if original:
+        dtheta = np.pi/ntheta
     else:
-        '''
-        #IMPLEMENTATION1: Make a new large memmapped file and sequentially dump data in
-        lengths = [memmap.shape[0] for memmap in memmap_list]
-        shapes = [memmap.shape[1:] for memmap in memmap_list]
-        assert all([x==shapes[0] for x in shapes[1:]])
-
-        big_memmap = np.memmap(os.path.join(temp_dir, +'rht.dat'), dtype=DTYPE, mode='r+', shape=(sum(lengths), *shapes[0])  )   
-        lengths.insert(0, sum(lengths))
-        for i in range(len(memmap_list)):
-            temp_file = memmap_list[i]
-            big_memmap[ sum(lengths[0:i]) : sum(lengths[0:i+1])-1, ...] = tempfile[:, ...]
-            temp_file.flush()         
-            temp_file.close()        
-            del temp_file 
-        return big_memmap
-        '''
-        # IMPLEMENTATION2: Append data to first given memmaped file, then delete and repeat
-        seed = memmap_list[0]
-        others = memmap_list[1:]
-        lengths = [memmap.shape[0] for memmap in others]
-        shapes = [memmap.shape[1:] for memmap in others]
-        assert all([x==seed.shape[1:] for x in shapes])
-        
-        bits_per_element_in_bits = np.dtype(DTYPE).itemsize
-        elements_per_shape_in_elements = np.multiply.reduce(seed.shape[1:])
-        bytes_per_shape_in_bytes = elements_per_shape_in_elements * bits_per_element_in_bits // 8
-
-        def append_memmaps(a, b):
-            a.flush()
-            a.close()
-            c = np.memmap(a.filename, dtype=DTYPE, mode='r+', offset=bytes_per_shape_in_bytes*a.shape[0], shape=b.shape )
-            
-            # Depends on offset correctly allocating new space at end of file
-            c[:,...] = b[:,...]
-            b.flush()         
-            b.close()        
-            del b
-            return c 
-
-        return reduce(append_memmaps, others, initializer=seed)
+        dtheta = 2*np.pi/ntheta
+    center = np.asarray(center, dtype=float)
+    k = int(math.floor(halfwidth/dtheta + 1e-9))
+    if 2*k+1 >= ntheta:
+        # The window covers every angle
+        return np.broadcast_to(np.arange(ntheta), center.shape + (ntheta,))
+    nearest = np.rint(center/dtheta).astype(np.intp)
+    return np.mod(nearest[..., None] + np.arange(-k, k+1), ntheta)
+
+def prior_hough(in_arr, kernel, bins, jpoints, ipoints):
+    # Evaluates the Hough counts of the windows centered on every (jpoints, ipoints)
+    # for the theta bins of each window, bins of shape (len(jpoints), nbins), in a single
+    # gather pass. The lit offsets of each theta are padded to a common length as flat
+    # offsets into in_arr, so every window reads its own bins at once; padding reads a
+    # zero appended to in_arr. Bands are sized so the gathered pixels stay within BANDCAP.
+    # Yields (jpoints, ipoints, h) for each band, where h has shape (len(jpoints), nbins).
+    if not isinstance(kernel, SparseThetas):
+        kernel = sparse_thetas(kernel)
+    counts = np.diff(kernel.indptr)
+    width = max(1, int(np.max(counts)))
+    slot = np.arange(width)
+    padding = slot >= counts[:, np.newaxis]
+    lit = np.minimum(kernel.indptr[:-1, np.newaxis] + slot, max(0, len(kernel.dy)-1))
+    offsets = kernel.dy[lit]*in_arr.shape[1] + kernel.dx[lit]
+
+    flat = np.append(np.ravel(in_arr), np.zeros(1, dtype=in_arr.dtype))
+    zero = len(flat)-1
+    band = max(1, BANDCAP // (2*8*bins.shape[-1]*width))
+    for c0 in range(0, len(jpoints), band):
+        jj = jpoints[c0:c0+band]
+        ii = ipoints[c0:c0+band]
+        b = bins[c0:c0+band]
+        index = (jj*in_arr.shape[1] + ii)[:, np.newaxis, np.newaxis] + offsets[b]
+        np.copyto(index, zero, where=padding[b])
+        yield jj, ii, np.sum(flat[index], axis=-1, dtype=np.int64)
+
+def restricted_hough(masked_udata, xyt, h1, frac, wlen_mask, bins, engine, message, 
+        progress=None):
+    # Runs the Hough step over every window of wlen_mask for only the given theta bins
+    # (see theta_bins), so the work and output shrink with the number of bins kept.
+    # bins of shape (nbins,) applies to every window, through the batch engine.
+    # bins of shape data.shape + (nbins,) gives each window its own bins, which are
+    # gathered in one pass whatever the engine (see prior_hough).
+    # Returns (Hj, Hi, index, hthets, values) in row-major order, where index holds the
+    # bins of each row of hthets and values the backprojection.
+    jpoints, ipoints = np.nonzero(wlen_mask)
+    progress = progress if progress is not None else Progress()
+    progress.start(len(jpoints), message=message)
+    if bins.ndim == 1:
+        windows = batch_hough(engine, masked_udata, select_thetas(xyt, bins), jpoints, ipoints)
+    else:
+        windows = prior_hough(masked_udata, xyt, bins[jpoints, ipoints], jpoints, ipoints)
 
-def window_step(data, wlen, frac, smr, original, smr_mask, wlen_mask, 
-        xyt_filename, message, filepath): 
+    Hj, Hi, index, Hthets, values = [], [], [], [], []
+    for jj, ii, h in windows:
+        if bins.ndim == 1:
+            window_bins = np.broadcast_to(bins, h.shape)
+        else:
+            window_bins = bins[jj, ii]
+        lit, hout = threshold_hough(h, h1[window_bins], frac)
+        Hj.append(jj[lit])
+        Hi.append(ii[lit])
+        index.append(window_bins[lit].astype(np.uint16))
+        Hthets.append(hout)
+        values.append(np.sum(hout, axis=1))
+        progress.update(pixels=len(jj), significant=len(hout))
+
+    nbins = bins.shape[-1]
+    if len(Hj) == 0:
+        return (np.array([], dtype=np.intp), np.array([], dtype=np.intp), 
+                np.zeros((0, nbins), np.uint16), np.zeros((0, nbins)), np.array([]))
+    Hj, Hi, index, Hthets, values = [np.concatenate(x) for x in (Hj, Hi, index, Hthets, values)]
+    return Hj, Hi, index, Hthets, values
+
+def grid_weights(n, stride):
+    # Returns, for each of n pixels along an axis, the two coarse grid points on
+    # either side of it and the linear interpolation weight of the second
+    position = np.arange(n) / stride
+    lower = np.floor(position).astype(np.intp)
+    upper = np.minimum(lower + 1, (n - 1)//stride)
+    return lower, upper, position - lower
+
+def fill_backproj(bp, wlen_mask, stride, fill=FILL):
+    # Reconstructs the backprojection of a strided window_step, which holds values only
+    # at the grid points [::stride, ::stride], at every pixel of wlen_mask.
+    # 'nearest' copies the value of the closest grid point, and 'linear' interpolates
+    # bilinearly between the grid points around each pixel. Grid points outside
+    # wlen_mask were never evaluated and are left out, rather than counted as zero:
+    # 'nearest' replaces them by the valid grid point closest to them.
+    # Returns the reconstruction, normalized like bp.
+    coarse = np.asarray(bp)[::stride, ::stride]
+    valid = wlen_mask[::stride, ::stride]
+    datay, datax = wlen_mask.shape
+    if fill == 'nearest':
+        rows = np.minimum(np.rint(np.arange(datay) / stride).astype(np.intp), coarse.shape[0] - 1)
+        cols = np.minimum(np.rint(np.arange(datax) / stride).astype(np.intp), coarse.shape[1] - 1)
+        if np.any(valid) and not np.all(valid):
+            # Every grid point takes the value of its nearest valid one
+            nearest = scipy.ndimage.distance_transform_edt(np.logical_not(valid), 
+                    return_distances=False, return_indices=True)
+            coarse = coarse[nearest[0], nearest[1]]
+        out = coarse[rows[:, None], cols[None, :]]
+    elif fill == 'linear':
+        # Interpolates the values and the valid grid points alike, so that dividing
+        # one by the other weights only the evaluated points
+        j0, j1, wj = grid_weights(datay, stride)
+        i0, i1, wi = grid_weights(datax, stride)
+        wj = wj[:, None]
+        value = np.where(valid, coarse, 0)
+        weight = valid.astype(coarse.dtype)
+        def interpolate(grid):
+            rows = grid[j0] * (1 - wj) + grid[j1] * wj
+            return rows[:, i0] * (1 - wi) + rows[:, i1] * wi
+        value = interpolate(value)
+        weight = interpolate(weight)
+        out = np.divide(value, weight, out=np.zeros_like(value), where=weight > 0)
+    else:
+        raise ValueError('Supported fills in fill_backproj include: nearest and linear only')
+    out = np.where(wlen_mask, out, 0).astype(coarse.dtype)
+    peak = np.amax(out)
+    if peak > 0:
+        out /= peak
+    return out
+# END MOD
+
+def window_step(data, wlen, frac, smr, original, smr_mask, wlen_mask,
+        xyt_filename, message, filepath, engine=ENGINE, workers=WORKERS, 
+        tile=TILE, backproj_only=False, encoding=ENCODING, progress=None, bins=None,
+        stride=1, fill=FILL):
     """
     MOD - returns data rather than writes to disk.
 
+    engine selects how each window is evaluated: 'loop' runs fast_hough
+    on one window at a time, 'convolve' evaluates all windows at once
+    with convolve_hough, 'sparse' gathers only the lit pixels of each
+    theta with sparse_hough_batch, and 'bitpack' counts them with bitwise
+    AND and popcount in bitpack_hough. All return identical results.
+
+    workers > 1 splits the image into tile x tile blocks and evaluates
+    them in that many processes (see tiled_hough). The merged result is
+    identical to the serial one.
+
+    backproj_only skips the theta spectra and writes the backprojection
+    straight into a float32 array, so memory stays O(image). Hi, Hj and
+    Hthets are then returned as None.
+
+    encoding stores Hthets compactly as EncodedThetas (see encode_thetas).
+    The batch engines encode each band as it is made,
+    so the full float spectra are never held at once.
+
+    With BUFFER set, float Hthets of a serial run are spilled to a
+    temporary file in chunks of buffershape() rows and returned as a
+    read-only memmap, whatever the engine. Encoded Hthets and those of
+    tiled runs (workers > 1) are held in memory.
+
+    progress is the Progress of this run, which also counts the windows
+    evaluated, significant windows and bytes spilled to BUFFER files.
+
+    bins restricts the transform to the theta bins from theta_bins(), either
+    for all windows or per pixel (see restricted_hough). Hthets are then
+    returned as 'topk' EncodedThetas holding only those bins, and the
+    windows are evaluated serially.
+
+    stride > 1 evaluates only the windows on every stride-th row and column.
+    The 'sparse', 'bitpack' and 'loop' engines then do about stride**2 times
+    less Hough work, while 'convolve' still transforms whole bands of rows
+    and gains little. ipoints, jpoints and hthets hold those windows, and the
+    backprojection is filled in between them by fill_backproj.
+
     Returns
     -------
     results : list
@@ -796,6 +1943,23 @@ def window_step(data, wlen, frac, smr, original, smr_mask, wlen_mask,
     assert smr == int(smr)
     assert smr > 0
     
+    # BEGIN MOD
+    assert stride == int(stride)
+    assert stride > 0
+
+    if stride > 1:
+        # Runs on the coarse grid only, then fills in the backprojection
+        coarse = np.zeros_like(wlen_mask, dtype=bool)
+        coarse[::stride, ::stride] = wlen_mask[::stride, ::stride]
+        results = window_step(data=data, wlen=wlen, frac=frac, smr=smr, original=original, 
+                smr_mask=smr_mask, wlen_mask=coarse, xyt_filename=xyt_filename, 
+                message=message, filepath=filepath, engine=engine, workers=workers, 
+                tile=tile, backproj_only=backproj_only, encoding=encoding, 
+                progress=progress, bins=bins)
+        results[3] = fill_backproj(results[3], wlen_mask, stride, fill=fill)
+        return results
+    # END MOD
+
     # Needed values
     r = wlen//2 
     ntheta = ntheta_w(wlen)
@@ -809,15 +1973,18 @@ def window_step(data, wlen, frac, smr, original, smr_mask, wlen_mask,
                 retstep=True)
 
     # Cylinder of all lit pixels along a theta value
-    xyt = all_thetas(wlen=wlen, theta=theta, original=original) 
-    xyt.setflags(write=0)
+    # BEGIN MOD
+    xyt = engine_thetas(engine, wlen=wlen, original=original)
+    # END MOD
     
     # Unsharp masks the whole data set
     masked_udata = umask(data=data, radius=smr, smr_mask=smr_mask)
     masked_udata.setflags(write=0)
 
     # Hough transform of same-sized circular window of 1's
-    h1 = fast_hough(circ_kern(wlen), xyt)
+    # BEGIN MOD
+    h1 = kernel_h1(xyt)
+    # END MOD
     h1.setflags(write=0)
 
     # Local function calls are faster than globals
@@ -833,113 +2000,553 @@ def window_step(data, wlen, frac, smr, original, smr_mask, wlen_mask,
     # Bonus Backprojection Creation
     backproj = np.zeros_like(data)
 
+    # BEGIN MOD
+    if engine not in ('loop', 'convolve', 'sparse', 'bitpack'):
+        raise ValueError('Supported engines in window_step include: loop, convolve, sparse and bitpack only')
+
+    if progress is None:
+        progress = Progress()
+
+    if bins is not None:
+        Hj, Hi, index, Hthets, values = restricted_hough(masked_udata, xyt, h1, frac, 
+                wlen_mask, np.asarray(bins), engine=engine, message=message, progress=progress)
+        if backproj_only:
+            backproj = np.zeros(data.shape, dtype=np.float32)
+        backproj[Hj, Hi] = values
+        bp=np.divide(backproj, np.amax(backproj))
+        if backproj_only:
+            return([None, None, None, bp])
+        if len(Hi) == 0:
+            return([np.array([]), np.array([]), np.array([]), bp])
+        return([Hi, Hj, EncodedThetas('topk', ntheta, index=index, power=Hthets), bp])
+
+    if backproj_only:
+        # Single precision backprojection, with no per-pixel spectra kept
+        backproj = np.zeros(data.shape, dtype=np.float32)
+        if workers > 1:
+            Hj, Hi, Hthets, values = tiled_hough(masked_udata, xyt, h1, frac, wlen_mask, 
+                    engine=engine, workers=workers, tile=tile, message=message, 
+                    backproj_only=True, progress=progress)
+            backproj[Hj, Hi] = values
+        else:
+            backproj = backproj_step(masked_udata, xyt, h1, frac, wlen_mask, 
+                    engine=engine, message=message, progress=progress)
+        backproj /= np.amax(backproj)
+        return([None, None, None, backproj])
+
+    if workers > 1:
+        Hj, Hi, Hthets, values = tiled_hough(masked_udata, xyt, h1, frac, wlen_mask, 
+                engine=engine, workers=workers, tile=tile, message=message, 
+                progress=progress)
+        backproj[Hj, Hi] = values
+        bp=np.divide(backproj, np.amax(backproj))
+        if len(Hi) == 0:
+            return([np.array([]), np.array([]), np.array([]), bp])
+        return([Hi, Hj, Hthets, bp])
+
+    if engine != 'loop':
+        # Float spectra are spilled like those of the loop below, in chunks of at
+        # least buffer_shape rows. Encoded spectra are compact and stay in memory.
+        spill = None
+        buffered = 0
+        buffer_shape = buffershape(ntheta, dtype=ThetaSpill.DTYPE)
+        jpoints, ipoints = np.nonzero(wlen_mask)
+        progress.start(len(jpoints), message=message)
+        try:
+            for jj, ii, h in batch_hough(engine, masked_udata, xyt, jpoints, ipoints):
+                # Same arithmetic as the loop below, applied to a whole band of windows
+                lit, hout = threshold_hough(h, h1, frac)
+                htapp(encode_thetas(hout, encoding=encoding))
+                hiapp(ii[lit])
+                hjapp(jj[lit])
+                backproj[jj[lit], ii[lit]] = np.sum(hout, axis=1)
+                progress.update(pixels=len(jj), significant=len(hout))
+
+                buffered += len(hout)
+                if BUFFER and not encoding and buffered >= buffer_shape[0]:
+                    if spill is None:
+                        spill = ThetaSpill(ntheta)
+                    progress.spilled += spill.append(np.concatenate(Hthets))
+                    buffered = 0
+                    del Hthets[:]
+        except BaseException:
+            if spill is not None:
+                spill.discard()
+            raise
+
+        bp=np.divide(backproj, np.amax(backproj))
+        if sum(len(x) for x in Hi) == 0:
+            # Matches the loop, which returns empty arrays when nothing is lit
+            return([np.array([]), np.array([]), np.array([]), bp])
+        if spill is not None:
+            if buffered > 0:
+                progress.spilled += spill.append(np.concatenate(Hthets))
+            Hthets = spill.close()
+        elif encoding:
+            Hthets = EncodedThetas.concatenate(Hthets)
+        else:
+            Hthets = np.concatenate(Hthets)
+        return([np.concatenate(Hi), np.concatenate(Hj), Hthets, bp])
+    # END MOD
+
     if BUFFER:
         # Preparing to write hout to file during operation so it does not over-fill RAM.
-        temp_dir = tempfile.mkdtemp()
-        
-        # List of memmap objects.
-        temp_files = []
-        buffer_shape = buffershape(ntheta)
-        def next_temp_filename():
-            return os.path.join(temp_dir, 'rht'+ str(len(temp_files)) + '.dat')
-        #print 'Temporary files in:', temp_dir 
+        # BEGIN MOD
+        # Full chunks of buffer_shape rows are appended to one growing spill file,
+        # which is only created once the first chunk fills
+        spill = None
+        buffer_shape = buffershape(ntheta, dtype=ThetaSpill.DTYPE)
+        # END MOD
 
     # Number of RHT operations that will be performed, and their coordinates
-    update_progress(0.0)
     coords = list(zip( *np.nonzero( wlen_mask)))
     N = len(coords)
-    for c in range(N):
-        j,i = coords[c]
-        h = fast_hough(masked_udata[j-r:j+r+1, i-r:i+r+1], xyt)
-
-        # Original RHT Implementation Subtracts Threshold From All Theta-Power Spectrums
-        hout = nptruediv(h, h1) - frac
-        hout *= npge(hout, 0.0)
-        # Deprecated Implementation Leaves Theta-Power Spectrum AS IS
-        #hout = nptruediv(h, h1)
-        #hout *= npge(hout, frac)
-
-        if np.any(hout):
-            htapp(hout)
-            hiapp(i)
-            hjapp(j)
-            backproj[j][i] = np.sum(hout) 
-
-            if BUFFER and len(Hthets) == buffer_shape[0]:
-                # Creates full memmap object
-                temp_files.append( np.memmap( next_temp_filename(), dtype=DTYPE, mode='w+', shape=buffer_shape ))
-                
-                # Convert list to array
-                theta_array = np.array(Hthets, dtype=DTYPE)
-                
-                # Write array to last memmapped object in list
-                temp_files[-1][:] = theta_array[:]
+    # BEGIN MOD
+    progress.start(N, message=message)
+    progupdate = progress.update
+    try:
+    # END MOD
+        for c in range(N):
+            j,i = coords[c]
+            h = fast_hough(masked_udata[j-r:j+r+1, i-r:i+r+1], xyt)
+
+            # Original RHT Implementation Subtracts Threshold From All Theta-Power Spectrums
+            hout = nptruediv(h, h1) - frac
+            hout *= npge(hout, 0.0)
+            # Deprecated Implementation Leaves Theta-Power Spectrum AS IS
+            #hout = nptruediv(h, h1)
+            #hout *= npge(hout, frac)
+
+            # BEGIN MOD
+            lit = np.any(hout)
+            # END MOD
+            if lit:
+                htapp(hout)
+                hiapp(i)
+                hjapp(j)
+                backproj[j][i] = np.sum(hout) 
+
+                if BUFFER and len(Hthets) == buffer_shape[0]:
+                    # BEGIN MOD
+                    # Write the full chunk to the end of the spill file
+                    if spill is None:
+                        spill = ThetaSpill(ntheta)
+                    progress.spilled += spill.append(Hthets)
+                    # END MOD
                 
-                # Reset Hthets
-                Hthets = []
-
-        update_progress((c+1)/float(N), message=message, final_message=message)
-        #End
-
-    if not BUFFER:
-        # BEGIN MOD
-        bp=np.divide(backproj, np.amax(backproj))
+                    # Reset Hthets
+                    Hthets = []
+                    # BEGIN MOD
+                    htapp = Hthets.append
+                    # END MOD
+
+            # BEGIN MOD
+            progupdate(pixels=1, significant=int(lit))
+            # END MOD
+            #End
+    # BEGIN MOD
+    except BaseException:
+        # Leave no spill file behind when the run fails or is interrupted
+        if BUFFER and spill is not None:
+            spill.discard()
+        raise
+    # END MOD
+
+    # BEGIN MOD
+    bp=np.divide(backproj, np.amax(backproj))
+    if not BUFFER or spill is None:
+        # Everything fit in memory
         return([
             np.array(Hi), 
             np.array(Hj), 
             np.array(Hthets), 
             bp
             ])
-        # END MOD
 
     else:
         if len(Hthets) > 0:
-            # Create small memmap object
-            temp_files.append( np.memmap( next_temp_filename(), dtype=DTYPE, mode='w+', shape=(len(Hthets), ntheta)  ))
-            
-            # Write array to last memmapped object in list
-            theta_array = np.array(Hthets, dtype=DTYPE)
-            temp_files[-1][:] = theta_array[:]
-
-        #print 'Converting list of buffered hthet arrays into final XYT cube'
-        # Combine memmap objects sequentially
-        converted_hthets = concat_along_axis_0(temp_files)
-        converted_hthets.flush()
-        # BEGIN MOD
-        bp=np.divide(backproj, np.amax(backproj))
-        params = [
+            progress.spilled += spill.append(Hthets)
+
+        # All rows, in order, as a read-only memmap of the spill file
+        return([
             np.array(Hi), 
             np.array(Hj), 
-            np.array(Hthets), 
+            spill.close(), 
             bp
-            ]
-        # END MOD
-        del converted_hthets
-        
-        def rmtree_failue(function, path, excinfo):
-            try:
-                #os.listdir(temp_dir):
-                for obj in temp_files: 
-                    #q = file(obj)
-                    #q.close()
-                    #del q
-                    obj.close()
-                    os.remove(obj)
-                os.removedirs(temp_dir)
-            except:
-                print('Failed to delete temporary files:', path) 
+            ])
+    # END MOD
+
+# BEGIN MOD
+def frame_backproj(frame, xyt, h1, wlen, smr, frac, engine):
+    # Normalized float32 backprojection of one frame, given the shared kernel and h1
+    smr_mask, wlen_mask = getMask(frame, smr=smr, wlen=wlen)
+    masked_udata = umask(data=frame, radius=smr, smr_mask=smr_mask)
+    backproj = backproj_step(masked_udata, xyt, h1, frac, wlen_mask, 
+            engine=engine, message='Running RHT...')
+    backproj /= np.amax(backproj)
+    return backproj
+
+def cube_init(specs):
+    # Worker initializer for rht_cube: maps the shared kernel and silences progress
+    # bars, which would interleave between processes
+    global PROGRESS
+    PROGRESS = False
+    attach_arrays(specs)
+
+def cube_step(task):
+    # Runs frame_backproj on one frame in an rht_cube worker process
+    index, frame, wlen, smr, frac, engine = task
+    xyt = shared_kernel()
+    h1 = _shared['h1'][1]
+    return index, frame_backproj(frame, xyt, h1, wlen, smr, frac, engine)
+
+def cube_writer(out, shape, wlen, smr, frac, original):
+    # Returns (target, write, close) for the rht_cube output. target is an array
+    # (possibly memory-mapped) of the given shape, or for FITS output the filename
+    # of a cube that frames are streamed into in order.
+    if out is None:
+        target = np.zeros(shape, dtype=np.float32)
+    elif isinstance(out, str) and out.endswith('.npy'):
+        target = np.lib.format.open_memmap(out, mode='w+', dtype=np.float32, shape=shape)
+    elif isinstance(out, str) and out.endswith('.fits'):
+        header = fits.PrimaryHDU().header
+        header['BITPIX'] = -32
+        header['NAXIS'] = 3
+        header.set('NAXIS1', shape[2], after='NAXIS')
+        header.set('NAXIS2', shape[1], after='NAXIS1')
+        header.set('NAXIS3', shape[0], after='NAXIS2')
+        header['WLEN'] = wlen
+        header['SMR'] = smr
+        header['FRAC'] = frac
+        header['ORIGINAL'] = original
+        if os.path.isfile(out):
+            os.remove(out)
+        stream = fits.StreamingHDU(out, header)
+        return out, lambda index, bp: stream.write(bp), stream.close
+    elif isinstance(out, str):
+        raise ValueError('Supported output filetypes in rht_cube include: .npy and .fits only')
+    else:
+        assert out.shape == tuple(shape)
+        target = out
 
-        shutil.rmtree(temp_dir, ignore_errors=False, onerror=rmtree_failue)
-        # BEGIN MOD
-        return params
-        # END MOD
+    def write(index, bp):
+        target[index] = bp
+
+    def close():
+        if isinstance(target, np.memmap):
+            target.flush()
+
+    return target, write, close
+
+def raw_step(data, wlen, smr, original, smr_mask, wlen_mask, engine='sparse', 
+        min_frac=RAW_MIN_FRAC, message='Running raw RHT...', progress=None):
+    """
+    Runs the Hough step of window_step once, without applying frac, so
+    that raw_frac() can threshold the result for any frac >= min_frac.
+
+    The raw response of a window is h/h1, where the Hough counts h are
+    small integers (at most h1). They are stored losslessly as uint8 or
+    uint16, and only for windows whose largest h/h1 exceeds min_frac,
+    since no other window can pass a threshold of min_frac or more.
+
+    engine must be one of the batch engines, 'convolve', 'sparse' or 'bitpack'.
+
+    Returns
+    -------
+    raw : dict
+        ipoints, jpoints : np.array
+        counts : np.array of shape (len(ipoints), ntheta)
+        h1 : np.array
+        shape, dtype : shape and dtype of data, for the backprojection
+        wlen, smr, original, min_frac : parameters of the run
+    """
+    assert wlen == int(wlen)
+    assert wlen > 0
+    assert wlen%2
+    assert smr == int(smr)
+    assert smr > 0
+    assert 0 <= min_frac <= 1
+
+    xyt = engine_thetas(engine, wlen=wlen, original=original)
+    masked_udata = umask(data=data, radius=smr, smr_mask=smr_mask)
+    h1 = kernel_h1(xyt)
+
+    # Counts never exceed h1, so the smallest unsigned type that holds h1 is lossless
+    if np.max(h1) <= np.iinfo(np.uint8).max:
+        count_type = np.uint8
+    else:
+        count_type = np.uint16
+
+    Hi, Hj, counts = [], [], []
+    jpoints, ipoints = np.nonzero(wlen_mask)
+    progress = progress if progress is not None else Progress()
+    progress.start(len(jpoints), message=message)
+    for jj, ii, h in batch_hough(engine, masked_udata, xyt, jpoints, ipoints):
+        keep = np.max(np.true_divide(h, h1), axis=1) > min_frac
+        Hi.append(ii[keep])
+        Hj.append(jj[keep])
+        counts.append(h[keep].astype(count_type))
+        progress.update(pixels=len(jj), significant=int(np.count_nonzero(keep)))
+
+    ntheta = kernel_ntheta(xyt)
+    return {
+        'ipoints' : np.concatenate(Hi) if Hi else np.array([], dtype=np.intp),
+        'jpoints' : np.concatenate(Hj) if Hj else np.array([], dtype=np.intp),
+        'counts' : np.concatenate(counts) if counts else np.zeros((0, ntheta), count_type),
+        'h1' : np.array(h1),
+        'shape' : data.shape,
+        'dtype' : data.dtype,
+        'wlen' : wlen,
+        'smr' : smr,
+        'original' : original,
+        'min_frac' : min_frac
+        }
+
+def raw_frac(raw, frac, theta_range=None):
+    """
+    Thresholds a raw_step result at frac, without rerunning the Hough step.
+    The result is identical to window_step with the same parameters.
+
+    frac may be a single value, or a list of values, in which case a list
+    of results is returned in the same order.
+
+    theta_range (center, halfwidth) keeps only the theta bins selected by
+    theta_bins, as rht() does, by picking those columns of the raw counts.
+
+    Returns
+    -------
+    results : list
+        ipoints : np.array
+        jpoints : np.array
+        hthets : np.array
+        bp : np.array
+    """
+    if np.ndim(frac) > 0:
+        return [raw_frac(raw, f, theta_range=theta_range) for f in frac]
+
+    assert frac == float(frac)
+    assert raw['min_frac'] <= frac <= 1
+
+    counts = raw['counts']
+    h1 = raw['h1']
+    bins = None
+    if theta_range is not None:
+        bins = theta_bins(raw['wlen'], raw['original'], theta_range[0], theta_range[1])
+        if bins.shape[-1] == len(h1):
+            bins = None
+    backproj = np.zeros(raw['shape'], dtype=raw['dtype'])
+    Hi, Hj, Hthets = [], [], []
+
+    # Thresholded spectra are float64, so convert the counts a block at a time
+    step = max(1, int(BANDCAP // (16*max(1, counts.shape[1]))))
+    index = []
+    for c0 in range(0, len(counts), step):
+        block = counts[c0:c0+step]
+        block_h1 = h1
+        if bins is not None:
+            # Bins shared by all windows, or looked up per window
+            if bins.ndim == 1:
+                rows = np.broadcast_to(bins, (len(block), len(bins)))
+            else:
+                rows = bins[raw['jpoints'][c0:c0+step], raw['ipoints'][c0:c0+step]]
+            block = np.take_along_axis(block, rows, axis=1)
+            block_h1 = h1[rows]
+        lit, hout = threshold_hough(block, block_h1, frac)
+        ii = raw['ipoints'][c0:c0+step][lit]
+        jj = raw['jpoints'][c0:c0+step][lit]
+        Hi.append(ii)
+        Hj.append(jj)
+        Hthets.append(hout)
+        if bins is not None:
+            index.append(rows[lit].astype(np.uint16))
+        backproj[jj, ii] = np.sum(hout, axis=1)
+
+    bp=np.divide(backproj, np.amax(backproj))
+    if sum(len(x) for x in Hi) == 0:
+        return([np.array([]), np.array([]), np.array([]), bp])
+    if bins is not None:
+        Hthets = [EncodedThetas('topk', len(h1), index=np.concatenate(index), 
+                power=np.concatenate(Hthets))]
+    return([
+        np.concatenate(Hi),
+        np.concatenate(Hj),
+        Hthets[0] if bins is not None else np.concatenate(Hthets),
+        bp
+        ])
+
+def multi_step(data, wlens, frac, smr, original, smr_mask, wlen_masks, message, 
+        engine='sparse', backproj_only=False, encoding=ENCODING, progress=None):
+    """
+    Runs window_step for several wlen in one pass over the image. The
+    unsharp mask of data is made once, and the pixel grid is walked in
+    blocks of TILE rows, evaluating every scale on each block before moving
+    on, so the masked data of a block is reused while it is in cache.
+
+    engine must be one of the batch engines, 'convolve', 'sparse' or 'bitpack'.
+    wlen_masks is a dict of the wlen_mask of each wlen, as from getMasks.
+
+    Returns
+    -------
+    results : dict
+        The window_step results [ipoints, jpoints, hthets, bp] of each wlen
+    """
+    masked_udata = umask(data=data, radius=smr, smr_mask=smr_mask)
+    masked_udata.setflags(write=0)
+
+    scales = {}
+    for wlen in wlens:
+        xyt = engine_thetas(engine, wlen=wlen, original=original)
+        h1 = kernel_h1(xyt)
+        backproj = np.zeros(data.shape, dtype=np.float32 if backproj_only else data.dtype)
+        scales[wlen] = (xyt, h1, backproj, [], [], [])
+
+    progress = progress if progress is not None else Progress()
+    progress.start(sum(int(np.count_nonzero(wlen_masks[w])) for w in wlens), message=message)
+    datay = data.shape[0]
+    for y0 in range(0, datay, TILE):
+        for wlen in wlens:
+            xyt, h1, backproj, Hi, Hj, Hthets = scales[wlen]
+            jpoints, ipoints = np.nonzero(wlen_masks[wlen][y0:y0+TILE])
+            for jj, ii, h in batch_hough(engine, masked_udata, xyt, jpoints + y0, ipoints):
+                lit, hout = threshold_hough(h, h1, frac)
+                backproj[jj[lit], ii[lit]] = np.sum(hout, axis=1)
+                if not backproj_only:
+                    Hthets.append(encode_thetas(hout, encoding=encoding))
+                    Hi.append(ii[lit])
+                    Hj.append(jj[lit])
+                progress.update(pixels=len(jj), significant=len(hout))
+
+    results = {}
+    for wlen in wlens:
+        xyt, h1, backproj, Hi, Hj, Hthets = scales[wlen]
+        bp = np.divide(backproj, np.amax(backproj))
+        if backproj_only:
+            results[wlen] = [None, None, None, bp]
+        elif sum(len(x) for x in Hi) == 0:
+            results[wlen] = [np.array([]), np.array([]), np.array([]), bp]
+        else:
+            results[wlen] = [
+                np.concatenate(Hi),
+                np.concatenate(Hj),
+                EncodedThetas.concatenate(Hthets) if encoding else np.concatenate(Hthets),
+                bp
+                ]
+    return results
+
+def roi_region(data, wlen, smr, roi):
+    # Returns the bounds (y0, y1, x0, x1) of the window centers that a change to data
+    # inside roi can affect, the (y, x) origin of a crop of data holding everything those
+    # windows depend on, and the crop's smr_mask and wlen_mask, restricted to them.
+    # The unsharp mask and masks reach smr pixels and each window reaches wlen//2 pixels;
+    # the crop adds the edge margin that getMask() masks away, so its masks and unsharp
+    # mask equal those of the full frame around the affected windows.
+    datay, datax = data.shape
+    r = wlen//2
+    y0, y1, x0, x1 = [int(x) for x in roi]
+
+    # Window centers that the change can affect
+    reach = smr + r
+    ay0, ay1 = max(0, y0-reach), min(datay, y1+reach)
+    ax0, ax1 = max(0, x0-reach), min(datax, x1+reach)
+
+    margin = smr + r + 1
+    cy0, cy1 = max(0, ay0-margin), min(datay, ay1+margin)
+    cx0, cx1 = max(0, ax0-margin), min(datax, ax1+margin)
+    crop = data[cy0:cy1, cx0:cx1]
+
+    smr_mask, wlen_mask = getMask(crop, smr=smr, wlen=wlen)
+    region = np.zeros_like(wlen_mask)
+    region[ay0-cy0:ay1-cy0, ax0-cx0:ax1-cx0] = 1
+    wlen_mask = np.logical_and(wlen_mask, region)
+    return (ay0, ay1, ax0, ax1), (cy0, cx0), crop, smr_mask, wlen_mask
+
+def outside(jpoints, ipoints, bounds):
+    # Mask of the points outside the half-open bounds (y0, y1, x0, x1)
+    y0, y1, x0, x1 = bounds
+    return np.logical_not(np.logical_and(
+            np.logical_and(jpoints >= y0, jpoints < y1), 
+            np.logical_and(ipoints >= x0, ipoints < x1)))
+
+def roi_step(data, wlen, frac, smr, original, roi, previous=None, engine='sparse', 
+        message='Running RHT on ROI...', progress=None):
+    """
+    Recomputes the RHT only where a change to data inside roi can reach.
+
+    roi is (y0, y1, x0, x1), the half-open bounds of the changed pixels.
+    The unsharp mask and masks reach smr pixels and each window reaches
+    wlen//2 pixels, so only windows centered within smr + wlen//2 of roi
+    are evaluated, on a crop of data large enough to give exactly the
+    same masks and unsharp mask as the full frame there.
+
+    previous is the full-frame result of rht() for the data before the
+    change. Its entries outside the affected region are reused, and the
+    merged result is identical to rerunning rht() on the whole frame.
+    It must hold Hthets, so it cannot come from a backproj_only run.
+    Without previous, only the affected region is returned, and its
+    backprojection is normalized by its own maximum.
+
+    engine may be any engine of window_step; 'loop' evaluates the
+    windows one at a time.
+
+    Returns
+    -------
+    results : list
+        ipoints : np.array
+        jpoints : np.array
+        hthets : np.array
+        bp : np.array
+    """
+    if previous is not None and previous[0] is None:
+        raise ValueError('previous must hold Hthets; rerun rht() without backproj_only')
+
+    affected, (cy0, cx0), crop, smr_mask, wlen_mask = roi_region(data, wlen, smr, roi)
+    xyt = engine_thetas(engine, wlen=wlen, original=original)
+    h1 = kernel_h1(xyt)
+    masked_udata = umask(data=crop, radius=smr, smr_mask=smr_mask)
+
+    Hi, Hj, Hthets = [], [], []
+    jpoints, ipoints = np.nonzero(wlen_mask)
+    progress = progress if progress is not None else Progress()
+    progress.start(len(jpoints), message=message)
+    for jj, ii, h in batch_hough(engine, masked_udata, xyt, jpoints, ipoints):
+        lit, hout = threshold_hough(h, h1, frac)
+        Hi.append(ii[lit]+cx0)
+        Hj.append(jj[lit]+cy0)
+        Hthets.append(hout)
+        progress.update(pixels=len(jj), significant=len(hout))
+
+    if previous is not None and len(previous[0]):
+        # Reuse every previous entry outside the affected region
+        pi, pj, pthets = previous[0], previous[1], previous[2]
+        keep = outside(np.asarray(pj), np.asarray(pi), affected)
+        Hi.append(np.asarray(pi)[keep])
+        Hj.append(np.asarray(pj)[keep])
+        Hthets.append(np.asarray(pthets)[keep])
+
+    ntheta = kernel_ntheta(xyt)
+    Hi = np.concatenate(Hi) if Hi else np.array([], dtype=np.intp)
+    Hj = np.concatenate(Hj) if Hj else np.array([], dtype=np.intp)
+    Hthets = np.concatenate(Hthets) if Hthets else np.zeros((0, ntheta))
+    order = np.lexsort((Hi, Hj))
+    Hi, Hj, Hthets = Hi[order], Hj[order], Hthets[order]
+
+    # Each backprojection pixel is the sum of its spectrum, so it can be rebuilt exactly
+    backproj = np.zeros_like(data)
+    backproj[Hj, Hi] = np.sum(Hthets, axis=1)
+    bp=np.divide(backproj, np.amax(backproj))
+    if len(Hi) == 0:
+        return([np.array([]), np.array([]), np.array([]), bp])
+    return([Hi, Hj, Hthets, bp])
+# END MOD
 
 #-----------------------------------------------------------------------------------------
 # Interactive Functions
 #-----------------------------------------------------------------------------------------
 
 def rht(filepath, force=False, original=ORIGINAL, wlen=WLEN, frac=FRAC, 
-        smr=SMR, data=None):
+        smr=SMR, data=None, engine=ENGINE, workers=WORKERS, tile=TILE, 
+        backproj_only=False, roi=None, previous=None, encoding=ENCODING, 
+        progress=None, theta_range=None, stride=1, fill=FILL, key=None):
     """
     filepath: String path to source data, which will have the Rolling Hough
         Transform applied - if data is input (see below) then filepath is not
@@ -961,6 +2568,46 @@ def rht(filepath, force=False, original=ORIGINAL, wlen=WLEN, frac=FRAC,
         of the data
     
     BEGIN MOD
+    engine: Hough evaluation engine passed to window_step, 'loop', 'convolve',
+        'sparse' or 'bitpack'
+
+    workers: Number of processes for the tiled RHT; 1 runs serially
+
+    tile: Side length in pixels of each tile when workers > 1
+
+    backproj_only: Boolean, if only the (float32) backprojection is needed;
+        ipoints, jpoints and hthets are then returned as None
+
+    roi: (y0, y1, x0, x1) bounds of a changed region; only the windows it
+        can affect are recomputed (see roi_step)
+
+    previous: Result of rht() on the frame before the change in roi, whose
+        untouched entries are reused
+
+    encoding: None for float Hthets, or 'uint8', 'uint16' or 'topk' to
+        return them as compact EncodedThetas (see encode_thetas)
+
+    progress: Progress of this run, to subscribe callbacks to it or read its
+        counters of windows evaluated, significant windows and bytes spilled
+
+    theta_range: (center, halfwidth) in radians, to evaluate only the theta
+        bins within halfwidth of center (see theta_bins). center may be a
+        scalar or a per-pixel prior orientation map of the shape of data.
+        Angles are on the theta axis of Hthets; a theta_rht() angle a is
+        the bin angle pi - a. Hthets then hold only those bins, as 'topk'
+        EncodedThetas. Runs serially, so workers must be 1
+
+    stride: Evaluate only every stride-th row and column of windows, for a 
+        fast preview; the backprojection between them is filled in by
+        fill, 'nearest' or 'linear' (see fill_backproj)
+
+    key: store_key() of data and these parameters, if already computed, so
+        that data is not hashed again
+
+    If STORE is set, results are kept in that directory, keyed by a hash of
+    data and (wlen, smr, frac, original). Unless force is set, stored results
+    are returned memory-mapped instead of being recomputed.
+
     Returns
     -------
     results : list
@@ -989,21 +2636,57 @@ def rht(filepath, force=False, original=ORIGINAL, wlen=WLEN, frac=FRAC,
 
     try:
 
-        xyt_filename = xyt_name_factory(filepath, wlen=wlen, smr=smr, 
-                frac=frac, original=original)
-        
-        if (not force) and os.path.isfile(xyt_filename):
-            # If the program recognizes that the RHT has already been
-            # completed, it will not rerun.  This can overridden by setting
-            # the 'force' flag.
-            return True
-
-
         if data is None:
             print('1/4:: Retrieving Data from:', filepath)
             data = getData(filepath)
         else:
             print('1/4:: Getting Mask for Data')
+
+        # BEGIN MOD
+        if stride > 1 and roi is not None:
+            raise ValueError('roi does not support stride')
+        bins = None
+        if theta_range is not None:
+            if roi is not None:
+                raise ValueError('roi does not support theta_range')
+            bins = theta_bins(wlen, original, theta_range[0], theta_range[1])
+            if bins.shape[-1] == ntheta_w(wlen):
+                # Every angle is kept
+                bins = None
+            elif workers > 1:
+                raise ValueError('theta_range does not support workers > 1')
+
+        # Results are stored by the hash of the data and parameters, replacing the
+        # _xyt??.fits search of the original xyt_name_factory
+        xyt_filename = None
+        if roi is not None or STORE is None:
+            key = None
+        elif key is None:
+            key = store_key(data, wlen=wlen, smr=smr, frac=frac, original=original, 
+                    backproj_only=backproj_only, encoding=encoding, bins=bins, 
+                    stride=stride, fill=fill)
+        if key is not None and not force:
+            # If the program recognizes that the RHT has already been
+            # completed, it will not rerun.  This can overridden by setting
+            # the 'force' flag.
+            results = store_get(key)
+            if results is not None:
+                print('4/4:: Found Stored RHT Results')
+                return(results)
+
+        if roi is not None:
+            # Masks are only needed around the ROI, so skip the full-frame ones
+            message = '2/4:: Running RHT on ROI {}...'.format(tuple(roi))
+            results = roi_step(data=data, wlen=wlen, frac=frac, smr=smr, 
+                    original=original, roi=roi, previous=previous, 
+                    engine=engine, message=message, 
+                    progress=progress)
+            if len(results[0]):
+                results[2] = encode_thetas(results[2], encoding=encoding)
+            print('4/4:: Successfully Ran RHT')
+            return(results)
+        # END MOD
+
         smr_mask, wlen_mask = getMask(data, smr=smr, wlen=wlen)
         datay, datax = data.shape
 
@@ -1016,7 +2699,14 @@ def rht(filepath, force=False, original=ORIGINAL, wlen=WLEN, frac=FRAC,
         results = window_step(data=data, wlen=wlen, frac=frac, smr=smr, 
                 original=original, smr_mask=smr_mask, wlen_mask=wlen_mask, 
                 xyt_filename=xyt_filename, message=message, 
-                filepath = filepath)
+                filepath = filepath, engine=engine, workers=workers, tile=tile,
+                backproj_only=backproj_only, encoding=encoding, progress=progress, 
+                bins=bins, stride=stride, fill=fill)
+        if results[0] is not None and len(results[0]):
+            # The loop and tiled paths encode once they finish
+            results[2] = encode_thetas(results[2], encoding=encoding)
+        store_put(key, results, filepath, wlen=wlen, smr=smr, frac=frac, 
+                original=original, backproj_only=backproj_only)
 
         print('4/4:: Successfully Ran RHT')
         return(results)
@@ -1026,6 +2716,246 @@ def rht(filepath, force=False, original=ORIGINAL, wlen=WLEN, frac=FRAC,
         raise #__________________________________________________________________________________________________________ Raise
         return False
 
+# BEGIN MOD
+def rht_raw(filepath, original=ORIGINAL, wlen=WLEN, smr=SMR, data=None, 
+        engine='sparse', min_frac=RAW_MIN_FRAC, progress=None, roi=None, previous=None):
+    """
+    Like rht(), but returns the raw, unthresholded transform of raw_step.
+    Pass it to raw_frac() to get the rht() results for one or more frac
+    values without recomputing the Hough step.
+
+    filepath: String path to source data - if data is given, filepath is
+        not read
+
+    original: Boolean if one should use the original Rolling Hough Transform
+
+    wlen: Diameter of a 'window' to be evaluated at one time
+
+    smr: Integer radius of gaussian smoothing kernel to be applied to an data
+
+    data: Input data array (image) - alternative to giving filepath
+
+    engine: Batch Hough engine, 'convolve', 'sparse' or 'bitpack'
+
+    min_frac: Smallest frac that raw_frac() will be asked for, RAW_MIN_FRAC by default.
+        Lower values keep more windows, and 0 keeps every one
+
+    progress: Progress of this run (see rht)
+
+    roi: (y0, y1, x0, x1) bounds of a changed region; only the windows it
+        can affect are recomputed (see roi_step)
+
+    previous: rht_raw() result on the frame before the change in roi, with
+        the same parameters, whose untouched windows are reused
+
+    Returns
+    -------
+    raw : dict
+        See raw_step
+    """
+    if data is None:
+        print('1/3:: Retrieving Data from:', filepath)
+        data = getData(filepath)
+    else:
+        print('1/3:: Getting Mask for Data')
+
+    if roi is not None:
+        affected, (cy0, cx0), crop, smr_mask, wlen_mask = roi_region(data, wlen, smr, roi)
+        raw = raw_step(data=crop, wlen=wlen, smr=smr, original=original, 
+                smr_mask=smr_mask, wlen_mask=wlen_mask, engine=engine, 
+                min_frac=min_frac, message='2/3:: Running raw RHT on ROI {}...'.format(tuple(roi)), 
+                progress=progress)
+        raw['ipoints'] += cx0
+        raw['jpoints'] += cy0
+        raw['shape'] = data.shape
+        if previous is not None:
+            if (previous['shape'], previous['wlen'], previous['smr'], previous['original']) != \
+                    (data.shape, wlen, smr, original) or previous['min_frac'] > min_frac:
+                raise ValueError('previous must be a raw RHT of data of the same shape and parameters')
+            # Reuse every previous window outside the affected region
+            keep = outside(previous['jpoints'], previous['ipoints'], affected)
+            Hi = np.concatenate([raw['ipoints'], previous['ipoints'][keep]])
+            Hj = np.concatenate([raw['jpoints'], previous['jpoints'][keep]])
+            counts = np.concatenate([raw['counts'], previous['counts'][keep]])
+            order = np.lexsort((Hi, Hj))
+            raw['ipoints'], raw['jpoints'], raw['counts'] = Hi[order], Hj[order], counts[order]
+        print('3/3:: Successfully Ran raw RHT')
+        return raw
+
+    smr_mask, wlen_mask = getMask(data, smr=smr, wlen=wlen)
+
+    raw = raw_step(data=data, wlen=wlen, smr=smr, original=original, 
+            smr_mask=smr_mask, wlen_mask=wlen_mask, engine=engine, 
+            min_frac=min_frac, message='2/3:: Running raw RHT...', progress=progress)
+
+    print('3/3:: Successfully Ran raw RHT')
+    return raw
+# END MOD
+
+# BEGIN MOD
+def rht_multi(filepath, wlens, force=False, original=ORIGINAL, frac=FRAC, smr=SMR, 
+        data=None, engine='sparse', backproj_only=False, encoding=ENCODING, 
+        progress=None):
+    """
+    Like rht(), for several wlen on the same data, e.g. to find both short
+    and long structures. The data, smr_mask and unsharp mask are made once,
+    and all scales are evaluated in one pass over the image (see multi_step).
+
+    filepath: String path to source data - if data is given, filepath is
+        not read but is just used to label the stored results
+
+    wlens: Odd window diameters to evaluate
+
+    engine: Batch Hough engine, 'convolve', 'sparse' or 'bitpack'; 'loop'
+        runs as 'sparse', which gives identical results
+
+    The other arguments are as in rht(). Each scale is stored and looked up
+    in STORE as rht() would, so only the scales not found are computed.
+
+    Returns
+    -------
+    results : dict
+        The rht() results [ipoints, jpoints, hthets, bp] of each wlen
+    backproj : np.array
+        Per-pixel maximum of the normalized backprojections of all scales
+    """
+    assert frac == float(frac)
+    assert 0 <= frac <= 1
+    assert smr == int(smr)
+    assert smr > 0
+    wlens = sorted(set(int(w) for w in wlens))
+    assert len(wlens) > 0
+    for wlen in wlens:
+        assert wlen > 0
+        assert wlen%2
+
+    if data is None:
+        print('1/4:: Retrieving Data from:', filepath)
+        data = getData(filepath)
+    else:
+        print('1/4:: Getting Masks for Data')
+
+    results = {}
+    keys = {}
+    for wlen in wlens:
+        if STORE is None:
+            break
+        keys[wlen] = store_key(data, wlen=wlen, smr=smr, frac=frac, original=original, 
+                backproj_only=backproj_only, encoding=encoding)
+        if not force:
+            stored = store_get(keys[wlen])
+            if stored is not None:
+                results[wlen] = stored
+    missing = [w for w in wlens if w not in results]
+
+    if len(missing):
+        smr_mask, wlen_masks = getMasks(data, smr=smr, wlens=missing)
+        datay, datax = data.shape
+        print('2/4:: Size: {} x {}, Wlens: {}, Smr: {}, Frac: {}'.format(
+                datax, datay, missing, smr, frac))
+        computed = multi_step(data=data, wlens=missing, frac=frac, smr=smr, 
+                original=original, smr_mask=smr_mask, wlen_masks=wlen_masks, 
+                message='3/4:: Running multi-scale RHT...', 
+                engine='sparse' if engine == 'loop' else engine, 
+                backproj_only=backproj_only, encoding=encoding, progress=progress)
+        for wlen in missing:
+            store_put(keys.get(wlen), computed[wlen], filepath, wlen=wlen, smr=smr, 
+                    frac=frac, original=original, backproj_only=backproj_only)
+            results[wlen] = computed[wlen]
+        print('4/4:: Successfully Ran multi-scale RHT')
+    else:
+        print('4/4:: Found Stored RHT Results')
+
+    backproj = reduce(np.maximum, [np.asarray(results[w][3]) for w in wlens])
+    return results, backproj
+
+def rht_cube(cube, out=None, original=ORIGINAL, wlen=WLEN, frac=FRAC, smr=SMR, 
+        engine='sparse', workers=WORKERS, callback=None):
+    """
+    Runs the RHT on every frame of a (t, y, x) time series and returns the
+    per-frame backprojections. The kernel and h1 are computed once and
+    shared by all frames, and frames are streamed through a pool of worker
+    processes, so only a few frames are ever held in memory.
+
+    cube: (t, y, x) array, which may be memory-mapped, or the path to a
+        FITS file holding the cube in its first HDU
+
+    out: Where to write the backprojections - None for a new array, an
+        array (or memmap) of the same shape as cube, or the path of a .npy
+        or .fits file to create
+
+    original: Boolean if one should use the original Rolling Hough Transform
+
+    wlen: Diameter of a 'window' to be evaluated at one time
+
+    frac: Fraction in [0.0, 1.0] of pixels along one angle that must be 'lit
+        up' to be counted
+
+    smr: Integer radius of gaussian smoothing kernel to be applied to an data
+
+    engine: Hough evaluation engine passed to window_step
+
+    workers: Number of processes; 1 runs every frame in this process
+
+    callback: Called as callback(index, done, total) after frame index is
+        written, where done frames out of total are finished
+
+    Returns
+    -------
+    out : np.array, np.memmap or str
+        The backprojection cube, or the FITS filename it was written to
+    """
+    assert frac == float(frac)
+    assert 0 <= frac <= 1
+    assert wlen == int(wlen)
+    assert wlen > 0
+    assert wlen%2
+    assert smr == int(smr)
+    assert smr > 0
+
+    if isinstance(cube, str):
+        cube = fits.open(cube, memmap=True)[0].data
+    assert cube.ndim == 3
+    nframes = cube.shape[0]
+
+    # Shared setup, computed once for every frame
+    xyt = engine_thetas(engine, wlen=wlen, original=original)
+    h1 = kernel_h1(xyt)
+
+    target, write, close = cube_writer(out, cube.shape, wlen, smr, frac, original)
+    try:
+        if workers <= 1:
+            for index in range(nframes):
+                frame = np.asarray(cube[index])
+                write(index, frame_backproj(frame, xyt, h1, wlen, smr, frac, engine))
+                if callback is not None:
+                    callback(index, index+1, nframes)
+        else:
+            handles, specs = share_arrays(dict(kernel_arrays(xyt), h1=h1))
+            try:
+                with ProcessPoolExecutor(max_workers=workers, initializer=cube_init, 
+                        initargs=(specs,)) as pool:
+                    # Keep a bounded number of frames in flight, written back in order
+                    pending = deque()
+                    for index in range(nframes + 1):
+                        if index < nframes:
+                            task = (index, np.asarray(cube[index]), wlen, smr, frac, engine)
+                            pending.append(pool.submit(cube_step, task))
+                        while pending and (len(pending) > 2*workers or index == nframes):
+                            done, bp = pending.popleft().result()
+                            write(done, bp)
+                            if callback is not None:
+                                callback(done, done+1, nframes)
+            finally:
+                for shm in handles:
+                    shm.close()
+                    shm.unlink()
+    finally:
+        close()
+
+    return target
+# END MOD
+
 def interpret(filepath, force=False, wlen=WLEN, frac=FRAC, smr=SMR, original=ORIGINAL):
 
     '''
@@ -1179,12 +3109,131 @@ def interpret(filepath, force=False, wlen=WLEN, frac=FRAC, smr=SMR, original=ORI
     cleanup()
     return True
 
+# BEGIN MOD
+def batch_init(store):
+    # Worker initializer for batch: silences progress bars, which would interleave
+    # between processes, and uses the store of the parent process
+    global PROGRESS, STORE
+    PROGRESS = False
+    STORE = store
+
+def batch_step(task):
+    # Runs rht() on one file of a batch and returns its summary entry. Every error
+    # is caught and recorded, so that one bad file does not stop the others.
+    path, force, original, wlen, frac, smr, engine, data = task
+    entry = {'file': path, 'status': 'failed', 'seconds': 0.0}
+    start = time.time()
+    try:
+        if data is None:
+            data = getData(path)
+        if data is None:
+            raise ValueError('unreadable data')
+        # Hashed once, for both the check below and rht()
+        key = None
+        if STORE is not None:
+            key = store_key(data, wlen=wlen, smr=smr, frac=frac, original=original)
+            entry['key'] = key
+        if key is not None and not force and store_get(key) is not None:
+            # Done by an earlier run
+            entry['status'] = 'skipped'
+        else:
+            progress = Progress(display=False)
+            if rht(path, force=force, original=original, wlen=wlen, frac=frac, 
+                    smr=smr, data=data, engine=engine, progress=progress, key=key) is not False:
+                entry['status'] = 'passed'
+            entry['progress'] = progress.stats()
+    except Exception as e:
+        entry['error'] = '{}: {}'.format(type(e).__name__, e)
+    entry['seconds'] = time.time() - start
+    return entry
+
+def batch_store(pathlist):
+    # Default store of a batch: BATCH_STORE in the directory holding all of its files
+    directory = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in pathlist])
+    return os.path.join(directory, BATCH_STORE)
+
+def batch(pathlist, force=False, original=ORIGINAL, wlen=WLEN, frac=FRAC, smr=SMR, 
+        engine=ENGINE, workers=WORKERS, summary=None, data=None, store=None):
+    """
+    Runs rht() on every file of pathlist, in workers processes. Results are
+    kept in store, and unless force is set, files already in it are skipped
+    without being recomputed. A file that fails is recorded as such, and
+    the rest of the batch carries on. If a worker process dies, the files
+    it took down with the pool are retried one at a time, and only the
+    file that killed its worker is recorded as failed.
+
+    summary: Optional filename of a JSON summary of the batch, with the
+        parameters, total time and an entry per file
+
+    data: Data of a single file in pathlist, which is then not read
 
+    store: Directory of the results (see STORE). Defaults to STORE, or if
+        that is None, to a BATCH_STORE directory beside the files, so that
+        rerunning an interrupted batch resumes it
+
+    Returns
+    -------
+    entries : list
+        Per-file dicts of 'file', 'status' ('passed', 'skipped' or 'failed'),
+        'seconds', and where available 'key' (the STORE key), 'error' and
+        'progress' (Progress.stats() of the run), in pathlist order
+    """
+    global STORE
+    start = time.time()
+    if store is None:
+        store = STORE if STORE is not None or len(pathlist) == 0 else batch_store(pathlist)
+    tasks = [(path, force, original, wlen, frac, smr, engine, data) for path in pathlist]
+    if workers <= 1 or len(tasks) <= 1:
+        previous, STORE = STORE, store
+        try:
+            entries = [batch_step(task) for task in tasks]
+        finally:
+            STORE = previous
+    else:
+        entries = [None]*len(tasks)
+        pending = list(range(len(tasks)))
+        width = workers
+        while len(pending):
+            # Files lost when a worker died, which breaks the whole pool
+            lost = []
+            with ProcessPoolExecutor(max_workers=width, initializer=batch_init, 
+                    initargs=(store,)) as pool:
+                futures = [(n, pool.submit(batch_step, tasks[n])) for n in pending]
+                for n, future in futures:
+                    try:
+                        entries[n] = future.result()
+                    except BrokenProcessPool:
+                        lost.append(n)
+                    except Exception as e:
+                        entries[n] = {'file': pathlist[n], 'status': 'failed', 'seconds': 0.0, 
+                                'error': '{}: {}'.format(type(e).__name__, e)}
+            if len(lost) and width == 1:
+                # Run one at a time, the first file lost is the one that killed its
+                # worker, e.g. by running out of memory; the rest never started
+                entries[lost[0]] = {'file': pathlist[lost[0]], 'status': 'failed', 
+                        'seconds': 0.0, 'error': 'BrokenProcessPool: worker process died'}
+                lost = lost[1:]
+                width = workers
+            elif len(lost):
+                # Retry one at a time, to find the file at fault
+                width = 1
+            pending = lost
+
+    if summary is not None:
+        with open(summary, 'w') as f:
+            json.dump({'wlen': wlen, 'smr': smr, 'frac': frac, 'original': original, 
+                    'engine': engine, 'workers': workers, 'seconds': time.time() - start, 
+                    'files': entries}, f, indent=2)
+    return entries
+# END MOD
 
 def main(source=None, display=False, force=False, drht=False, wlen=WLEN, 
-        frac=FRAC, smr=SMR, data=None):
+        frac=FRAC, smr=SMR, data=None, workers=WORKERS, engine=ENGINE, summary=None):
     """
     source: A filename, or the name of a directory containing files to transform
+        BEGIN MOD
+        , or a list of them
+        END MOD
 
     display: Boolean flag determining if the input is to be interpreted and
         displayed
@@ -1199,6 +3248,14 @@ def main(source=None, display=False, force=False, drht=False, wlen=WLEN,
     
     smr: Integer radius of gaussian smoothing kernel to be applied to an data
 
+    BEGIN MOD
+    workers: Number of processes the files are spread over (see batch)
+
+    engine: Hough evaluation engine passed to rht()
+
+    summary: Optional filename of a JSON summary of the run (see batch)
+    END MOD
+
     return: Boolean, if the function succeeded
     """
 
@@ -1209,7 +3266,9 @@ def main(source=None, display=False, force=False, drht=False, wlen=WLEN,
         original = True
     
     # Ensure that the input is a non-None, non-Empty string
-    while source is None or type(source) != str or len(source)==0:
+    # BEGIN MOD
+    while source is None or (type(source) != str and type(source) != list) or len(source)==0:
+    # END MOD
         try:
             source = input('Source:')
         except:
@@ -1217,19 +3276,25 @@ def main(source=None, display=False, force=False, drht=False, wlen=WLEN,
     
     # Interpret whether the Input is a file or directory, excluding all else
     pathlist = []
-    if os.path.isfile(source):
-        # Input is a file.
-        pathlist.append(source)
-    elif os.path.isdir(source):
-        # Input is a directory. 
-        for obj in os.listdir(source):
-            obj_path = os.path.join(source, obj)
-            if os.path.isfile(obj_path):
-                pathlist.append(obj_path)
-    else:
-        # Input is neither a file nor a directory.
-        print('Invalid source encountered in main(); must be file or directory.')
-        return False
+    # BEGIN MOD
+    sources = [source] if type(source) == str else source
+    for source in sources:
+    # END MOD
+        if os.path.isfile(source):
+            # Input is a file.
+            pathlist.append(source)
+        elif os.path.isdir(source):
+            # Input is a directory. 
+            # BEGIN MOD
+            for obj in sorted(os.listdir(source)):
+            # END MOD
+                obj_path = os.path.join(source, obj)
+                if os.path.isfile(obj_path):
+                    pathlist.append(obj_path)
+        else:
+            # Input is neither a file nor a directory.
+            print('Invalid source encountered in main(); must be file or directory.')
+            return False
 
     pathlist = list(filter(is_valid_file, pathlist))
     if len(list(pathlist)) == 0:
@@ -1237,9 +3302,26 @@ def main(source=None, display=False, force=False, drht=False, wlen=WLEN,
         return False
 
     # Run RHT over all valid inputs. 
-    announce(['Fast Rolling Hough Transform by Susan Clark', 'Started for: '+source])
-
-    summary = [] #TODO__________________________________________________________________________________ batch progress bar
+    # BEGIN MOD
+    announce(['Fast Rolling Hough Transform by Susan Clark', 'Started for: '+', '.join(sources)])
+
+    if not display:
+        # Files are spread over workers processes, isolating failures
+        entries = batch(pathlist, force=force, original=original, wlen=wlen, frac=frac, 
+                smr=smr, engine=engine, workers=workers, summary=summary, data=data)
+        lines = []
+        for entry in entries:
+            line = '{}: {} ({:.1f}s)'.format(entry['file'], entry['status'].capitalize(), 
+                    entry['seconds'])
+            if 'error' in entry:
+                line += ' ' + entry['error']
+            lines.append(line)
+        lines.append('Complete!')
+        announce(lines)
+        return all(entry['status'] != 'failed' for entry in entries)
+
+    summary = []
+    # END MOD
 
     for path in pathlist:
         success = True
@@ -1273,6 +3355,9 @@ def main(source=None, display=False, force=False, drht=False, wlen=WLEN,
 # Command Line Mode
 #------------------------------------------------------------------------------
 def cli():
+    # BEGIN MOD
+    global STORE
+    # END MOD
     parser = ArgumentParser(description="Run Rolling Hough Transform on 1+ FITS files",
         usage='%(prog)s [options] file(s)',
         formatter_class=ArgumentDefaultsHelpFormatter)
@@ -1287,15 +3372,29 @@ def cli():
         help="Fraction (Threshold) of a given theta that must be 'lit up' to be counted")
     parser.add_argument('-d','--drht',action="store_true",
         help="Compute Directional RHT (full polar)")
+    # BEGIN MOD
+    parser.add_argument('-j','--workers',default=WORKERS,type=int,
+        help="Number of processes to spread the files over")
+    parser.add_argument('--summary',default=None,
+        help="Write a JSON summary of the run, with per-file timing, to this file")
+    parser.add_argument('--store',default=STORE,
+        help="Directory of stored results, reused and skipped on later runs; "
+        "defaults to a {} directory beside the files".format(BATCH_STORE))
+    # END MOD
     parser.add_argument('--version',action='version',version='%(prog)s 1.0')
 
     if len(sys.argv) == 1: # no arguments given, so add -h to get help msg
         sys.argv.append('-h')
     args = parser.parse_args()
 
-    for f in args.files: # loop over input files
-        main(source=f, force=args.force, wlen=args.wlen,
-            frac=args.thresh, smr=args.smr, drht=args.drht)
+    # BEGIN MOD
+    STORE = args.store
+
+    # All input files form one batch, so that they can run in parallel
+    main(source=args.files, force=args.force, wlen=args.wlen,
+        frac=args.thresh, smr=args.smr, drht=args.drht, 
+        workers=args.workers, summary=args.summary)
+    # END MOD
     sys.exit()
 
 if __name__ == "__main__":
@@ -9,13 +9,19 @@ scientific images.
 """
 
 from PySide6.QtGui import QPalette
-from PySide6.QtWidgets import (QComboBox, QFileDialog, QFormLayout, QGroupBox, QHBoxLayout, QLabel, QLineEdit, QPushButton, QVBoxLayout, QWidget)
+from PySide6.QtWidgets import (QApplication, QCheckBox, QComboBox, QFileDialog, QFormLayout, QGroupBox, QHBoxLayout, QLabel, QLineEdit, QProgressBar, QPushButton, QVBoxLayout, QWidget)
 from matplotlib import (colors, pyplot)
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg
 from astropy.io import fits
 from preprocessing import processing
+from preprocessing.rht import rht
 from helper.widgets import MPLImage
 
+# Constants
+PREVIEW_STRIDE = 4
+# Engine of the preview, whose work shrinks with the stride
+PREVIEW_ENGINE = "bitpack"
+
 class PreprocessWidget(QWidget):
     def __init__(self):
         """
@@ -39,10 +45,10 @@ class PreprocessWidget(QWidget):
         imgLayout.addWidget(self.procimg)
 
         # Add a controls area
-        controlsBox = QGroupBox("Controls")
+        self.controlsBox = QGroupBox("Controls")
         controlsLayout = QHBoxLayout()
-        controlsBox.setLayout(controlsLayout)
-        layout.addWidget(controlsBox)
+        self.controlsBox.setLayout(controlsLayout)
+        layout.addWidget(self.controlsBox)
 
         # Add an 'open image' button
         openButton = QPushButton("Open image")
@@ -165,8 +171,18 @@ class PreprocessWidget(QWidget):
         }
         params = self.options[self.currentOpt].get_params()
 
-        # Run the associated processing function
-        self.img_alt = opt_fn[self.currentOpt](self.img_alt, params)
+        # The RHT processes events while it runs to show its progress, so
+        # lock the controls until it is done to keep it from being re-entered
+        self.controlsBox.setEnabled(False)
+        try:
+            # Run the associated processing function
+            if self.currentOpt == "Rolling hough transform":
+                # The RHT box reuses its raw transform when only FRAC changes
+                self.img_alt = self.options[self.currentOpt].process(self.img_alt, params)
+            else:
+                self.img_alt = opt_fn[self.currentOpt](self.img_alt, params)
+        finally:
+            self.controlsBox.setEnabled(True)
 
         # set the image
         self.procimg.set_image(self.img_alt)
@@ -272,6 +288,18 @@ class PreprocessWidget(QWidget):
             """
             super().__init__()
 
+            # Raw transform of the last input, reused when only FRAC changes
+            self.raw = None
+            self.raw_params = None
+            self.raw_input = None
+            self.raw_output = None
+            # Parameters that made raw_output
+            self.output_params = None
+
+            # Last coarse-grid preview and its input
+            self.preview_input = None
+            self.preview_output = None
+
             # Set layout
             layout = QFormLayout(self)
 
@@ -283,11 +311,29 @@ class PreprocessWidget(QWidget):
             self.smrEdit.setPlaceholderText("4")
             self.fracEdit = QLineEdit()
             self.fracEdit.setPlaceholderText("0.7")
+            self.centerEdit = QLineEdit()
+            self.centerEdit.setPlaceholderText("All angles")
+            self.centerEdit.setToolTip("Fibril orientation to keep, in degrees (0-180), as theta_rht reports it. Leave blank for all angles.")
+            self.rangeEdit = QLineEdit()
+            self.rangeEdit.setPlaceholderText("All angles")
+            self.rangeEdit.setToolTip("Keep orientations within this many degrees of the center.")
             
+            self.previewBox = QCheckBox()
+            self.previewBox.setToolTip("Evaluate every {}th pixel only, for a fast preview.".format(PREVIEW_STRIDE))
+
+            # Progress of the running transform
+            self.progressBar = QProgressBar()
+            self.progressBar.setRange(0, 1000)
+            self.progressBar.setValue(0)
+
             # Add params to layout
             layout.insertRow(0, "Min. length:", self.wlenEdit)
             layout.insertRow(1, "Smoothing radius:", self.smrEdit)
             layout.insertRow(2, "Int. threshold:", self.fracEdit)
+            layout.insertRow(3, "Orientation (deg):", self.centerEdit)
+            layout.insertRow(4, "Orientation \u00b1 (deg):", self.rangeEdit)
+            layout.insertRow(5, "Preview:", self.previewBox)
+            layout.insertRow(6, "Progress:", self.progressBar)
 
         def get_params(self):
             """
@@ -305,9 +351,92 @@ class PreprocessWidget(QWidget):
             wlen = int(self.wlenEdit.text())
             smr = int(self.smrEdit.text())
             frac = float(self.fracEdit.text())
+            # Blank orientation fields keep every angle
+            center = float(self.centerEdit.text()) if len(self.centerEdit.text()) > 0 else None
+            halfwidth = float(self.rangeEdit.text()) if len(self.rangeEdit.text()) > 0 else None
 
             return([
                 wlen,
                 smr,
-                frac
-                ])
\ No newline at end of file
+                frac,
+                center,
+                halfwidth
+                ])
+
+        def process(self, img_data, params):
+            """
+            Run the RHT on the image. The raw transform is kept, so
+            re-running with only a new FRAC (down to rht.RAW_MIN_FRAC)
+            is near-instant, and an edited image only recomputes the 
+            windows around the edits. In preview mode, only a coarse 
+            grid of windows is evaluated.
+
+            Parameters
+            ----------
+            img_data : ndarray
+            params : list
+                Output of get_params().
+
+            Returns
+            -------
+            data : ndarray
+                Backprojection of the RHT.
+            """
+            wlen, smr, frac = params[:3]
+
+            # Processing our own preview again replaces it, so previews
+            # and the full run all start from the same image.
+            if img_data is self.preview_output:
+                img_data = self.preview_input
+            if self.previewBox.isChecked():
+                progress = rht.Progress(display=False, callbacks=[self.show_progress])
+                self.preview_output = processing.rolling_hough_transform(img_data, params, 
+                        engine=PREVIEW_ENGINE, progress=progress, stride=PREVIEW_STRIDE)
+                self.preview_input = img_data
+                return(self.preview_output)
+
+            # Processing our own output again with a new FRAC or orientation
+            # means the threshold is being tuned, so apply it to the image we
+            # transformed last. With the same parameters, the output itself
+            # is transformed.
+            if (img_data is self.raw_output and self.raw_params == (wlen, smr) 
+                    and params != self.output_params):
+                img_data = self.raw_input
+            # The raw transform keeps only windows that can pass rht.RAW_MIN_FRAC,
+            # so a lower FRAC needs it again down to that FRAC
+            if (self.raw_params != (wlen, smr) or self.raw_input is None 
+                    or self.raw_input.shape != img_data.shape 
+                    or frac < self.raw["min_frac"]):
+                progress = rht.Progress(display=False, callbacks=[self.show_progress])
+                self.raw = processing.rht_raw(img_data, params, progress=progress, 
+                        min_frac=min(frac, rht.RAW_MIN_FRAC))
+            elif img_data is not self.raw_input:
+                # The raw transform belongs to the contents of raw_input, so an
+                # edited image only needs the windows around its changes again
+                roi = processing.changed_region(self.raw_input, img_data)
+                if roi is not None:
+                    progress = rht.Progress(display=False, callbacks=[self.show_progress])
+                    self.raw = processing.rht_raw(img_data, params, progress=progress, 
+                            min_frac=self.raw["min_frac"], roi=roi, previous=self.raw)
+            self.raw_params = (wlen, smr)
+            self.raw_input = img_data
+
+            self.raw_output = processing.rolling_hough_transform(img_data, params, raw=self.raw)
+            self.output_params = list(params)
+            return(self.raw_output)
+
+        def show_progress(self, progress):
+            """
+            Progress callback of the RHT, called at most a few
+            times per second while it runs.
+
+            Parameters
+            ----------
+            progress : rht.Progress
+            """
+            self.progressBar.setValue(int(1000*progress.fraction))
+            self.progressBar.setFormat("{:.0f}% ({} significant px)".format(
+                100*progress.fraction, progress.significant))
+            # The transform runs on the GUI thread, so keep it responsive;
+            # the controls are disabled meanwhile (see process)
+            QApplication.processEvents()
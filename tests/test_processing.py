@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("cv2")
+
+from preprocessing import processing
+
+@pytest.fixture
+def framed():
+    """
+    Image with a NaN border, like a rotated or cropped frame.
+    """
+    data = np.random.default_rng(0).random((64, 64))
+    data[:5] = np.nan
+    data[:, -7:] = np.nan
+    return(data)
+
+def test_changed_region_ignores_shared_nans(framed):
+    assert processing.changed_region(framed, framed.copy()) is None
+
+    edited = framed.copy()
+    edited[20:24, 30:33] = 0
+    assert processing.changed_region(framed, edited) == (20, 24, 30, 33)
+
+def test_changed_region_counts_new_nans(framed):
+    edited = framed.copy()
+    edited[40, 10] = np.nan
+    assert processing.changed_region(framed, edited) == (40, 41, 10, 11)
+
+def test_raw_below_min_frac_runs_in_full():
+    data = np.random.default_rng(1).random((48, 48))
+    params = [15, 3, 0.3, None, None]
+    raw = processing.rht_raw(data, params)
+    np.testing.assert_array_equal(
+            processing.rolling_hough_transform(data, params, raw=raw),
+            processing.rolling_hough_transform(data, params))
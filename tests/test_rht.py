@@ -0,0 +1,279 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from preprocessing.rht import rht, RHT_tools
+
+WLEN = 15
+SMR = 3
+FRAC = 0.7
+
+@pytest.fixture(autouse=True)
+def no_caches(monkeypatch, tmp_path):
+    """
+    Keep kernels and results out of the shared temporary directory.
+    """
+    monkeypatch.setattr(rht, "KERNEL_CACHE", str(tmp_path / "kernels"))
+    monkeypatch.setattr(rht, "STORE", None)
+
+@pytest.fixture
+def image():
+    """
+    Noisy image with a few straight fibrils at different angles.
+    """
+    rng = np.random.default_rng(0)
+    data = rng.random((96, 96))
+    yy, xx = np.mgrid[:96, :96]
+    for angle, offset in [(0.3, 10.0), (1.2, -20.0), (2.4, 40.0)]:
+        distance = np.abs(np.cos(angle) * yy - np.sin(angle) * xx - offset)
+        data += 4 * np.exp(-distance**2 / 2.0)
+    return(data)
+
+def run(data, **kwargs):
+    return(rht.rht('', data=data, wlen=WLEN, smr=SMR, frac=FRAC, **kwargs))
+
+def assert_same(a, b):
+    for x, y in zip(a, b):
+        np.testing.assert_array_equal(np.asarray(x), np.asarray(y))
+
+@pytest.mark.parametrize("engine", ["convolve", "sparse", "bitpack"])
+def test_engines_match_loop(image, engine):
+    assert_same(run(image, engine=engine), run(image, engine="loop"))
+
+@pytest.mark.parametrize("engine", ["loop", "sparse"])
+@pytest.mark.parametrize("backproj_only", [False, True])
+def test_tiled_matches_serial(image, engine, backproj_only):
+    tiled = run(image, engine=engine, workers=2, tile=32, backproj_only=backproj_only)
+    assert_same(tiled, run(image, engine=engine, backproj_only=backproj_only))
+
+@pytest.mark.parametrize("original", [True, False])
+@pytest.mark.parametrize("wlen", [5, 15, 31])
+def test_geometry_thetas_match_dense_kernel(wlen, original):
+    dense = rht.sparse_thetas(rht.cached_thetas(wlen, original))
+    for kernel in (rht.geometry_thetas(wlen, original), rht.cached_sparse_thetas(wlen, original)):
+        assert kernel.wlen == dense.wlen
+        for x, y in zip(kernel[1:], dense[1:]):
+            np.testing.assert_array_equal(x, y)
+
+    # A second process finds the kernel on disk
+    rht._kernel_lru.clear()
+    np.testing.assert_array_equal(rht.cached_sparse_thetas(wlen, original).dy, dense.dy)
+
+def test_stride_one_is_default(image):
+    assert_same(run(image, engine="sparse", stride=1), run(image, engine="sparse"))
+
+@pytest.mark.parametrize("engine", ["convolve", "sparse", "bitpack"])
+def test_stride_evaluates_grid_windows(image, engine):
+    full = run(image, engine=engine)
+    coarse = run(image, engine=engine, stride=4)
+    assert np.all(coarse[0] % 4 == 0) and np.all(coarse[1] % 4 == 0)
+    rows = {(j, i): k for k, (i, j) in enumerate(zip(full[0], full[1]))}
+    on_grid = [rows[(j, i)] for i, j in zip(coarse[0], coarse[1])]
+    np.testing.assert_array_equal(coarse[2], full[2][on_grid])
+
+def test_nearest_fill_uses_valid_grid_points():
+    # Every evaluated grid point holds 1, and the mask edges fall between grid points
+    stride = 4
+    wlen_mask = np.zeros((40, 40), bool)
+    wlen_mask[5:34, 5:31] = True
+    bp = np.zeros((40, 40))
+    bp[::stride, ::stride] = wlen_mask[::stride, ::stride]
+    out = rht.fill_backproj(bp, wlen_mask, stride, fill="nearest")
+    np.testing.assert_array_equal(out, wlen_mask)
+
+def test_theta_range_restricts(image):
+    full = run(image, engine="sparse")
+    restricted = run(image, engine="sparse", theta_range=(np.pi / 4, np.pi / 16))
+    bins = rht.theta_bins(WLEN, True, np.pi / 4, np.pi / 16)
+    others = np.setdiff1d(np.arange(rht.ntheta_w(WLEN)), bins)
+    spectra = np.asarray(restricted[2])
+    assert len(spectra) and not np.any(spectra[:, others])
+
+    # Kept bins hold the same power as in the full transform
+    rows = {(j, i): k for k, (i, j) in enumerate(zip(full[0], full[1]))}
+    lit = [rows[(j, i)] for i, j in zip(restricted[0], restricted[1])]
+    np.testing.assert_array_equal(spectra[:, bins], full[2][lit][:, bins])
+    assert len(restricted[0]) < len(full[0])
+    assert not np.array_equal(restricted[3], full[3])
+
+@pytest.mark.parametrize("engine", ["loop", "sparse"])
+def test_theta_range_prior_map(image, engine):
+    full = run(image, engine="sparse")
+    yy, xx = np.mgrid[:96, :96]
+    prior = np.arctan2(yy - 48, xx - 48) % np.pi
+    restricted = run(image, engine=engine, theta_range=(prior, np.pi / 16))
+    bins = rht.theta_bins(WLEN, True, prior, np.pi / 16)
+    spectra = np.asarray(restricted[2])
+    assert len(spectra)
+
+    # Each window holds the full transform's power in its own bins, and nothing else
+    rows = {(j, i): k for k, (i, j) in enumerate(zip(full[0], full[1]))}
+    for row, i, j in zip(spectra, restricted[0], restricted[1]):
+        kept = np.zeros(len(row), bool)
+        kept[bins[j, i]] = True
+        assert not np.any(row[~kept])
+        np.testing.assert_array_equal(row[kept], full[2][rows[(j, i)]][kept])
+
+    # A uniform map matches the scalar center
+    uniform = run(image, engine=engine, theta_range=(np.full((96, 96), np.pi / 4), np.pi / 16))
+    assert_same(uniform[:2], run(image, engine=engine, theta_range=(np.pi / 4, np.pi / 16))[:2])
+
+def test_theta_range_rejects_workers(image):
+    with pytest.raises(ValueError):
+        run(image, engine="sparse", theta_range=(np.pi / 4, np.pi / 16), workers=2)
+
+@pytest.mark.parametrize("engine", ["loop", "sparse"])
+def test_roi_matches_full_run(image, engine):
+    edited = image.copy()
+    edited[40:50, 30:45] = 0
+    roi = (40, 50, 30, 45)
+    previous = run(image, engine="sparse")
+    assert_same(run(edited, engine=engine, roi=roi, previous=previous), run(edited, engine="sparse"))
+
+    raw = rht.rht_raw("", data=edited, wlen=WLEN, smr=SMR, roi=roi, 
+            previous=rht.rht_raw("", data=image, wlen=WLEN, smr=SMR))
+    assert_same(rht.raw_frac(raw, FRAC), run(edited, engine="sparse"))
+
+def test_raw_keeps_windows_above_min_frac(image):
+    every = rht.rht_raw("", data=image, wlen=WLEN, smr=SMR, min_frac=0.0)
+    raw = rht.rht_raw("", data=image, wlen=WLEN, smr=SMR)
+    assert raw["min_frac"] == rht.RAW_MIN_FRAC
+    assert len(raw["counts"]) < len(every["counts"])
+    for frac in (rht.RAW_MIN_FRAC, 0.9):
+        assert_same(rht.raw_frac(raw, frac), rht.raw_frac(every, frac))
+    with pytest.raises(AssertionError):
+        rht.raw_frac(raw, rht.RAW_MIN_FRAC - 0.1)
+
+def test_roi_rejects_backproj_only_previous(image):
+    previous = run(image, engine="sparse", backproj_only=True)
+    with pytest.raises(ValueError):
+        run(image, engine="sparse", roi=(40, 50, 30, 45), previous=previous)
+
+@pytest.mark.parametrize("encoding", ["uint8", "uint16"])
+def test_quantized_thetas_round_trip(image, encoding):
+    hthets = run(image, engine="sparse")[2]
+    encoded = rht.encode_thetas(hthets, encoding=encoding)
+    assert encoded.shape == hthets.shape
+    assert encoded.nbytes < hthets.nbytes
+    step = np.amax(hthets, axis=1, keepdims=True) / np.iinfo(encoding).max
+    assert np.all(np.abs(encoded[:] - hthets) <= step/2 + 1e-6)
+    np.testing.assert_allclose(np.amax(encoded[:], axis=1), np.amax(hthets, axis=1), rtol=1e-6)
+
+def test_topk_thetas_keep_strongest_angles(image):
+    full = run(image, engine="sparse")
+    encoded = run(image, engine="sparse", encoding="topk")
+    assert isinstance(encoded[2], rht.EncodedThetas)
+    assert_same(encoded[:2] + encoded[3:], full[:2] + full[3:])
+
+    hthets = full[2].astype(np.float32)
+    decoded = encoded[2][:]
+    assert np.all(np.count_nonzero(decoded, axis=1) <= rht.TOPK)
+    kth = -np.sort(-hthets, axis=1)[:, rht.TOPK-1:rht.TOPK]
+    strong = hthets > kth
+    np.testing.assert_array_equal(decoded[strong], hthets[strong])
+    np.testing.assert_array_equal(decoded[decoded > 0], hthets[decoded > 0])
+
+def test_qu_maps_match_per_point(image):
+    ipoints, jpoints, hthets, _ = run(image, engine="sparse")
+    thets = RHT_tools.get_thets(WLEN, save=False)
+    hthets[0] = 0
+    maps = RHT_tools.get_QU_RHT_maps(ipoints, jpoints, hthets, image.shape[1], image.shape[0], 
+            thets, chunk=100)
+
+    expected = np.zeros((6,) + image.shape)
+    expected[5] = np.nan
+    for i, j, h in zip(ipoints, jpoints, hthets):
+        qu = RHT_tools.get_QU_RHT_unnorm(h, thets, sqerror=True)
+        expected[:4, j, i] = [np.nan if x is None else x for x in qu]
+        expected[4, j, i] = np.sum(h)
+        expected[5, j, i] = rht.theta_rht(h, original=True)
+    assert np.isnan(maps[0][jpoints[0], ipoints[0]])
+    for got, want in zip(maps[:5], expected[:5]):
+        np.testing.assert_allclose(got, want, rtol=1e-12, atol=1e-12)
+    # The angle is only defined where Q and U are not lost to rounding
+    q, u, _, _, intensity = expected[:5, jpoints, ipoints]
+    defined = np.hypot(q, u) > 1e-9*intensity
+    np.testing.assert_allclose(maps[5][jpoints, ipoints][defined], 
+            expected[5][jpoints, ipoints][defined], rtol=1e-12)
+
+    # Encoded spectra give the maps of their decoded rows
+    encoded = rht.encode_thetas(hthets, encoding="uint16")
+    for got, want in zip(RHT_tools.get_QU_RHT_maps(ipoints, jpoints, encoded, image.shape[1], 
+            image.shape[0], thets, chunk=100), RHT_tools.get_QU_RHT_maps(ipoints, jpoints, 
+            encoded[:], image.shape[1], image.shape[0], thets)):
+        np.testing.assert_array_equal(got, want)
+
+def test_buffershape_uses_row_dtype():
+    assert rht.buffershape(10, filesize=800, dtype=np.float64) == (10, 10)
+    assert rht.buffershape(10, filesize=800, dtype=np.float32) == (20, 10)
+
+@pytest.mark.parametrize("engine", ["loop", "convolve", "sparse", "bitpack"])
+def test_spilled_hthets_match_memory(image, engine, monkeypatch, tmp_path):
+    expected = run(image, engine="sparse")
+    monkeypatch.setattr(rht, "buffershape", lambda ntheta, **kw: (16, ntheta))
+    monkeypatch.setattr(rht.tempfile, "tempdir", str(tmp_path))
+    spilled = run(image, engine=engine)
+    assert isinstance(spilled[2], np.memmap)
+    assert spilled[2].dtype == expected[2].dtype
+    assert_same(spilled, expected)
+
+    # A failed run leaves no spill file behind
+    def fail(progress):
+        if progress.significant > 64:
+            raise RuntimeError
+    progress = rht.Progress(display=False, callbacks=[fail], interval=0)
+    with pytest.raises(RuntimeError):
+        run(image, engine=engine, progress=progress)
+    assert not list(tmp_path.glob("rht*.dat"))
+
+@pytest.mark.parametrize("backproj_only", [False, True])
+def test_multi_matches_single_scales(image, backproj_only):
+    results, backproj = rht.rht_multi("", [15, 9, 15], data=image, smr=SMR, frac=FRAC, 
+            backproj_only=backproj_only)
+    assert sorted(results) == [9, 15]
+    for wlen, result in results.items():
+        assert_same(result, rht.rht("", data=image, wlen=wlen, smr=SMR, frac=FRAC, 
+                engine="sparse", backproj_only=backproj_only))
+    np.testing.assert_array_equal(backproj, np.maximum(results[9][3], results[15][3]))
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_cube_matches_frames(image, workers, tmp_path):
+    cube = np.stack([image, image.T, image[::-1]])
+    calls = []
+    out = rht.rht_cube(cube, out=str(tmp_path / "cube.npy"), wlen=WLEN, smr=SMR, frac=FRAC, 
+            workers=workers, callback=lambda *args: calls.append(args))
+    assert isinstance(out, np.memmap)
+    for index, frame in enumerate(cube):
+        np.testing.assert_array_equal(out[index], run(frame, backproj_only=True)[-1])
+    assert calls == [(0, 1, 3), (1, 2, 3), (2, 3, 3)]
+    np.testing.assert_array_equal(np.load(tmp_path / "cube.npy"), out)
+
+def test_store_round_trip_and_eviction(image, monkeypatch, tmp_path):
+    store = tmp_path / "store"
+    monkeypatch.setattr(rht, "STORE", str(store))
+    first = run(image, engine="sparse")
+    assert len(list(store.glob("*.json"))) == 1
+    assert_same(run(image, engine="sparse"), first)
+
+    # A second result over the size bound evicts the least recently used one
+    size = sum(f.stat().st_size for f in store.iterdir())
+    monkeypatch.setattr(rht, "STORE_BYTES", size + size // 2)
+    run(image[::-1], engine="sparse")
+    entries = list(store.glob("*.json"))
+    assert len(entries) == 1
+    assert rht.store_get(entries[0].stem) is not None
+    assert all(f.name.startswith(entries[0].stem) for f in store.iterdir())
+
+def test_batch_resumes_from_default_store(image, tmp_path):
+    paths = []
+    for n, data in enumerate([image, image[::-1]]):
+        paths.append(str(tmp_path / "frame{}.fits".format(n)))
+        fits.writeto(paths[-1], data)
+    kwargs = dict(wlen=WLEN, smr=SMR, frac=FRAC, engine="sparse")
+
+    # An interrupted batch, which only got through the first file
+    assert [e["status"] for e in rht.batch(paths[:1], **kwargs)] == ["passed"]
+    assert (tmp_path / rht.BATCH_STORE).is_dir()
+    assert [e["status"] for e in rht.batch(paths, workers=2, **kwargs)] == ["skipped", "passed"]
+    assert [e["status"] for e in rht.batch(paths, **kwargs)] == ["skipped", "skipped"]
+    assert [e["status"] for e in rht.batch(paths, force=True, **kwargs)] == ["passed", "passed"]
@@ -0,0 +1,130 @@
+import os
+
+import numpy as np
+import pytest
+import scipy.spatial
+import sunkit_image.trace
+from astropy.io import fits
+
+from tracing import tracing
+
+IMAGE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                     "data", "images", "fits", "caii", "caii-1718.fits")
+
+@pytest.fixture(scope="module")
+def crop():
+    """
+    Small crop of a Ca II frame with plenty of fibrils.
+    """
+    return(fits.getdata(IMAGE)[:240, :240])
+
+def line(x0, x1, y=20.0):
+    """
+    Straight horizontal trace with unit spacing, as an (n, 2) array of [x, y].
+    """
+    x = np.arange(x0, x1 + 1, dtype=np.float64)
+    return(np.column_stack([x, np.full_like(x, y)]))
+
+def test_stitch_tiles_joins_across_seam():
+    # Tiles meet at x = 64 and overlap by 8 pixels; each holds its part of one fibril
+    left = [line(5, 70)]
+    right = [line(58, 120)]
+    features = tracing.stitch_tiles([left, right], lmin=10)
+    assert len(features) == 1
+    points = np.asarray(features[0])
+    assert points[:, 0].min() == 5 and points[:, 0].max() == 120
+    # One pass along the fibril, with at most a trimmed gap at the seam
+    steps = np.diff(points[:, 0])
+    assert np.all(steps > 0) and steps.max() <= tracing.JOIN_DIST
+
+def test_stitch_tiles_drops_duplicates():
+    trace = line(60, 100)
+    features = tracing.stitch_tiles([[trace], [trace + [0.5, 0.5]]], lmin=10)
+    assert len(features) == 1
+    assert len(features[0]) == len(trace)
+
+def test_stitch_tiles_keeps_separate_traces():
+    features = tracing.stitch_tiles([[line(5, 60, y=10)], [line(70, 120, y=40)]], lmin=10)
+    assert len(features) == 2
+
+def test_stitch_tiles_drops_short_leftovers():
+    # A trace of another tile that starts along this one and then turns away
+    # keeps 9 of its 12 points once trimmed
+    turn = np.concatenate([line(58, 60, y=21), np.column_stack([np.full(9, 60.0), np.arange(24.0, 33.0)])])
+    features = tracing.stitch_tiles([[line(5, 60)], [turn]], lmin=10)
+    assert len(features) == 1
+    assert len(features[0]) == 56
+
+def test_stitch_tiles_passes_single_tile(crop):
+    features = tracing.AutoTracingOCCULT(data=crop).run()
+    assert tracing.stitch_tiles([features], lmin=35) == features
+
+def test_run_tiled_matches_run():
+    # With nstruc uncapped, tracing runs out of structures in every tile
+    at = tracing.AutoTracingOCCULT(data=fits.getdata(IMAGE))
+    features = at.run(nstruc=100000)
+    tiled = at.run_tiled(nstruc=100000, workers=2)
+    assert abs(len(tiled) - len(features)) <= 0.05 * len(features)
+    points = np.concatenate([np.asarray(f) for f in features])
+    tiled_points = np.concatenate([np.asarray(f) for f in tiled])
+    for a, b in [(points, tiled_points), (tiled_points, points)]:
+        dist, _ = scipy.spatial.cKDTree(a).query(b)
+        assert np.mean(dist <= 2) >= 0.95
+
+@pytest.mark.parametrize("engine", ["native", "sunkit"])
+def test_engines_match_occult2(crop, engine):
+    params = (4, 45, 35, 2000, 1, 0.0, 3.0)
+    expected = sunkit_image.trace.occult2(crop, *params)
+    features = tracing.AutoTracingOCCULT(data=crop).run(*params, engine=engine)
+    assert len(features) == len(expected)
+    for feature, loop in zip(features, expected):
+        np.testing.assert_array_equal(np.asarray(feature), np.asarray(loop))
+
+def test_trace_cache_round_trip(crop, tmp_path):
+    cache = tracing.TraceCache(str(tmp_path))
+    at = tracing.AutoTracingOCCULT(data=crop, cache=cache)
+    features = at.run()
+    assert (cache.hits, cache.misses) == (0, 1)
+    assert at.run() == features
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # A new process finds the traces on disk
+    cache = tracing.TraceCache(str(tmp_path))
+    assert tracing.AutoTracingOCCULT(data=crop, cache=cache).run() == features
+    assert (cache.hits, cache.misses) == (1, 0)
+
+    # Other parameters, or a changed image, are traced again
+    at = tracing.AutoTracingOCCULT(data=crop.copy(), cache=cache)
+    at.run(lmin=50)
+    at.img_data[:20] = 0
+    at.run()
+    assert (cache.hits, cache.misses) == (1, 2)
+
+def test_trace_cache_evicts_least_recently_used(tmp_path):
+    features = [line(0, 200).tolist()]
+    size = len(tracing._pack_traces(features))
+    cache = tracing.TraceCache(str(tmp_path), max_bytes=2 * size, memory_bytes=2 * size)
+    for key in ["a", "b"]:
+        cache.put(key, features)
+    # Written long ago, a before b
+    os.utime(cache.filename("a"), ns=(0, 0))
+    os.utime(cache.filename("b"), ns=(1, 1))
+    assert cache.get("a") == features
+    cache.put("c", features)
+
+    # b was used least recently, both in memory and on disk
+    assert list(cache.memory) == ["a", "c"]
+    assert sorted(os.listdir(str(tmp_path))) == ["a.trc", "c.trc"]
+    assert tracing.TraceCache(str(tmp_path)).get("b") is None
+
+def test_sweep_reuses_cached_traces(crop, tmp_path):
+    cache = tracing.TraceCache(str(tmp_path))
+    with tracing.OCCULTSweep(crop, lmin=[35, 40], workers=2, cache=cache) as sweep:
+        first = dict(sweep.results())
+    assert len(first) == 2 and len(cache) == 2
+
+    # Everything is cached, so no pool is started
+    sweep = tracing.OCCULTSweep(crop, lmin=[35, 40], cache=cache).start()
+    assert sweep.pool is None and sweep.done
+    assert dict(sweep.poll()) == first
+    assert first[tracing.sweep_key(4, 45, 35, 2000, 1, 0.0, 3.0)] == tracing.AutoTracingOCCULT(data=crop).run()
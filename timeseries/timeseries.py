@@ -57,7 +57,7 @@ class Timeseries():
             print("Tracing frame {}".format(frame_num))
 
             # Set up an autotracing instance
-            at = AutoTracingOCCULT(data=self.full_image[frame_num,:,:])
+            at = AutoTracingOCCULT(data=self.full_image[frame_num,:,:], cache=True)
 
             # Run it
             tracings = at.run()
@@ -9,17 +9,773 @@ Created on Mon 6.5.22
 """
 
 import csv
+import hashlib
+import io
+import itertools
+import json
 import os
+import tempfile
+import warnings
+import numpy as np
+import scipy.interpolate
+import scipy.spatial
 import sunkit_image.trace
 from astropy.io import fits
+from collections import OrderedDict
+from concurrent.futures import (ProcessPoolExecutor, as_completed)
+from multiprocessing import (shared_memory, util)
 from PySide6.QtGui import (QAction, QIcon)
 from PySide6.QtWidgets import (QApplication, QFileDialog, QMainWindow, QToolBar)
 
+# Number of intermediate arrays kept per OCCULT-2 stage
+STAGE_CACHE = 8
+
+# OCCULT-2 implementation used by AutoTracingOCCULT.run(), "native" or "sunkit"
+ENGINE = "native"
+
+# Rows of the image smoothed at once by the native engine
+SMOOTH_ROWS = 256
+
+# Tiled tracing: tile side and minimum overlap with neighbouring tiles, in pixels
+TILE = 512
+TILE_OVERLAP = 64
+
+# Tiled tracing: traces mostly within DUP_DIST pixels of a trace from another tile
+# (by a fraction DUP_FRAC of their points) are duplicates. Ends within JOIN_DIST
+# pixels, facing each other within JOIN_ANGLE degrees, are joined across seams.
+DUP_DIST = 2.0
+DUP_FRAC = 0.8
+JOIN_DIST = 6.0
+JOIN_ANGLE = 30.0
+
+# Directory of the on-disk cache of AutoTracingOCCULT.run() traces, shared by repeated
+# runs and processes, such as os.path.join(tempfile.gettempdir(), "occult_traces").
+# None (the default) keeps traces in memory only.
+TRACE_CACHE = None
+
+# Version of the trace cache. Bump whenever the traces of OCCULT-2 change.
+TRACE_CACHE_VERSION = 1
+
+# Size bounds of the trace cache on disk and in memory, in bytes
+TRACE_CACHE_BYTES = int(2.5e8)
+TRACE_MEMORY_BYTES = int(6.4e7)
+
+def pairwise_sum(windows):
+    """
+    Sum over the last axis of float32 windows, in the same order as NumPy's
+    pairwise summation of each window, so that results match np.sum bit for bit.
+    """
+    n = windows.shape[-1]
+    if n < 8:
+        res = np.zeros(windows.shape[:-1], dtype=windows.dtype)
+        for i in range(n):
+            res += windows[..., i]
+        return(res)
+    if n <= 128:
+        # Eight interleaved partial sums, then the remainder
+        r = windows[..., :8].copy()
+        i = 8
+        while i < n - (n % 8):
+            r += windows[..., i:i+8]
+            i += 8
+        res = ((r[..., 0] + r[..., 1]) + (r[..., 2] + r[..., 3])) + ((r[..., 4] + r[..., 5]) + (r[..., 6] + r[..., 7]))
+        for i in range(i, n):
+            res += windows[..., i]
+        return(res)
+    n2 = n // 2
+    n2 -= n2 % 8
+    return(pairwise_sum(windows[..., :n2]) + pairwise_sum(windows[..., n2:]))
+
+def smooth(image, width):
+    """
+    Boxcar smoothing identical to sunkit_image.trace.smooth, computed over
+    blocks of rows instead of one window at a time.
+
+    Parameters
+    ----------
+    image : ndarray
+        float32 image.
+    width : int
+        Width of the boxcar, incremented if even.
+
+    Returns
+    -------
+    ndarray
+        float32 image, equal to image within width // 2 of the edges.
+    """
+    if not np.all(np.isfinite(image)):
+        # Windows with NaNs average over fewer pixels
+        return(sunkit_image.trace.smooth(image, width, "replace"))
+    if width % 2 == 0:
+        width = width + 1
+    filtered = np.array(image, dtype=np.float32)
+    half = width // 2
+    r, c = image.shape
+    if r < width or c < width:
+        return(filtered)
+    view = np.lib.stride_tricks.sliding_window_view(filtered.copy(), (width, width))
+    for row in range(0, view.shape[0], SMOOTH_ROWS):
+        windows = view[row:row+SMOOTH_ROWS].reshape(-1, view.shape[1], width*width)
+        total = pairwise_sum(windows)
+        # np.mean divides the float32 sum by the count in double precision
+        filtered[row+half:row+half+len(total), half:c-half] = total.astype(np.float64) / (width*width)
+    return(filtered)
+
+def bandpass_filter(image, nsm1=1, nsm2=3):
+    """
+    Bandpass filter identical to sunkit_image.trace.bandpass_filter, using smooth().
+    """
+    if nsm1 >= nsm2:
+        raise ValueError("nsm1 should be less than nsm2")
+    if nsm1 <= 2:
+        return(image - smooth(image, nsm2))
+    return(smooth(image, nsm1) - smooth(image, nsm2))
+
+class OCCULTKernels:
+    def __init__(self, rmin):
+        """
+        Direction kernels of the native OCCULT-2 tracing for one rmin, which
+        sets both the curvature radii and the tracing segment length. They
+        are computed once with the same arithmetic as sunkit's
+        initial_direction_finding and curvature_radius.
+
+        Parameters
+        ----------
+        rmin : int
+            Minimum feature radius of curvature, in pixels
+        """
+        nlen = rmin
+        self.nlen = nlen
+        self.norm = np.float32(nlen)
+
+        # Initial direction, 180 angles along a centered segment
+        na = 180
+        trace_seg_bi = (np.arange(nlen, dtype=np.float32) - nlen // 2).reshape((-1, 1))
+        self.angles = np.pi * np.arange(na, dtype=np.float32) / np.float32(na).reshape((1, -1))
+        self.dir_x = np.matmul(trace_seg_bi, np.float32(np.cos(self.angles)))
+        self.dir_y = np.matmul(trace_seg_bi, np.float32(np.sin(self.angles)))
+
+        # Curvature radii of every radial segment, with their curved segments
+        self.rad_segments = 30
+        trace_seg_uni = np.arange(nlen, dtype=np.float32).reshape((-1, 1))
+        self.rad = rmin / (-1.0 + 2.0 * np.arange(0, self.rad_segments, dtype=np.float32) / np.float32(self.rad_segments - 1)).reshape((1, -1))
+        self.ratio = self.rad / rmin
+        self.curve = np.float32(np.matmul(trace_seg_uni, 1 / self.rad))
+        self.curve_back = -1 * self.curve
+
+def _pixel_index(pos, n):
+    """
+    Nearest pixel index of float positions, clipped to [0, n), in place of np.clip.
+    """
+    index = (pos + 0.5).astype(int)
+    np.maximum(index, 0, out=index)
+    np.minimum(index, n - 1, out=index)
+    return(index)
+
+def _trace_native(residual, thresh, rmin, lmin, nstruc, ngap, wid, kernels):
+    """
+    Native OCCULT-2 structure tracing, identical in output to the loop of
+    sunkit_image.trace.occult2. Tracing starts are taken from a presorted
+    list of the pixels above the threshold, directions use the precomputed
+    kernels, and loops are erased from the residual all at once.
+    """
+    nloopmax = 10000
+    npmax = 2000
+    nx, ny = residual.shape
+    step = 1
+
+    # Candidate starts, brightest first and in index order within ties, as the
+    # first maximum of np.where. Values only change when erased.
+    cand_i, cand_j = np.nonzero(residual > thresh)
+    cand_z = residual[cand_i, cand_j]
+    order = np.argsort(-cand_z, kind="stable")
+    cand_i, cand_j, cand_z = cand_i[order], cand_j[order], cand_z[order]
+    next_start = 0
+
+    iloop = 0
+    loops = []
+    for _ in range(0, nstruc):
+        while next_start < len(cand_z) and residual[cand_i[next_start], cand_j[next_start]] != cand_z[next_start]:
+            next_start += 1
+        if next_start == len(cand_z):
+            break
+        istart, jstart, zstart = cand_i[next_start], cand_j[next_start], cand_z[next_start]
+
+        # Initial direction, shared by both tracing directions
+        xstart = np.float32(istart)
+        ystart = np.float32(jstart)
+        ix = _pixel_index(xstart + kernels.dir_x, nx)
+        iy = _pixel_index(ystart + kernels.dir_y, ny)
+        flux = np.sum(residual[ix, iy], axis=0) / kernels.norm
+        al0 = kernels.angles[0, np.argmax(flux)]
+
+        ip = 0
+        for idir in range(0, 2):
+            xl = np.zeros((npmax + 1,), dtype=np.float32)
+            yl = np.zeros((npmax + 1,), dtype=np.float32)
+            zl = np.zeros((npmax + 1,), dtype=np.float32)
+            al = np.zeros((npmax + 1,), dtype=np.float32)
+            xl[0] = istart
+            yl[0] = jstart
+            zl[0] = zstart
+            al[0] = al0
+            sign_dir = 1 - 2 * idir
+            curve = kernels.curve if idir == 0 else kernels.curve_back
+            ir = 0
+            for ip in range(0, npmax):
+                # Radii within one segment of the last, or all of them at the start
+                if ip == 0:
+                    ib1 = 0
+                    ib2 = kernels.rad_segments - 1
+                else:
+                    ib1 = max(ir - 1, 0)
+                    ib2 = min(ir + 1, kernels.rad_segments - 1)
+                rad_i = kernels.rad[:, ib1:ib2+1]
+                beta0 = al[ip] + np.float32(np.pi / 2)
+                xcen = xl[ip] + rmin * np.float32(np.cos(beta0))
+                ycen = yl[ip] + rmin * np.float32(np.sin(beta0))
+                ratio = kernels.ratio[:, ib1:ib2+1]
+                xcen_i = xl[ip] + (xcen - xl[ip]) * ratio
+                ycen_i = yl[ip] + (ycen - yl[ip]) * ratio
+                beta_i = beta0 + curve[:, ib1:ib2+1]
+                ix = _pixel_index(xcen_i - rad_i * np.float32(np.cos(beta_i)), nx)
+                iy = _pixel_index(ycen_i - rad_i * np.float32(np.sin(beta_i)), ny)
+                # The residual is never negative, so no clipping at zero is needed
+                flux = np.sum(residual[ix, iy], axis=0) / kernels.norm
+                v = np.argmax(flux)
+                al[ip + 1] = al[ip] + sign_dir * (step / rad_i[0, v])
+                ir = ib1 + v
+                al_mid = (al[ip] + al[ip + 1]) / 2.0
+                xl[ip + 1] = xl[ip] + step * np.float32(np.cos(al_mid + np.pi * idir))
+                yl[ip + 1] = yl[ip] + step * np.float32(np.sin(al_mid + np.pi * idir))
+                ix_ip = min(max(int(xl[ip + 1] + 0.5), 0), nx - 1)
+                iy_ip = min(max(int(yl[ip + 1] + 0.5), 0), ny - 1)
+                zl[ip + 1] = residual[ix_ip, iy_ip]
+                # Stop once the last ngap points are below zero
+                iz1 = max((ip + 1 - ngap), 0)
+                if zl[iz1 : ip + 2].max() <= 0:
+                    ip = max(iz1 - 1, 0)
+                    break
+            if idir == 0:
+                xloop = np.flip(xl[0 : ip + 1])
+                yloop = np.flip(yl[0 : ip + 1])
+                continue
+            if idir == 1 and ip >= 1:
+                xloop = np.concatenate([xloop, xl[1 : ip + 1]])
+                yloop = np.concatenate([yloop, yl[1 : ip + 1]])
+            else:
+                break
+
+        # Keep only points where both coordinates are non-zero
+        ind = np.logical_and(xloop != 0, yloop != 0)
+        looplen = 0
+        if np.sum(ind) > 1:
+            xloop = xloop[ind]
+            yloop = yloop[ind]
+            if iloop >= nloopmax:
+                break
+            # Scalar float32 powers round differently from array ones, so the
+            # length is summed point by point as sunkit does
+            s = np.zeros(len(xloop), dtype=np.float32)
+            for ip in range(1, len(xloop)):
+                s[ip] = s[ip - 1] + np.sqrt((xloop[ip] - xloop[ip - 1]) ** 2 + (yloop[ip] - yloop[ip - 1]) ** 2)
+            looplen = s[-1]
+        # Only structures of at least lmin are kept, resampled at unit spacing
+        if looplen >= lmin:
+            points = np.arange(int(max(int(s[-1]), 3) + 0.5))
+            x_interp = scipy.interpolate.interp1d(s, xloop, fill_value="extrapolate")(points)
+            y_interp = scipy.interpolate.interp1d(s, yloop, fill_value="extrapolate")(points)
+            iloop += 1
+            loops.append([[x, y] for x, y in zip(x_interp, y_interp)])
+        _erase_loop(residual, istart, jstart, wid, xloop, yloop)
+
+    return(loops)
+
+def _erase_loop(residual, istart, jstart, width, xloop, yloop):
+    """
+    Zero every pixel within width of the start and of each loop point, in place,
+    as sunkit_image.trace.erase_loop_in_image does box by box.
+    """
+    nx, ny = residual.shape
+    i0 = np.concatenate([[istart], np.clip(xloop.astype(int), 0, nx - 1)])
+    j0 = np.concatenate([[jstart], np.clip(yloop.astype(int), 0, ny - 1)])
+    xs = np.maximum(i0 - width, 0)
+    xe = np.minimum(i0 + width, nx - 1)
+    ys = np.maximum(j0 - width, 0)
+    ye = np.minimum(j0 + width, ny - 1)
+
+    # Boxes are marked on a difference array of their bounding region
+    bx, by = xs.min(), ys.min()
+    cover = np.zeros((xe.max() - bx + 2, ye.max() - by + 2), dtype=np.int32)
+    np.add.at(cover, (xs - bx, ys - by), 1)
+    np.add.at(cover, (xe - bx + 1, ys - by), -1)
+    np.add.at(cover, (xs - bx, ye - by + 1), -1)
+    np.add.at(cover, (xe - bx + 1, ye - by + 1), 1)
+    cover = np.cumsum(np.cumsum(cover, axis=0), axis=1)[:-1, :-1]
+    residual[bx:bx+cover.shape[0], by:by+cover.shape[1]][cover > 0] = 0.0
+
+class OCCULTStages:
+    def __init__(self, data, cache_size=STAGE_CACHE):
+        """
+        OCCULT-2, as in sunkit_image.trace.occult2, split into its stages. 
+        The intermediate arrays of each stage are cached by the parameters 
+        they depend on, so that runs sharing nsm1 and the qthresh values 
+        only repeat the structure tracing.
+
+            base(qthresh1) : image with the base level removed
+            bandpass(nsm1, qthresh1, engine) : bandpass-filtered image
+            threshold(nsm1, qthresh1, qthresh2, engine) : noise threshold
+            trace(...) : traced structures
+
+        Each stage runs either sunkit's code ("sunkit") or the vectorized
+        equivalent in this module ("native"), which gives the same output.
+
+        Parameters
+        ----------
+        data : ndarray
+            Image data to trace.
+        cache_size : int
+            Number of arrays kept per stage, the least recently used
+            being dropped first.
+        """
+        # Transposed, as sunkit's code follows the column-major IDL original
+        self.image = data.astype(np.float32).T
+        self.cache_size = cache_size
+        self.cache = {"base" : OrderedDict(), "bandpass" : OrderedDict(), "threshold" : OrderedDict()}
+        # Direction kernels of the native engine, by rmin
+        self.kernels = {}
+        self.hits = 0
+        self.misses = 0
+
+    def cached(self, stage, key, compute):
+        """
+        Return the cached result of a stage for key, computing it if needed.
+        """
+        cache = self.cache[stage]
+        if key in cache:
+            self.hits += 1
+            cache.move_to_end(key)
+            return(cache[key])
+        self.misses += 1
+        result = compute()
+        cache[key] = result
+        if len(cache) > self.cache_size:
+            cache.popitem(last=False)
+        return(result)
+
+    def base(self, qthresh1):
+        """
+        Image with all pixels below qthresh1 * median set to that level.
+
+        Returns
+        -------
+        ndarray
+            Read-only, transposed float32 image.
+        """
+        def compute():
+            zmed = np.median(self.image[self.image > 0])
+            image = np.where(self.image > (zmed * qthresh1), self.image, zmed * qthresh1)
+            image.setflags(write=False)
+            return(image)
+        return(self.cached("base", qthresh1, compute))
+
+    def bandpass(self, nsm1, qthresh1, engine=ENGINE):
+        """
+        Bandpass-filtered base image, with the boundary zones affected by 
+        the smoothing erased.
+
+        Returns
+        -------
+        ndarray
+            Read-only, transposed float32 image.
+        """
+        def compute():
+            nsm2 = nsm1 + 2
+            if engine == "native":
+                image2 = bandpass_filter(self.base(qthresh1), nsm1, nsm2)
+            else:
+                image2 = sunkit_image.trace.bandpass_filter(self.base(qthresh1), nsm1, nsm2)
+            nx, ny = image2.shape
+            image2[:, 0:nsm2] = 0.0
+            image2[:, ny - nsm2 :] = 0.0
+            image2[0:nsm2, :] = 0.0
+            image2[nx - nsm2 :, :] = 0.0
+            if not np.count_nonzero(image2):
+                raise RuntimeError(
+                    "The filter size is very large compared to the size of the image."
+                    + " The entire image zeros out while smoothing the image edges after filtering."
+                )
+            image2.setflags(write=False)
+            return(image2)
+        return(self.cached("bandpass", (nsm1, qthresh1, engine), compute))
+
+    def threshold(self, nsm1, qthresh1, qthresh2, engine=ENGINE):
+        """
+        Noise threshold of the bandpass image, below which tracing stops.
+
+        Returns
+        -------
+        float
+        """
+        def compute():
+            image2 = self.bandpass(nsm1, qthresh1, engine)
+            return(np.median(image2[image2 > 0]) * qthresh2)
+        return(self.cached("threshold", (nsm1, qthresh1, qthresh2, engine), compute))
+
+    def trace(self, nsm1=4, rmin=45, lmin=35, nstruc=2000, ngap=1, qthresh1=0.0, qthresh2=3.0, engine=ENGINE):
+        """
+        Trace structures in the bandpass image, brightest first. Parameters
+        are those of AutoTracingOCCULT.run().
+
+        Returns
+        -------
+        list
+            List of features, with a list of coordinates per feature
+        """
+        if engine not in ("native", "sunkit"):
+            raise ValueError("Supported OCCULT-2 engines include: native and sunkit only")
+        thresh = self.threshold(nsm1, qthresh1, qthresh2, engine)
+        if engine == "native" and rmin not in self.kernels:
+            self.kernels[rmin] = OCCULTKernels(rmin)
+        return(trace_residual(self.residual(nsm1, qthresh1, engine), thresh, nsm1, rmin, lmin, 
+            nstruc, ngap, engine, self.kernels.get(rmin)))
+
+    def residual(self, nsm1, qthresh1, engine=ENGINE):
+        """
+        Positive part of the bandpass image, which tracing erases as it
+        goes. Each call returns a new copy.
+
+        Returns
+        -------
+        ndarray
+            Transposed float32 image.
+        """
+        image2 = self.bandpass(nsm1, qthresh1, engine)
+        return(np.where(image2 > 0, image2, 0))
+
+def trace_residual(residual, thresh, nsm1=4, rmin=45, lmin=35, nstruc=2000, ngap=1, engine=ENGINE, kernels=None):
+    """
+    Trace structures in a residual image (see OCCULTStages.residual), 
+    brightest first, until they fall below thresh. The residual is erased
+    along each structure traced. Parameters are those of 
+    AutoTracingOCCULT.run().
+
+    Parameters
+    ----------
+    kernels : OCCULTKernels (optional)
+        Direction kernels of the native engine for rmin, computed if not given.
+
+    Returns
+    -------
+    list
+        List of features, with a list of coordinates per feature
+    """
+    wid = max((nsm1 + 2) // 2 - 1, 1)
+    if engine == "native":
+        if kernels is None:
+            kernels = OCCULTKernels(rmin)
+        return(_trace_native(residual, thresh, rmin, lmin, nstruc, ngap, wid, kernels))
+    return(_trace_sunkit(residual, thresh, rmin, lmin, nstruc, ngap, wid))
+
+def _trace_sunkit(residual, thresh, rmin, lmin, nstruc, ngap, wid):
+    """
+    Tracing loop of sunkit_image.trace.occult2.
+    """
+    # Constants of sunkit's implementation
+    nloopmax = 10000
+    npmax = 2000
+    nlen = rmin
+
+    iloop = 0
+    loops = []
+    for _ in range(0, nstruc):
+        # Tracing begins at the maximum flux position, until it falls below the noise
+        zstart = residual.max()
+        if zstart <= thresh:
+            break
+        max_coords = np.where(residual == zstart)
+        istart, jstart = max_coords[0][0], max_coords[1][0]
+
+        # Trace forwards, then backwards from the starting point
+        ip = 0
+        for idir in range(0, 2):
+            xl = np.zeros((npmax + 1,), dtype=np.float32)
+            yl = np.zeros((npmax + 1,), dtype=np.float32)
+            zl = np.zeros((npmax + 1,), dtype=np.float32)
+            al = np.zeros((npmax + 1,), dtype=np.float32)
+            ir = np.zeros((npmax + 1,), dtype=np.float32)
+            xl[0] = istart
+            yl[0] = jstart
+            zl[0] = zstart
+            al[0] = sunkit_image.trace.initial_direction_finding(residual, xl[0], yl[0], nlen)
+            for ip in range(0, npmax):
+                xl, yl, zl, al = sunkit_image.trace.curvature_radius(residual, rmin, xl, yl, zl, al, ir, ip, nlen, idir)
+                # Stop once the last ngap points are below zero
+                iz1 = max((ip + 1 - ngap), 0)
+                if np.max(zl[iz1 : ip + 2]) <= 0:
+                    ip = max(iz1 - 1, 0)
+                    break
+            if idir == 0:
+                xloop = np.flip(xl[0 : ip + 1])
+                yloop = np.flip(yl[0 : ip + 1])
+                zloop = np.flip(zl[0 : ip + 1])
+                continue
+            if idir == 1 and ip >= 1:
+                xloop = np.concatenate([xloop, xl[1 : ip + 1]])
+                yloop = np.concatenate([yloop, yl[1 : ip + 1]])
+                zloop = np.concatenate([zloop, zl[1 : ip + 1]])
+            else:
+                break
+
+        # Keep only points where both coordinates are non-zero
+        ind = np.logical_and(xloop != 0, yloop != 0)
+        nind = np.sum(ind)
+        looplen = 0
+        if nind > 1:
+            xloop = xloop[ind]
+            yloop = yloop[ind]
+            zloop = zloop[ind]
+            if iloop >= nloopmax:
+                break
+            np1 = len(xloop)
+            s = np.zeros((np1), dtype=np.float32)
+            looplen = 0
+            if np1 >= 2:
+                for ip in range(1, np1):
+                    s[ip] = s[ip - 1] + np.sqrt((xloop[ip] - xloop[ip - 1]) ** 2 + (yloop[ip] - yloop[ip - 1]) ** 2)
+            looplen = s[np1 - 1]
+        # Only structures of at least lmin are kept
+        if looplen >= lmin:
+            loops, iloop = sunkit_image.trace.loop_add(s, xloop, yloop, zloop, iloop, loops)
+        residual = sunkit_image.trace.erase_loop_in_image(residual, istart, jstart, wid, xloop, yloop)
+
+    return(loops)
+
+def image_digest(data):
+    """
+    Hash of the contents of an image, the part of a trace cache key 
+    shared by every run on it.
+
+    Returns
+    -------
+    str
+    """
+    data = np.ascontiguousarray(data)
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(json.dumps([TRACE_CACHE_VERSION, data.dtype.str, data.shape]).encode())
+    digest.update(data.view(np.uint8).reshape(-1))
+    return(digest.hexdigest())
+
+def trace_key(digest, nsm1, rmin, lmin, nstruc, ngap, qthresh1, qthresh2, engine=ENGINE):
+    """
+    Trace cache key of one OCCULT-2 run, from the image_digest() of the
+    image and the parameters of AutoTracingOCCULT.run(). The engine is
+    included, as the engines agree only as far as they have been compared,
+    and so is the sunkit_image version for its engine.
+
+    Returns
+    -------
+    str
+    """
+    version = sunkit_image.__version__ if engine == "sunkit" else None
+    key = hashlib.blake2b(digest.encode(), digest_size=20)
+    key.update(json.dumps([int(nsm1), int(rmin), int(lmin), int(nstruc), int(ngap),
+            repr(float(qthresh1)), repr(float(qthresh2)), engine, version]).encode())
+    return(key.hexdigest())
+
+def _pack_traces(features):
+    """
+    Features as a binary payload: the number of points of each feature,
+    followed by the [x, y] points of all features.
+    """
+    lengths = np.array([len(feature) for feature in features], dtype=np.int32)
+    points = np.array([coord for feature in features for coord in feature], dtype=np.float64)
+    buffer = io.BytesIO()
+    np.save(buffer, lengths)
+    np.save(buffer, points.reshape(-1, 2))
+    return(buffer.getvalue())
+
+def _unpack_traces(payload):
+    """
+    Features from a binary payload of _pack_traces().
+    """
+    buffer = io.BytesIO(payload)
+    lengths = np.load(buffer)
+    points = np.load(buffer).tolist()
+    ends = np.cumsum(lengths).tolist()
+    return([points[end - length : end] for end, length in zip(ends, lengths.tolist())])
+
+class TraceCache:
+    def __init__(self, path=None, max_bytes=TRACE_CACHE_BYTES, memory_bytes=TRACE_MEMORY_BYTES):
+        """
+        Cache of OCCULT-2 traces by trace_key(). Traces are kept as compact
+        binary payloads in memory and, optionally, in a directory shared
+        with other processes. Both are bounded in size, the least recently
+        used traces being dropped first. On disk, the size is tracked from
+        this process's own writes and checked against the directory only 
+        once it passes max_bytes, so writes by other processes are counted 
+        late.
+
+        Parameters
+        ----------
+        path : str or None
+            Directory of the cache on disk. None keeps traces in memory only.
+        max_bytes : int
+            Maximum size of the cache on disk.
+        memory_bytes : int
+            Maximum size of the cache in memory.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.memory_bytes = memory_bytes
+        self.memory = OrderedDict()
+        self.size = 0
+        # Size of the cache on disk, unknown until the directory is first listed
+        self.disk_size = None
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return(len(self.memory))
+
+    def filename(self, key):
+        """
+        Path of the payload of key on disk.
+        """
+        return(os.path.join(self.path, key + ".trc"))
+
+    def get(self, key):
+        """
+        Return the cached features for key, or None if they are not cached.
+        """
+        payload = self.memory.get(key)
+        if payload is not None:
+            self.memory.move_to_end(key)
+        elif self.path is not None:
+            try:
+                with open(self.filename(key), "rb") as f:
+                    payload = f.read()
+            except OSError:
+                payload = None
+            if payload is not None:
+                self.remember(key, payload)
+        if payload is not None and self.path is not None:
+            # Mark as recently used for eviction on disk
+            try:
+                os.utime(self.filename(key))
+            except OSError:
+                pass
+        if payload is None:
+            self.misses += 1
+            return(None)
+        try:
+            features = _unpack_traces(payload)
+        except (OSError, ValueError):
+            # Truncated payload; trace again
+            self.forget(key)
+            self.misses += 1
+            return(None)
+        self.hits += 1
+        return(features)
+
+    def put(self, key, features):
+        """
+        Cache features under key.
+        """
+        payload = _pack_traces(features)
+        self.remember(key, payload)
+        if self.path is None:
+            return
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            # Written under a unique name and renamed into place, so that
+            # readers in other processes never see partial payloads
+            fd, temp_name = tempfile.mkstemp(suffix=".tmp", dir=self.path)
+            with os.fdopen(fd, "wb") as f:
+                f.write(payload)
+            os.replace(temp_name, self.filename(key))
+            if self.disk_size is not None:
+                self.disk_size += len(payload)
+            if self.disk_size is None or self.disk_size > self.max_bytes:
+                self.evict()
+        except OSError as e:
+            warnings.warn("Unable to write OCCULT-2 trace cache in {}: {}".format(self.path, e))
+
+    def remember(self, key, payload):
+        """
+        Keep a payload in memory, dropping the least recently used ones
+        beyond memory_bytes.
+        """
+        if key in self.memory:
+            self.size -= len(self.memory.pop(key))
+        self.memory[key] = payload
+        self.size += len(payload)
+        while self.size > self.memory_bytes and len(self.memory) > 1:
+            self.size -= len(self.memory.popitem(last=False)[1])
+
+    def forget(self, key):
+        """
+        Remove key from the cache.
+        """
+        if key in self.memory:
+            self.size -= len(self.memory.pop(key))
+        if self.path is not None:
+            try:
+                os.remove(self.filename(key))
+            except OSError:
+                pass
+
+    def evict(self):
+        """
+        Remove the least recently used payloads on disk beyond max_bytes,
+        updating disk_size from the directory.
+        """
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(".trc"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except OSError:
+                # Removed by another process
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, name))
+        total = sum(entry[1] for entry in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total -= size
+        self.disk_size = total
+
+# Trace cache shared by AutoTracingOCCULT instances, created on first use
+_trace_cache = {}
+
+def trace_cache():
+    """
+    Trace cache shared by every AutoTracingOCCULT of this process, in the
+    TRACE_CACHE directory, or in memory only if it is None.
+
+    Returns
+    -------
+    TraceCache
+    """
+    if "cache" not in _trace_cache:
+        _trace_cache["cache"] = TraceCache(TRACE_CACHE)
+    return(_trace_cache["cache"])
+
 class AutoTracingOCCULT:
-    def __init__(self, image_path="", data=None):
+    def __init__(self, image_path="", data=None, cache=False):
         """
-        Autotracing class which acts as a wrapper for sunkit's OCCULT-2 implementation to 
-        trace out curvilinear features on an image. 
+        Autotracing class which runs OCCULT-2, either sunkit's implementation or the
+        vectorized one of this module, to trace out curvilinear features on an image. 
+        It is run in stages (see OCCULTStages), caching the preprocessing shared by 
+        repeated runs. Traces can also be cached by image content and parameters 
+        (see TraceCache), so that repeating a run on the same image is near-instant.
 
         Each AutoTracing instance should act on a single image. 
 
@@ -29,7 +785,20 @@ class AutoTracingOCCULT:
             Path to the image containing features to trace. Image must be in .fits format.
         data : ndarray (optional)
             Image data - useful if the image has already been opened. 
+        cache : TraceCache or bool (optional)
+            Trace cache to use. True uses the cache shared by the process 
+            (see trace_cache), and False, the default, disables caching.
         """
+        # Staged OCCULT-2, created on the first run
+        self.stages = None
+
+        # Trace cache, if any
+        if cache is True:
+            cache = trace_cache()
+        elif cache is False:
+            cache = None
+        self.cache = cache
+
         if data is not None:
             self.img_data = data
         else:
@@ -42,7 +811,7 @@ class AutoTracingOCCULT:
             else:
                 raise Exception("Did not detect .fits extension in image path.")
     
-    def run(self, nsm1=4, rmin=45, lmin=35, nstruc=2000, ngap=1, qthresh1=0.0, qthresh2=3.0):
+    def run(self, nsm1=4, rmin=45, lmin=35, nstruc=2000, ngap=1, qthresh1=0.0, qthresh2=3.0, engine=ENGINE):
         """
         Run OCCULT-2 with given parameters. 
 
@@ -62,6 +831,9 @@ class AutoTracingOCCULT:
             Ratio of image base and median flux. All pixels below qthresh1 * median intensity = 0
         qthresh2 : float
             Factor which determines noise in image - intensities below qthresh2 * median are noise
+        engine : str
+            "native" for this module's vectorized OCCULT-2, or "sunkit" for sunkit's own
+            code. Both give the same features.
 
         Returns
         -------
@@ -69,19 +841,99 @@ class AutoTracingOCCULT:
             List of features, with a list of coordinates per feature
         """
 
-        features = sunkit_image.trace.occult2(
-            self.img_data, 
+        # Runs already traced on the same image come from the cache. The image is
+        # hashed on every run, so changes to img_data are never missed.
+        key = None
+        if self.cache is not None:
+            key = trace_key(image_digest(self.img_data), nsm1, rmin, lmin, nstruc, ngap, qthresh1, qthresh2, engine)
+            features = self.cache.get(key)
+            if features is not None:
+                return(features)
+
+        # Repeated runs reuse the preprocessing stages they share
+        if self.stages is None:
+            self.stages = OCCULTStages(self.img_data)
+
+        features = self.stages.trace(
             nsm1, 
             rmin, 
             lmin, 
             nstruc, 
             ngap, 
             qthresh1, 
-            qthresh2
+            qthresh2,
+            engine
             )
+        if key is not None:
+            self.cache.put(key, features)
             
         return(features)
     
+    def run_tiled(self, nsm1=4, rmin=45, lmin=35, nstruc=2000, ngap=1, qthresh1=0.0, qthresh2=3.0, 
+            engine=ENGINE, tile=TILE, overlap=None, workers=None):
+        """
+        Run OCCULT-2 on overlapping tiles of the image in parallel, for images 
+        too large to trace at once. The bandpass image and noise threshold 
+        are computed once for the whole image, so traces do not depend on 
+        where the tiles fall. Duplicate traces in the overlaps are removed, 
+        and traces cut by tile seams are joined by the proximity and 
+        direction of their ends (see stitch_tiles).
+
+        nstruc is split across the tiles in proportion to their area. As 
+        OCCULT-2 spends it on the brightest structures of the whole image 
+        first, a capped nstruc gives only roughly the traces of run(); with 
+        nstruc large enough that tracing runs out of structures first, the 
+        traces closely match those of run().
+
+        Parameters
+        ----------
+        nsm1, rmin, lmin, nstruc, ngap, qthresh1, qthresh2, engine
+            See run().
+        tile : int
+            Side length of each tile, in pixels, excluding overlap.
+        overlap : int (optional)
+            Pixels each tile extends into its neighbours. Defaults to 
+            TILE_OVERLAP.
+        workers : int (optional)
+            Number of worker processes. Defaults to the number of CPUs,
+            and is never more than the number of tiles.
+
+        Returns
+        -------
+        list
+            List of features, with a list of coordinates per feature
+        """
+        if engine not in ("native", "sunkit"):
+            raise ValueError("Supported OCCULT-2 engines include: native and sunkit only")
+        if overlap is None:
+            overlap = TILE_OVERLAP
+        if self.stages is None:
+            self.stages = OCCULTStages(self.img_data)
+        thresh = self.stages.threshold(nsm1, qthresh1, qthresh2, engine)
+        residual = self.stages.residual(nsm1, qthresh1, engine)
+        bounds = tile_bounds(np.shape(self.img_data), tile, overlap)
+        area = np.prod(np.shape(self.img_data))
+        tasks = [(b, (nsm1, rmin, lmin, int(np.ceil(nstruc * (b[1] - b[0]) * (b[3] - b[2]) / area)), 
+                      ngap, thresh, engine)) for b in bounds]
+        workers = min(workers if workers is not None else os.cpu_count(), len(bounds))
+
+        if workers <= 1:
+            tiles = [_trace_tile(residual, b, params) for b, params in tasks]
+        else:
+            shm = _share_image(residual)
+            try:
+                with ProcessPoolExecutor(
+                    max_workers=workers, 
+                    initializer=_attach_image, 
+                    initargs=(shm.name, residual.shape, residual.dtype.str)
+                    ) as pool:
+                    tiles = list(pool.map(_tile_run, tasks))
+            finally:
+                shm.close()
+                shm.unlink()
+
+        return(stitch_tiles(tiles, lmin))
+
     def save(self, features, save_path, save_file=None):
         """
         Save features in a list to a .csv file.
@@ -111,6 +963,386 @@ class AutoTracingOCCULT:
                     for coord in fibril:
                         savewriter.writerow([fibril_num, coord[0], coord[1]])
     
+def sweep_key(nsm1, rmin, lmin, nstruc, ngap, qthresh1, qthresh2):
+    """
+    Name of one OCCULT-2 parameter set, used as the key of sweep results
+    and as the filename of saved results.
+
+    Returns
+    -------
+    str
+    """
+    return("N{}-R{}-L{}-NS{}-NG{}-Q1{}-Q2{}".format(nsm1, rmin, lmin, nstruc, ngap, qthresh1, qthresh2))
+
+# Image shared with the sweep and tiling worker processes
+_sweep_image = {}
+
+def _attach_image(name, shape, dtype):
+    """
+    Attach a worker process to the shared image, detaching again when
+    the worker exits.
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    _sweep_image['shm'] = shm
+    _sweep_image['data'] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    # Worker processes skip atexit, but run multiprocessing finalizers on exit
+    util.Finalize(None, _detach_image, exitpriority=0)
+
+def _detach_image():
+    """
+    Drop the views of the shared image held by a worker process and close it.
+    """
+    shm = _sweep_image.pop('shm', None)
+    _sweep_image.clear()
+    if shm is not None:
+        try:
+            shm.close()
+        except BufferError:
+            # Still viewed by an unfinished run; released with the process
+            pass
+
+def _sweep_init(name, shape, dtype):
+    """
+    Attach a sweep worker process to the shared image.
+    """
+    _attach_image(name, shape, dtype)
+    _sweep_image['at'] = AutoTracingOCCULT(data=_sweep_image['data'])
+
+def _share_image(data):
+    """
+    Copy a contiguous image into new shared memory, returning its handle.
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+    shared = np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)
+    shared[...] = data
+    return(shm)
+
+def _sweep_run(params):
+    """
+    Run OCCULT-2 on the shared image in a sweep worker process. The worker's
+    AutoTracingOCCULT caches the preprocessing stages between runs.
+    """
+    return(_sweep_image['at'].run(*params))
+
+class OCCULTSweep:
+    def __init__(self, data, nsm1=4, rmin=45, lmin=35, nstruc=2000, ngap=1, qthresh1=0.0, qthresh2=3.0, workers=None, 
+            cache=False):
+        """
+        Parameter sweep of OCCULT-2 over a process pool. The image is copied
+        into shared memory once, and every combination of the parameter
+        values is traced in the pool. Results are returned as they finish.
+        With a trace cache, parameter sets already traced on the same image
+        are returned at once, and new results are added to it.
+
+        Parameters
+        ----------
+        data : ndarray
+            Image data to trace.
+        nsm1, rmin, lmin, nstruc, ngap, qthresh1, qthresh2 : value or list
+            Parameters of AutoTracingOCCULT.run(). A list gives every value
+            to sweep over.
+        workers : int (optional)
+            Number of worker processes. Defaults to the number of CPUs,
+            and is never more than the number of parameter sets.
+        cache : TraceCache or bool (optional)
+            Trace cache, as for AutoTracingOCCULT. It is used in this
+            process only.
+        """
+        self.data = np.ascontiguousarray(data)
+        if cache is True:
+            cache = trace_cache()
+        elif cache is False:
+            cache = None
+        self.cache = cache
+        values = []
+        for param in [nsm1, rmin, lmin, nstruc, ngap, qthresh1, qthresh2]:
+            if isinstance(param, (list, tuple, range, np.ndarray)):
+                values.append(list(param))
+            else:
+                values.append([param])
+        self.params = list(itertools.product(*values))
+        self.keys = [sweep_key(*params) for params in self.params]
+        self.workers = min(workers if workers is not None else os.cpu_count(), len(self.params))
+        self.errors = {}
+        self.finished = 0
+        self.cancelled = False
+        self.pool = None
+        self.shm = None
+        self.futures = {}
+        # Cached results not yet returned, and the cache key of each parameter set
+        self.ready = []
+        self.trace_keys = {}
+
+    def __len__(self):
+        return(len(self.params))
+
+    def __enter__(self):
+        return(self.start())
+
+    def __exit__(self, *args):
+        self.close()
+
+    def start(self):
+        """
+        Share the image and submit every parameter set to the pool.
+
+        Returns
+        -------
+        self : OCCULTSweep
+        """
+        # Parameter sets sharing nsm1 and the qthresh values are submitted together,
+        # so each worker mostly reuses its cached preprocessing stages
+        order = sorted(range(len(self.params)), key=lambda i: (self.params[i][0],) + self.params[i][5:])
+        if self.cache is not None:
+            digest = image_digest(self.data)
+            pending = []
+            for i in order:
+                self.trace_keys[self.keys[i]] = trace_key(digest, *self.params[i])
+                features = self.cache.get(self.trace_keys[self.keys[i]])
+                if features is None:
+                    pending.append(i)
+                else:
+                    self.ready.append((self.keys[i], features))
+                    self.finished += 1
+            order = pending
+        if len(order) == 0:
+            return(self)
+
+        self.shm = _share_image(self.data)
+        self.pool = ProcessPoolExecutor(
+            max_workers=min(self.workers, len(order)), 
+            initializer=_sweep_init, 
+            initargs=(self.shm.name, self.data.shape, self.data.dtype.str)
+            )
+        for i in order:
+            self.futures[self.pool.submit(_sweep_run, self.params[i])] = self.keys[i]
+        return(self)
+
+    @property
+    def done(self):
+        """
+        True once every result has been returned, or the sweep was cancelled.
+        """
+        return(self.cancelled or self.finished == len(self.params))
+
+    def _collect(self, future):
+        """
+        Return the (key, features) of a finished future, recording errors.
+        """
+        key = self.futures.pop(future)
+        self.finished += 1
+        try:
+            result = (key, future.result())
+        except Exception as e:
+            self.errors[key] = e
+            result = None
+        if result is not None and self.cache is not None:
+            self.cache.put(self.trace_keys[key], result[1])
+        if self.done:
+            self.close()
+        return(result)
+
+    def poll(self):
+        """
+        Return the results finished since the last call, without waiting.
+
+        Returns
+        -------
+        list
+            (key, features) of each finished parameter set. Parameter sets
+            that raised are left out and kept in self.errors.
+        """
+        results, self.ready = self.ready, []
+        for future in [f for f in self.futures if f.done()]:
+            if self.cancelled:
+                break
+            result = self._collect(future)
+            if result is not None:
+                results.append(result)
+        return(results)
+
+    def results(self):
+        """
+        Yield each result as it finishes, until all are returned or the
+        sweep is cancelled.
+
+        Yields
+        ------
+        tuple
+            (key, features), see poll().
+        """
+        ready, self.ready = self.ready, []
+        for result in ready:
+            yield result
+        for future in as_completed(list(self.futures)):
+            if self.cancelled:
+                return
+            result = self._collect(future)
+            if result is not None:
+                yield result
+
+    def cancel(self):
+        """
+        Stop the sweep. Parameter sets not yet started are dropped, and
+        results of those still running are discarded.
+        """
+        self.cancelled = True
+        for future in self.futures:
+            future.cancel()
+        self.futures = {}
+        self.close()
+
+    def close(self):
+        """
+        Shut down the pool and release the shared image.
+        """
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+def tile_bounds(shape, tile=TILE, overlap=TILE_OVERLAP):
+    """
+    Tiles of an image for tiled tracing.
+
+    Returns
+    -------
+    list
+        (row0, row1, col0, col1) of each tile including its overlap, row by row.
+    """
+    rows, cols = shape
+    bounds = []
+    for r in range(0, rows, tile):
+        for c in range(0, cols, tile):
+            bounds.append((max(r - overlap, 0), min(r + tile + overlap, rows), 
+                           max(c - overlap, 0), min(c + tile + overlap, cols)))
+    return(bounds)
+
+def _trace_tile(residual, bounds, params):
+    """
+    Trace one tile of a residual image (see OCCULTStages.residual) against 
+    the threshold of the whole image, returning its features as (n, 2) 
+    arrays of [x, y] in the coordinates of the whole image.
+    """
+    r0, r1, c0, c1 = bounds
+    nsm1, rmin, lmin, nstruc, ngap, thresh, engine = params
+    # Transposed like the residual, and copied as tracing erases it
+    crop = np.array(residual[c0:c1, r0:r1])
+    # Tracing reads past the edges as the edge pixels, so they are zeroed as the
+    # image border is, ending traces at the seams rather than running along them
+    crop[[0, -1], :] = 0
+    crop[:, [0, -1]] = 0
+    features = trace_residual(crop, thresh, nsm1, rmin, lmin, nstruc, ngap, engine)
+    offset = np.array([c0, r0], dtype=np.float64)
+    return([np.asarray(feature, dtype=np.float64).reshape(-1, 2) + offset for feature in features])
+
+def _tile_run(task):
+    """
+    Trace one tile of the shared residual image in a tiling worker process.
+    """
+    bounds, params = task
+    return(_trace_tile(_sweep_image['data'], bounds, params))
+
+def _end_direction(points, end, span=5):
+    """
+    Outward unit direction of a trace at its first (end=0) or last (end=1) point.
+    """
+    if end == 0:
+        points = points[::-1]
+    step = points[-1] - points[max(len(points) - 1 - span, 0)]
+    norm = np.hypot(*step)
+    return(step / norm if norm > 0 else step)
+
+def stitch_tiles(tiles, lmin, dup_dist=DUP_DIST, dup_frac=DUP_FRAC, join_dist=JOIN_DIST, join_angle=JOIN_ANGLE):
+    """
+    Merge the traces of overlapping tiles into one list of features.
+
+    Traces are taken longest first. One that lies mostly (dup_frac of its 
+    points) within dup_dist of an already kept trace of another tile is a 
+    duplicate and dropped; one that only starts or ends along it is trimmed.
+    Then ends of traces from different tiles that are
+    within join_dist pixels, and whose outward directions face each other
+    within join_angle degrees, are joined, until no more can be. Finally,
+    trimmed or joined traces with fewer than lmin points, e.g. leftovers 
+    of trimming, are dropped. Traces left untouched are returned as they 
+    are, in the order of their tiles, so a single tile passes through 
+    unchanged.
+
+    Parameters
+    ----------
+    tiles : list
+        Features of each tile, as (n, 2) arrays of [x, y].
+    lmin : int
+        Minimum feature length, in points, as OCCULT-2 counts it.
+
+    Returns
+    -------
+    list
+        List of features, with a list of coordinates per feature
+    """
+    # Each trace keeps its place in the input, for the output order, and whether
+    # trimming or joining has changed it
+    traces = [(np.asarray(points, dtype=np.float64).reshape(-1, 2), t, order) for order, (t, points) in enumerate(
+        (t, points) for t, features in enumerate(tiles) for points in features) if len(points)]
+    traces.sort(key=lambda trace: -len(trace[0]))
+
+    # Remove duplicates in the overlaps
+    kept = []
+    for points, t, order in traces:
+        lo = points.min(axis=0) - dup_dist
+        hi = points.max(axis=0) + dup_dist
+        near = np.zeros(len(points), dtype=bool)
+        for _, tiles_other, _, _, tree, (olo, ohi) in kept:
+            if t in tiles_other or np.any(lo > ohi) or np.any(hi < olo):
+                continue
+            dist, _ = tree.query(points, distance_upper_bound=dup_dist)
+            near |= np.isfinite(dist)
+        if near.mean() >= dup_frac:
+            continue
+        # Trim ends that run along another trace, keeping crossings in the middle
+        far = np.flatnonzero(~near)
+        trimmed = far[0] > 0 or far[-1] < len(points) - 1
+        points = points[far[0]:far[-1] + 1]
+        kept.append((points, {t}, order, trimmed, scipy.spatial.cKDTree(points), (points.min(axis=0), points.max(axis=0))))
+
+    # Join traces across seams, closest ends first
+    traces = [(points, tiles_t, order, trimmed) for points, tiles_t, order, trimmed, _, _ in kept]
+    cos_angle = np.cos(np.radians(join_angle))
+    joined = True
+    while joined and len(traces) > 1:
+        joined = False
+        ends = np.array([trace[0][-end] if end else trace[0][0] for trace in traces for end in (0, 1)])
+        pairs = scipy.spatial.cKDTree(ends).query_pairs(join_dist, output_type="ndarray")
+        if len(pairs) == 0:
+            break
+        gaps = np.hypot(*(ends[pairs[:, 0]] - ends[pairs[:, 1]]).T)
+        for a, b in pairs[np.argsort(gaps, kind="stable")]:
+            ia, ea = divmod(a, 2)
+            ib, eb = divmod(b, 2)
+            if ia == ib or traces[ia][1] & traces[ib][1]:
+                continue
+            da = _end_direction(traces[ia][0], ea)
+            db = _end_direction(traces[ib][0], eb)
+            if np.dot(da, -db) < cos_angle:
+                continue
+            gap = ends[b] - ends[a]
+            if np.hypot(*gap) > 0 and np.dot(gap / np.hypot(*gap), da) < cos_angle:
+                continue
+            # Orient a to end, and b to start, at the joined ends
+            pa = traces[ia][0] if ea else traces[ia][0][::-1]
+            pb = traces[ib][0][::-1] if eb else traces[ib][0]
+            merged = (np.concatenate([pa, pb]), traces[ia][1] | traces[ib][1], 
+                      min(traces[ia][2], traces[ib][2]), True)
+            traces = [trace for i, trace in enumerate(traces) if i not in (ia, ib)] + [merged]
+            joined = True
+            break
+
+    traces.sort(key=lambda trace: trace[2])
+    return([points.tolist() for points, _, _, changed in traces if not changed or len(points) >= lmin])
+
 class ManualTrace:
     def __init__(self, image_path=""):
         """
@@ -8,7 +8,7 @@ Created on Tue 6.28.22
 curvilinear features.
 """
 
-from PySide6.QtCore import Qt
+from PySide6.QtCore import (Qt, QTimer)
 from PySide6.QtGui import QPalette
 from PySide6.QtWidgets import (QColorDialog, QComboBox, QFileDialog, 
                             QFormLayout, QGroupBox, QHBoxLayout, 
@@ -18,13 +18,14 @@ from PySide6.QtWidgets import (QColorDialog, QComboBox, QFileDialog,
 from astropy.io import fits
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg
 from matplotlib import (pyplot, colors)
-from tracing.tracing import (AutoTracingOCCULT)
+from tracing.tracing import (AutoTracingOCCULT, OCCULTSweep)
 from helper.functions import ZoomPan
 from collections import OrderedDict
 import numpy as np
 import csv
 
 # Global variables
+SWEEP_POLL = 200 # ms between checks for finished sweep results
 LINEWIDTH = 0.5
 LINECOLOR = (0,0,1,0.7) # RGBA
 SEL_LINEWIDTH = 0.5
@@ -532,6 +533,7 @@ class OCCULTParams(QWidget):
         self.canvas = None
         self.ax = None
         self.results = None
+        self.sweep = None
         self.pcolor = (0,0,1,1)
         self.linecolor = LINECOLOR
         self.linewidth = LINEWIDTH
@@ -583,21 +585,34 @@ class OCCULTParams(QWidget):
 
         # Add button to save, trace and analyze the data
         self.traceButton = QPushButton("Trace")
+        self.cancelButton = QPushButton("Cancel")
         self.saveButton = QPushButton("Save")
         self.analyzeButton = QPushButton("Analyze")
 
         # Disable buttons until enabled by functions
         self.traceButton.setEnabled(False)
+        self.cancelButton.setEnabled(False)
         self.saveButton.setEnabled(False)
         self.analyzeButton.setEnabled(False)
 
         # Button configuration
         self.traceButton.clicked.connect(self.run_occult)
+        self.cancelButton.clicked.connect(self.cancel_occult)
         self.saveButton.clicked.connect(self.save_results)
         self.analyzeButton.clicked.connect(self.analyze_results)
+
+        # Status of a running trace
+        self.statusLabel = QLabel()
+        
+        # Timer which collects results of a running trace
+        self.sweepTimer = QTimer(self)
+        self.sweepTimer.setInterval(SWEEP_POLL)
+        self.sweepTimer.timeout.connect(self.poll_occult)
         
         # Add buttons to layout
         layout.addWidget(self.traceButton)
+        layout.addWidget(self.cancelButton)
+        layout.addWidget(self.statusLabel)
         buttonLayout.addWidget(self.analyzeButton)
         buttonLayout.addWidget(self.saveButton)
 
@@ -646,7 +661,8 @@ class OCCULTParams(QWidget):
 
     def run_occult(self):
         """
-        Run OCCULT-2 using paramers attached to self.
+        Run OCCULT-2 using paramers attached to self. Tracing runs
+        in an OCCULTSweep process pool, so the GUI stays responsive.
         """
         params = [self.nsm1, self.rmin, self.lmin, self.nstruc, self.ngap, self.qthresh1, self.qthresh2]
 
@@ -656,7 +672,7 @@ class OCCULTParams(QWidget):
                 param.setText(param.placeholderText())
 
         # Create an AutoTracingOCCULT instance
-        at = AutoTracingOCCULT(self.image_path)
+        at = AutoTracingOCCULT(self.image_path, cache=True)
 
         # Check if there is a range of parameters
         self.multiparams = {}
@@ -665,7 +681,7 @@ class OCCULTParams(QWidget):
                 start = param.text().split(",")[0]
                 end = param.text().split(",")[1]
                 self.multiparams[param] = [int(start), int(end)]
-            elif param.text().count(",") == 1 and param == self.qthresh1 and param == self.qthresh2:
+            elif param.text().count(",") == 1 and (param == self.qthresh1 or param == self.qthresh2):
                 start = param.text().split(",")[0]
                 end = param.text().split(",")[1]
                 self.multiparams[param] = [float(start), float(end)]            
@@ -673,109 +689,102 @@ class OCCULTParams(QWidget):
                 print("Error: Too many commas in ", param.text())
                 return
 
-        # Run OCCULT-2
-        if len(self.multiparams) == 0:
-            self.results = at.run(
-                int(self.nsm1.displayText()),
-                int(self.rmin.text()),
-                int(self.lmin.text()),
-                int(self.nstruc.text()),
-                int(self.ngap.text()),
-                float(self.qthresh1.text()),
-                float(self.qthresh2.text())
-            )
-
-            # Clear the current axes from previous results
-            self.ax.cla()
+        # Values of each parameter, ranges being expanded as [start, end)
+        values = []
+        for param in params:
+            if param not in self.multiparams:
+                if param == self.qthresh1 or param == self.qthresh2:
+                    values.append(float(param.text()))
+                else:
+                    values.append(int(param.text()))
+            elif param == self.qthresh1 or param == self.qthresh2:
+                values.append(list(np.arange(self.multiparams[param][0], self.multiparams[param][1], 0.25)))
+            elif param == self.nstruc:
+                values.append(list(range(self.multiparams[param][0], self.multiparams[param][1], 100)))
+            else:
+                values.append(list(range(self.multiparams[param][0], self.multiparams[param][1])))
 
-            # Reset the image, since it's cleared with cla()
-            self.ax.imshow(self.image_data, origin="lower")
+        # Run OCCULT-2 over all parameter sets
+        self.results = OrderedDict()
+        self.sweep = OCCULTSweep(at.img_data, *values, cache=True).start()
+        self.traceButton.setEnabled(False)
+        self.cancelButton.setEnabled(True)
+        self.statusLabel.setText("Traced 0 of {}".format(len(self.sweep)))
+        self.sweepTimer.start()
 
-            # Plot the results
-            for result in self.results:
-                x = []
-                y = []
-                for coord in result:
-                    x.append(coord[0])
-                    y.append(coord[1])
-                self.ax.plot(x,y, color=self.linecolor, linewidth=self.linewidth)
+    def poll_occult(self):
+        """
+        Collect finished OCCULT-2 results of the running sweep, and
+        plot them once every parameter set is done.
+        """
+        for key_name, result in self.sweep.poll():
+            print("Finished OCCULT-2 for", key_name)
+            self.results[key_name] = result
+        self.statusLabel.setText("Traced {} of {}".format(self.sweep.finished, len(self.sweep)))
+        if not self.sweep.done:
+            return
+        for key_name, error in self.sweep.errors.items():
+            print("OCCULT-2 failed for", key_name, ":", error)
 
-            # Refresh the canvas
-            self.ax.draw_artist(self.ax.patch)
-            self.canvas.update()
-            self.canvas.flush_events()
-            self.canvas.draw()
+        self.sweepTimer.stop()
+        self.traceButton.setEnabled(True)
+        self.cancelButton.setEnabled(False)
+        if len(self.results) == 0:
+            return
 
-            # Enable the save & color buttons
-            try:
-                self.saveButton.clicked.disconnect()
-                self.saveButton.clicked.connect(self.save_results)
-            except:
-                pass
-            self.saveButton.setEnabled(True)
-            self.analyzeButton.setEnabled(True)
-        
-        # If we have multiple parameters selected
+        # Keep the results in parameter order
+        self.results = OrderedDict((k, self.results[k]) for k in self.sweep.keys if k in self.results)
+        key_name = next(reversed(self.results))
+        multiple = len(self.sweep) > 1
+        if not multiple:
+            self.results = self.results[key_name]
+            features = self.results
         else:
-            self.results = OrderedDict()
-            for param in params:
-                if param not in self.multiparams:
-                    if param == self.qthresh1 or param == self.qthresh2:
-                        self.multiparams[param] = [float(param.text()), float(param.text())+0.25]
-                    else:
-                        self.multiparams[param] = [int(param.text()), int(param.text())+1]
-            
-            # Run OCCULT-2 over all ranges
-            for nsm1 in range(self.multiparams[self.nsm1][0], self.multiparams[self.nsm1][1]):
-                for rmin in range(self.multiparams[self.rmin][0], self.multiparams[self.rmin][1]):
-                    for lmin in range(self.multiparams[self.lmin][0], self.multiparams[self.lmin][1]):
-                        for nstruc in range(self.multiparams[self.nstruc][0], self.multiparams[self.nstruc][1],100):
-                            for ngap in range(self.multiparams[self.ngap][0], self.multiparams[self.ngap][1]):
-                                for qthresh1 in np.arange(self.multiparams[self.qthresh1][0], self.multiparams[self.qthresh1][1], 0.25):
-                                    for qthresh2 in np.arange(self.multiparams[self.qthresh2][0], self.multiparams[self.qthresh2][1], 0.25):
-                                        # Dictionary keys will be parameter set
-                                        key_name = "N{}-R{}-L{}-NS{}-NG{}-Q1{}-Q2{}".format(nsm1, rmin, lmin, nstruc, ngap, qthresh1, qthresh2)
-                                        print("Running OCCULT-2 for", key_name)
-                                        result = at.run(
-                                            nsm1,
-                                            rmin,
-                                            lmin,
-                                            nstruc,
-                                            ngap,
-                                            qthresh1,
-                                            qthresh2
-                                        )
-                                        self.results[key_name] = result
-
-            # Clear the current axes from previous results
-            self.ax.cla()
+            features = self.results[key_name]
 
-            # Reset the image, since it's cleared with cla()
-            self.ax.imshow(self.image_data, origin="lower")
+        # Clear the current axes from previous results
+        self.ax.cla()
 
-            # Plot the results
-            for feature in self.results[key_name]:
-                x = []
-                y = []
-                for coord in feature:
-                    x.append(coord[0])
-                    y.append(coord[1])
-                self.ax.plot(x,y, color=self.linecolor, linewidth=self.linewidth)
+        # Reset the image, since it's cleared with cla()
+        self.ax.imshow(self.image_data, origin="lower")
 
-            # Refresh the canvas
-            self.ax.draw_artist(self.ax.patch)
-            self.canvas.update()
-            self.canvas.flush_events()
-            self.canvas.draw()
+        # Plot the results
+        for feature in features:
+            x = []
+            y = []
+            for coord in feature:
+                x.append(coord[0])
+                y.append(coord[1])
+            self.ax.plot(x,y, color=self.linecolor, linewidth=self.linewidth)
+
+        # Refresh the canvas
+        self.ax.draw_artist(self.ax.patch)
+        self.canvas.update()
+        self.canvas.flush_events()
+        self.canvas.draw()
 
-            # Enable the save & color buttons
-            try:
-                self.saveButton.clicked.disconnect()
+        # Enable the save & color buttons
+        try:
+            self.saveButton.clicked.disconnect()
+            if multiple:
                 self.saveButton.clicked.connect(self.save_multiple)
-            except:
-                pass
-            self.saveButton.setEnabled(True)
-            self.analyzeButton.setEnabled(True)
+            else:
+                self.saveButton.clicked.connect(self.save_results)
+        except:
+            pass
+        self.saveButton.setEnabled(True)
+        self.analyzeButton.setEnabled(True)
+
+    def cancel_occult(self):
+        """
+        Cancel the running OCCULT-2 sweep, keeping the results
+        finished so far.
+        """
+        if self.sweep is None:
+            return
+        self.sweep.cancel()
+        self.poll_occult()
+        self.statusLabel.setText("Cancelled")
 
     def save_results(self):
         """